@@ -2,34 +2,70 @@
 ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 """
-import datetime
+import atexit
+import heapq
+import itertools
+import mimetypes
 import os
 
-from flask import Flask, jsonify, render_template, request, url_for
+from flask import (Flask, abort, g, json, jsonify, render_template, request,
+                   safe_join, send_file, send_from_directory, url_for)
 from libearth.codecs import Rfc3339
-from libearth.compat import text_type
-from libearth.crawler import crawl, open_url
+from libearth.compat import string_type, text_type
+from libearth.crawler import CrawlError
 from libearth.parser.autodiscovery import autodiscovery, FeedUrlNotFoundError
-from libearth.subscribe import Category, Subscription, SubscriptionList
+from libearth.subscribe import Category, Subscription
 from libearth.tz import now, utc
 
+from .assets import find_compressed_file, get_file_hash
+from .cache import (READ_FLAG, STARRED_FLAG, IteratorStore, content_cache,
+                    feed_cache, get_entry_flags, get_entry_key,
+                    subscription_cache)
+from .connection import connection_pool
+from .crawler import fetch_feed, save_validators
 from .util import autofix_repo_url, get_hash
-from .wsgi import MethodRewriteMiddleware
-from .exceptions import (InvalidCategoryID, IteratorNotFound, WorkerNotRunning,
-                         FeedNotFound, EntryNotFound)
+from .wsgi import GzipMiddleware, MethodRewriteMiddleware, accepts_gzip
+from .exceptions import (InvalidCategoryID, IteratorNotFound, JobNotFound,
+                         WorkerNotRunning, FeedNotFound, EntryNotFound)
 from .worker import Worker
+from .scheduler import Scheduler
 from .stage import stage
+from .timeline import encode_revisions, timeline
 
 
 app = Flask(__name__)
-app.wsgi_app = MethodRewriteMiddleware(app.wsgi_app)
+app.wsgi_app = GzipMiddleware(MethodRewriteMiddleware(app.wsgi_app))
 
 app.config.update(
     ALLFEED='All Feeds',
     SESSION_ID=None,
     PAGE_SIZE=20,
     CRAWLER_THREAD=4,
+    WORKER_POOL_SIZE=2,
+    CRAWL_SCHEDULER=False,
+    CRAWL_MIN_INTERVAL=15 * 60,
+    CRAWL_MAX_INTERVAL=24 * 60 * 60,
+    CRAWL_RATE_LIMIT=60,
+    CRAWL_ENGINE='threads',
+    CRAWL_CONCURRENCY=100,
+    CRAWL_HOST_CONNECTIONS=4,
+    CRAWL_HOST_INTERVAL=0.1,
     USE_WORKER=True,
+    FEED_CACHE_SIZE=1000,
+    FEED_CACHE_BYTES=64 * 1024 * 1024,
+    MARK_FLUSH_INTERVAL=None,
+    MARK_FLUSH_THRESHOLD=100,
+    CATEGORY_TIMELINE=True,
+    # A local directory outside the repository to persist the timeline
+    # index to, or None to build it in memory
+    TIMELINE_PERSIST=None,
+    ITERATOR_STORE_SIZE=10,
+    ITERATOR_STORE_TTL=30 * 60,
+    CONTENT_CACHE_BYTES=16 * 1024 * 1024,
+    # A local directory outside the repository to persist sanitized
+    # contents to, or None
+    CONTENT_CACHE_PERSIST=None,
+    STATIC_MAX_AGE=365 * 24 * 60 * 60,
     )
 
 
@@ -39,6 +75,7 @@ try:
 except KeyError:
     pass
 worker = Worker(app)
+scheduler = Scheduler(worker)
 
 
 @app.before_first_request
@@ -46,16 +83,53 @@ def initialize():
     if 'REPOSITORY' in app.config:
         app.config['REPOSITORY'] = autofix_repo_url(app.config['REPOSITORY'])
 
+    feed_cache.max_count = app.config['FEED_CACHE_SIZE']
+    feed_cache.max_bytes = app.config['FEED_CACHE_BYTES']
+    feed_cache.flush_threshold = app.config['MARK_FLUSH_THRESHOLD']
+    entry_generators.max_count = app.config['ITERATOR_STORE_SIZE']
+    entry_generators.ttl = app.config['ITERATOR_STORE_TTL']
+    content_cache.max_bytes = app.config['CONTENT_CACHE_BYTES']
+    content_cache.persist = app.config['CONTENT_CACHE_PERSIST']
+    timeline.persist = app.config['TIMELINE_PERSIST']
+    connection_pool.max_connections = app.config['CRAWL_HOST_CONNECTIONS']
+    connection_pool.interval = app.config['CRAWL_HOST_INTERVAL']
+    if app.config['MARK_FLUSH_INTERVAL']:
+        feed_cache.start_flusher(app.config['MARK_FLUSH_INTERVAL'],
+                                 flush_marks)
+        atexit.register(feed_cache.stop_flusher)
+    atexit.register(save_timeline)
+
     if app.config['USE_WORKER']:
         worker.start_worker()
+        if app.config['CRAWL_SCHEDULER']:
+            scheduler.min_interval = app.config['CRAWL_MIN_INTERVAL']
+            scheduler.max_interval = app.config['CRAWL_MAX_INTERVAL']
+            scheduler.rate_limit = app.config['CRAWL_RATE_LIMIT']
+            scheduler.start()
+            atexit.register(scheduler.stop)
+
+
+def flush_marks():
+    with app.app_context():
+        feed_cache.flush(stage)
+        timeline.save(stage)
+
+
+def save_timeline():
+    if timeline.dirty:
+        with app.app_context():
+            timeline.save(stage)
 
 
 class Cursor():
 
-    def __init__(self, category_id, return_parent=False):
+    def __init__(self, category_id, return_parent=False, writable=False):
+        # Cursors to change the subscription list get their own copy,
+        # since the cached one is shared by other requests
         with stage:
-            self.subscriptionlist = (stage.subscriptions if stage.subscriptions
-                                     else SubscriptionList())
+            self.subscriptionlist, categories = subscription_cache.load(
+                stage, fresh=writable
+            )
         self.value = self.subscriptionlist
         self.path = ['/']
         self.category_id = None
@@ -69,10 +143,11 @@ class Cursor():
                 self.path = [key[1:] for key in category_id.split('/')]
                 if return_parent:
                     target_name = self.path.pop(-1)
-                for key in self.path:
-                    self.value = self.value.categories[key]
+                if self.path:
+                    self.value = categories[tuple(self.path)]
                 if target_name:
-                    self.target_child = self.value.categories[target_name]
+                    self.target_child = categories[tuple(self.path) +
+                                                   (target_name,)]
         except Exception:
             raise InvalidCategoryID('The given category ID is not valid')
 
@@ -88,39 +163,78 @@ class Cursor():
         return '-' + append
 
 
+#: (:class:`~libearth.codecs.Rfc3339`) The codec shared by views.
+rfc3339 = Rfc3339()
+
+#: (:class:`dict`) Endpoints of :func:`add_urls()` keys for categories.
+CATEGORY_APIS = {
+    'entries_url': 'category_entries',
+    'feeds_url': 'feeds',
+    'add_feed_url': 'add_feed',
+    'add_category_url': 'add_category',
+    'remove_category_url': 'delete_category',
+    'move_url': 'move_outline',
+}
+
+#: (:class:`dict`) Endpoints of :func:`add_urls()` keys for feeds.
+FEED_APIS = dict(
+    CATEGORY_APIS,
+    entries_url='feed_entries',  # overwrite
+    remove_feed_url='delete_feed',
+)
+
+#: (:class:`dict`) Endpoints of :func:`add_urls()` keys for entries.
+ENTRY_APIS = dict(
+    FEED_APIS,
+    entry_url='feed_entry',
+    read_url='read_entry',
+    unread_url='unread_entry',
+    star_url='star_entry',
+    unstar_url='unstar_entry',
+)
+
+#: (:class:`str`) The placeholder of entry ids in URL templates.
+#: Entry ids are hex digests which URLs contain as they are, so it
+#: is replaced by them.
+ENTRY_ID_PLACEHOLDER = 'ENTRY_ID_PLACEHOLDER'
+
+
+def build_url(endpoint, category_id, feed_id=None, entry_id=None):
+    """The same to :func:`~flask.url_for()` with ``_external=True`` except
+    URLs are built only once per request.  URLs of entries are built from
+    a template per category and feed, with the entry id substituted.
+
+    """
+    templates = g.get('url_templates')
+    if templates is None:
+        templates = g.url_templates = {}
+    key = request.host_url, endpoint, category_id, feed_id
+    try:
+        template = templates[key]
+    except KeyError:
+        template = url_for(
+            endpoint,
+            category_id=category_id,
+            feed_id=feed_id,
+            entry_id=None if entry_id is None else ENTRY_ID_PLACEHOLDER,
+            _external=True
+        ).split(ENTRY_ID_PLACEHOLDER, 1)
+        templates[key] = template
+    if entry_id is None:
+        return template[0]
+    return template[0] + entry_id + template[1]
+
+
 def add_urls(data, keys, category_id, feed_id=None, entry_id=None):
-    APIS = {
-        'entries_url': 'category_entries',
-        'feeds_url': 'feeds',
-        'add_feed_url': 'add_feed',
-        'add_category_url': 'add_category',
-        'remove_category_url': 'delete_category',
-        'move_url': 'move_outline',
-    }
-    if feed_id is not None:
-        APIS.update(
-            entries_url='feed_entries',  # overwrite
-            remove_feed_url='delete_feed',
-        )
-        if entry_id is not None:
-            APIS.update(
-                entry_url='feed_entry',
-                read_url='read_entry',
-                unread_url='unread_entry',
-                star_url='star_entry',
-                unstar_url='unstar_entry',
-            )
-    urls = {}
+    if feed_id is None:
+        apis = CATEGORY_APIS
+    elif entry_id is None:
+        apis = FEED_APIS
+    else:
+        apis = ENTRY_APIS
     for key in keys:
-        if key in APIS:
-            urls[key] = url_for(
-                APIS[key],
-                category_id=category_id,
-                feed_id=feed_id,
-                entry_id=entry_id,
-                _external=True
-            )
-    data.update(urls)
+        if key in apis:
+            data[key] = build_url(apis[key], category_id, feed_id, entry_id)
 
 
 def add_path_data(data, category_id, feed_id=''):
@@ -132,15 +246,127 @@ def add_path_data(data, category_id, feed_id=''):
     data.update({'path': path})
 
 
+def get_etag(feed_ids, subscriptions=True):
+    """Make a strong ETag of the current request from revisions of
+    the subscription list and the feeds of ``feed_ids``, which are read
+    without parsing whole documents.  Since pending marks don't change
+    revisions until they are written, the last time feeds are marked is
+    taken into account as well.
+
+    :param feed_ids: feed ids that the response depends on
+    :type feed_ids: :class:`collections.Iterable`
+    :param subscriptions: whether the response depends on the subscription
+                          list.  :const:`True` by default
+    :type subscriptions: :class:`bool`
+    :returns: the etag
+    :rtype: :class:`str`
+
+    """
+    parts = [request.full_path, app.config['PAGE_SIZE'], worker.is_running()]
+    with stage:
+        if subscriptions:
+            revisions = subscription_cache.get_revisions(stage)
+            parts.append(encode_revisions(revisions))
+        for feed_id in sorted(frozenset(feed_ids)):
+            try:
+                revisions = feed_cache.get_revisions(stage, feed_id)
+            except KeyError:
+                revisions = None
+            else:
+                revisions = encode_revisions(revisions)
+            marked_at = feed_cache.get_last_marked_at(feed_id)
+            parts.append((feed_id, revisions,
+                          marked_at and rfc3339.encode(marked_at)))
+    return get_hash(repr(parts))
+
+
+def make_not_modified(etag):
+    response = app.response_class(status=304)
+    response.set_etag(etag)
+    return response
+
+
 @app.route('/', methods=['GET'])
 def index():
     return render_template('index.html')
 
 
+@app.url_defaults
+def add_static_hash(endpoint, values):
+    """Add the hash of the static file to its URL, so that it can be
+    cached for a long time.
+
+    """
+    if endpoint != 'static' or 'v' in values:
+        return
+    path = safe_join(app.static_folder, values.get('filename', ''))
+    try:
+        values['v'] = get_file_hash(path)
+    except (IOError, OSError):
+        pass
+
+
+@app.endpoint('static')
+def static(filename):
+    """Serve the static file.  The precompressed ``.gz`` file is served
+    instead if it exists and the client accepts ``gzip``.  Files requested
+    with their current hash are cached for :data:`STATIC_MAX_AGE`.
+
+    """
+    path = safe_join(app.static_folder, filename)
+    if not os.path.isfile(path):
+        abort(404)
+    compressed_path = None
+    if accepts_gzip(request.environ):
+        compressed_path = find_compressed_file(path)
+    if compressed_path:
+        mimetype = mimetypes.guess_type(filename)[0]
+        response = send_file(compressed_path,
+                             mimetype=mimetype or 'application/octet-stream',
+                             conditional=True)
+        response.content_encoding = 'gzip'
+    else:
+        response = send_from_directory(app.static_folder, filename)
+    response.vary.add('Accept-Encoding')
+    version = request.args.get('v')
+    if version and version == get_file_hash(path):
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config['STATIC_MAX_AGE']
+        response.expires = None
+    return response
+
+
+def get_entry_counts(subscriptions):
+    counts = {}
+    with stage:
+        for subscription in subscriptions:
+            feed_id = subscription.feed_id
+            if feed_id in counts:
+                continue
+            try:
+                counts[feed_id] = feed_cache.get_counts(stage, feed_id)
+            except KeyError:
+                counts[feed_id] = 0, 0
+    return counts
+
+
+def add_count_data(data, counts, feed_ids):
+    unread = starred = 0
+    for feed_id in feed_ids:
+        feed_unread, feed_starred = counts[feed_id]
+        unread += feed_unread
+        starred += feed_starred
+    data.update(unread_count=unread, starred_count=starred)
+
+
 @app.route('/feeds/', defaults={'category_id': ''})
 @app.route('/<path:category_id>/feeds/')
 def feeds(category_id):
     cursor = Cursor(category_id)
+    etag = get_etag(sub.feed_id for sub in cursor.recursive_subscriptions)
+    if etag in request.if_none_match:
+        return make_not_modified(etag)
+    counts = get_entry_counts(cursor.recursive_subscriptions)
     feeds = []
     categories = []
     for child in cursor:
@@ -149,23 +375,31 @@ def feeds(category_id):
             url_keys = ['entries_url', 'remove_feed_url']
             add_urls(data, url_keys, cursor.category_id, child.feed_id)
             add_path_data(data, cursor.category_id, child.feed_id)
+            add_count_data(data, counts, [child.feed_id])
             feeds.append(data)
         elif isinstance(child, Category):
             url_keys = ['feeds_url', 'entries_url', 'add_feed_url',
                         'add_category_url', 'remove_category_url', 'move_url']
             add_urls(data, url_keys, cursor.join_id(child.label))
             add_path_data(data, cursor.join_id(child.label))
+            add_count_data(data, counts, frozenset(
+                sub.feed_id for sub in child.recursive_subscriptions
+            ))
             categories.append(data)
-    return jsonify(feeds=feeds, categories=categories)
+    data = {'feeds': feeds, 'categories': categories}
+    add_count_data(data, counts, counts)
+    response = jsonify(data)
+    response.set_etag(etag)
+    return response
 
 
 @app.route('/feeds/', methods=['POST'], defaults={'category_id': ''})
 @app.route('/<path:category_id>/feeds/', methods=['POST'])
 def add_feed(category_id):
-    cursor = Cursor(category_id)
+    cursor = Cursor(category_id, writable=True)
     url = request.form['url']
     try:
-        f = open_url(url)
+        f = connection_pool.open(url)
         document = f.read()
         f.close()
     except Exception:
@@ -185,32 +419,42 @@ def add_feed(category_id):
         r.status_code = 400
         return r
     feed_url = feed_links[0].url
-    feed_url, feed, hints = next(iter(crawl([feed_url], 1)))
+    try:
+        result, validators, _ = fetch_feed(feed_url)
+    except CrawlError:
+        r = jsonify(
+            error='unreachable-feed-url',
+            message='Cannot fetch feed url'
+        )
+        r.status_code = 400
+        return r
     with stage:
-        sub = cursor.subscribe(feed)
-        stage.subscriptions = cursor.subscriptionlist
-        stage.feeds[sub.feed_id] = feed
+        sub = cursor.subscribe(result.feed)
+        subscription_cache.store(stage, cursor.subscriptionlist)
+        feed_cache.store(stage, sub.feed_id, result.feed)
+        # The next crawl can send a conditional request for the feed
+        save_validators(stage, sub.feed_id, validators)
     return feeds(category_id)
 
 
 @app.route('/', methods=['POST'], defaults={'category_id': ''})
 @app.route('/<path:category_id>/', methods=['POST'])
 def add_category(category_id):
-    cursor = Cursor(category_id)
+    cursor = Cursor(category_id, writable=True)
     title = request.form['title']
     outline = Category(label=title)
     cursor.add(outline)
     with stage:
-        stage.subscriptions = cursor.subscriptionlist
+        subscription_cache.store(stage, cursor.subscriptionlist)
     return feeds(category_id)
 
 
 @app.route('/<path:category_id>/', methods=['DELETE'])
 def delete_category(category_id):
-    cursor = Cursor(category_id, True)
+    cursor = Cursor(category_id, True, writable=True)
     cursor.remove(cursor.target_child)
     with stage:
-        stage.subscriptions = cursor.subscriptionlist
+        subscription_cache.store(stage, cursor.subscriptionlist)
     index = category_id.rfind('/')
     if index == -1:
         return feeds('')
@@ -222,7 +466,7 @@ def delete_category(category_id):
            defaults={'category_id': ''})
 @app.route('/<path:category_id>/feeds/<feed_id>/', methods=['DELETE'])
 def delete_feed(category_id, feed_id):
-    cursor = Cursor(category_id)
+    cursor = Cursor(category_id, writable=True)
     target = None
     for subscription in cursor:
         if isinstance(subscription, Subscription):
@@ -238,7 +482,10 @@ def delete_feed(category_id, feed_id):
         r.status_code = 400
         return r
     with stage:
-        stage.subscriptions = cursor.subscriptionlist
+        subscription_cache.store(stage, cursor.subscriptionlist)
+    if all(sub.feed_id != feed_id
+           for sub in cursor.subscriptionlist.recursive_subscriptions):
+        content_cache.discard(feed_id)
     return feeds(category_id)
 
 
@@ -248,13 +495,13 @@ def move_outline(category_id):
     source_path = request.args.get('from')
     if '/feeds/' in source_path:
         parent_category_id, feed_id = source_path.split('/feeds/')
-        source = Cursor(parent_category_id)
+        source = Cursor(parent_category_id, writable=True)
         target = None
         for child in source:
             if child.feed_id == feed_id:
                 target = child
     else:
-        source = Cursor(source_path, True)
+        source = Cursor(source_path, True, writable=True)
         target = source.target_child
 
     dest = Cursor(category_id)
@@ -267,56 +514,64 @@ def move_outline(category_id):
         return r
     source.discard(target)
     with stage:
-        stage.subscriptions = source.subscriptionlist
-    dest = Cursor(category_id)
+        subscription_cache.store(stage, source.subscriptionlist)
+    dest = Cursor(category_id, writable=True)
     dest.add(target)
     with stage:
-        stage.subscriptions = dest.subscriptionlist
+        subscription_cache.store(stage, dest.subscriptionlist)
     return jsonify()
 
 
-entry_generators = {}
-
-
-def tidy_generators_up():
-    global entry_generators
-    generators = []
-    for key, (it, time_saved) in entry_generators.items():
-        if time_saved >= now() - datetime.timedelta(minutes=30):
-            generators.append((key, (it, time_saved)))
-    generators = sorted(generators, key=lambda generator: generator[1][1],
-                        reverse=True)
-    entry_generators = dict(generators[:10])
+#: (:class:`~earthreader.web.cache.IteratorStore`) Iterators of paged
+#: entry lists, to continue next pages without resuming from cursors.
+entry_generators = IteratorStore()
 
 
 def to_bool(str_):
     return str_.strip().lower() == 'true'
 
 
+def get_filter_arg(name):
+    value = request.args.get(name)
+    return to_bool(value) if value else None
+
+
 def get_optional_args():
     url_token = request.args.get('url_token')
     entry_after = request.args.get('entry_after')
-    read = request.args.get('read')
-    starred = request.args.get('starred')
+    read = get_filter_arg('read')
+    starred = get_filter_arg('starred')
     return url_token, entry_after, read, starred
 
 
-def save_entry_generators(url_token, generator):
-    entry_generators[url_token] = generator, now()
+def parse_entry_after(entry_after, cached=None):
+    """Parse the ``entry_after`` cursor, which consists of the hash of
+    the entry id and the updated time of the last entry of the previous
+    page, e.g. ``0123abcd@2013-10-30T20:55:30Z``.  A bare entry id hash is
+    also accepted if the ``cached`` feed is given and has such entry.
 
+    :param entry_after: the cursor to parse
+    :type entry_after: :class:`str`
+    :param cached: the cached feed to find the entry of a bare hash
+    :type cached: :class:`~earthreader.web.cache.CachedFeed`
+    :returns: the key of the last entry.  see also
+              :func:`~earthreader.web.cache.get_entry_key()`
+    :rtype: :class:`tuple`
+    :raises ValueError: when the cursor is invalid
 
-def get_entry_generator(url_token):
-    pair = entry_generators.get(url_token)
-    if pair:
-        it = pair[0]
-        return it
-    else:
-        raise IteratorNotFound('The iterator does not exist')
+    """
+    entry_id, sep, updated = entry_after.partition('@')
+    if sep:
+        return rfc3339.decode(updated), entry_id
+    entry = cached and cached.find_entry(entry_id)
+    if entry is None:
+        raise ValueError('invalid cursor: ' + repr(entry_after))
+    return get_entry_key(entry)
 
 
-def remove_entry_generator(url_token):
-    if url_token in entry_generators:
-        entry_generators.pop(url_token)
+def format_entry_after(entry):
+    updated_at, entry_id = get_entry_key(entry)
+    return entry_id + '@' + rfc3339.encode(updated_at.astimezone(utc))
 
 
 def get_permalink(data):
@@ -337,21 +592,97 @@ def make_next_url(category_id, url_token, entry_after, read, starred,
     )
 
 
+def get_entry_data(category_id, feed_id, feed_title, feed_permalink, entry):
+    entry_id = get_hash(entry.id)
+    entry_permalink = get_permalink(entry)
+    entry_data = {
+        'title': text_type(entry.title),
+        'entry_id': entry_id,
+        'permalink': entry_permalink or None,
+        'updated': rfc3339.encode(entry.updated_at.astimezone(utc)),
+        'read': bool(entry.read),
+        'starred': bool(entry.starred)
+    }
+    feed_data = {
+        'title': feed_title,
+        'permalink': feed_permalink or None
+    }
+    add_urls(entry_data, ['entry_url'], category_id, feed_id, entry_id)
+    add_urls(feed_data, ['entries_url'], category_id, feed_id)
+    entry_data['feed'] = feed_data
+    return entry_data
+
+
+#: (:class:`dict`) The tails of entry fragments that contain read/starred
+#: flags, by flag bits.  See also :func:`get_entry_fragment()`.
+ENTRY_FLAG_FRAGMENTS = dict(
+    (flags, ', "read": {0}, "starred": {1}}}'.format(
+        json.dumps(bool(flags & READ_FLAG)),
+        json.dumps(bool(flags & STARRED_FLAG))
+    ))
+    for flags in range((READ_FLAG | STARRED_FLAG) + 1)
+)
+
+#: (:class:`str`) The placeholder of entries in :func:`jsonify_entries()`.
+ENTRIES_PLACEHOLDER = '__ENTRIES_PLACEHOLDER__'
+
+
+def get_entry_fragment(category_id, feed_id, cached, entry):
+    """Get the JSON encoded :func:`get_entry_data()` of the ``entry``.
+    Everything except read/starred flags is encoded only once per parsed
+    feed, and flags are patched in.
+
+    :param category_id: the category id of the listing
+    :type category_id: :class:`str`
+    :param feed_id: the feed id of the entry
+    :type feed_id: :class:`str`
+    :param cached: the cached feed of the entry
+    :type cached: :class:`~earthreader.web.cache.CachedFeed`
+    :param entry: the entry to encode
+    :type entry: :class:`~libearth.feed.Entry`
+    :returns: the JSON object
+    :rtype: :class:`str`
+
+    """
+    key = request.host_url, category_id, entry.id
+    fragment = cached.fragments.get(key)
+    if fragment is None:
+        feed = cached.feed
+        entry_data = get_entry_data(category_id, feed_id,
+                                    text_type(feed.title),
+                                    get_permalink(feed), entry)
+        del entry_data['read'], entry_data['starred']
+        fragment = json.dumps(entry_data)[:-1]
+        cached.fragments[key] = fragment
+    return fragment + ENTRY_FLAG_FRAGMENTS[get_entry_flags(entry)]
+
+
+def jsonify_entries(entries, **data):
+    """The same to :func:`~flask.jsonify()` except ``entries`` are
+    JSON fragments that :func:`get_entry_fragment()` returned, which are
+    concatenated as they are instead of being encoded again.
+
+    :param entries: JSON fragments of entries
+    :type entries: :class:`collections.Sequence`
+    :returns: the response
+    :rtype: :class:`flask.Response`
+
+    """
+    data['entries'] = ENTRIES_PLACEHOLDER
+    body = json.dumps(data).replace(json.dumps(ENTRIES_PLACEHOLDER),
+                                    '[' + ', '.join(entries) + ']', 1)
+    return app.response_class(body, mimetype='application/json')
+
+
 class FeedEntryGenerator():
 
-    def __init__(self, category_id, feed_id, feed_title, feed_permalink, it,
-                 time_used, read, starred):
+    def __init__(self, category_id, feed_id, cached, it, time_used):
         self.category_id = category_id
         self.feed_id = feed_id
-        self.feed_title = feed_title
-        self.feed_permalink = feed_permalink
+        self.cached = cached
         self.it = it
         self.time_used = time_used
 
-        self.filters = 'read', 'starred'
-        self.read = read
-        self.starred = starred
-
         self.entry = None
         self.find_next_entry()
 
@@ -361,59 +692,20 @@ class FeedEntryGenerator():
     def __next__(self):
         return next(self.it)
 
-    def set_iterator(self, entry_after=None):
-        if entry_after:
-            self.skip_to_next_entry(entry_after)
-        self.skip_until_filter_matched()
-
-    def skip_to_next_entry(self, latest_entry_id):
-        while latest_entry_id and get_hash(self.entry.id) != latest_entry_id:
-            self.entry = next(self.it)
-        self.entry = next(self.it)
-
-    def skip_until_filter_matched(self):
-        while self.filter_not_matched():
-            self.entry = next(self.it)
-
-    def filter_not_matched(self):
-        for filter in self.filters:
-            arg = getattr(self, filter)
-            if arg and to_bool(arg) != bool(getattr(self.entry, filter)):
-                return True
-        return False
-
     def find_next_entry(self):
         self.entry = next(self.it)
-        while self.filter_not_matched():
-            self.entry = next(self.it)
 
-    def get_entry_data(self):
+    def get_entry_fragment(self):
         if not self.entry:
             raise StopIteration
-        entry_permalink = get_permalink(self.entry)
-        entry_data = {
-            'title': text_type(self.entry.title),
-            'entry_id': get_hash(self.entry.id),
-            'permalink': entry_permalink or None,
-            'updated': Rfc3339().encode(self.entry.updated_at.astimezone(utc)),
-            'read': bool(self.entry.read),
-            'starred': bool(self.entry.starred)
-        }
-        feed_data = {
-            'title': self.feed_title,
-            'permalink': self.feed_permalink or None
-        }
-        add_urls(entry_data, ['entry_url'], self.category_id, self.feed_id,
-                 get_hash(self.entry.id))
-        add_urls(feed_data, ['entries_url'], self.category_id, self.feed_id)
-        entry_data['feed'] = feed_data
-        return entry_data
+        return self.entry, get_entry_fragment(self.category_id, self.feed_id,
+                                              self.cached, self.entry)
 
     def get_entries(self):
         entries = []
         while len(entries) < app.config['PAGE_SIZE']:
             try:
-                entry = self.get_entry_data()
+                entry = self.get_entry_fragment()
                 entries.append(entry)
                 self.find_next_entry()
             except StopIteration:
@@ -434,9 +726,12 @@ def feed_entries(category_id, feed_id):
         )
         r.status_code = 404
         return r
+    etag = get_etag([feed_id])
+    if etag in request.if_none_match:
+        return make_not_modified(etag)
     try:
         with stage:
-            feed = stage.feeds[feed_id]
+            cached = feed_cache.load(stage, feed_id)
     except KeyError:
         r = jsonify(
             error='feed-not-found',
@@ -444,9 +739,13 @@ def feed_entries(category_id, feed_id):
         )
         r.status_code = 404
         return r
+    feed = cached.feed
     if feed.__revision__:
         updated_at = feed.__revision__.updated_at
-        if request.if_modified_since:
+        last_marked_at = feed_cache.get_last_marked_at(feed_id)
+        if last_marked_at and last_marked_at > updated_at:
+            updated_at = last_marked_at
+        if request.if_modified_since and not request.if_none_match:
             if_modified_since = request.if_modified_since.replace(tzinfo=utc)
             last_modified = updated_at.replace(microsecond=0)
             if if_modified_since >= last_modified:
@@ -465,23 +764,28 @@ def feed_entries(category_id, feed_id):
     generator = None
     if url_token:
         try:
-            generator = get_entry_generator(url_token)
+            generator = entry_generators.pop(url_token, entry_after)
         except IteratorNotFound:
             pass
     else:
         url_token = text_type(now())
     if not generator:
-        it = iter(feed.entries)
-        feed_title = text_type(feed.title)
-        feed_permalink = get_permalink(feed)
         try:
-            generator = FeedEntryGenerator(category_id, feed_id, feed_title,
-                                           feed_permalink, it, now(), read,
-                                           starred)
-            generator.set_iterator(entry_after)
+            after = entry_after and parse_entry_after(entry_after, cached)
+        except ValueError:
+            r = jsonify(
+                error='entry-after-invalid',
+                message='Given entry_after cursor is invalid'
+            )
+            r.status_code = 400
+            return r
+        it = cached.iter_entries(after or None, read, starred)
+        try:
+            generator = FeedEntryGenerator(category_id, feed_id, cached, it,
+                                           now())
         except StopIteration:
-            return jsonify(
-                title=feed_title,
+            response = jsonify(
+                title=text_type(feed.title),
                 entries=[],
                 next_url=None,
                 read_url=url_for('read_all_entries',
@@ -491,25 +795,25 @@ def feed_entries(category_id, feed_id):
                                  _external=True),
                 crawl_url=crawl_url
             )
-    save_entry_generators(url_token, generator)
-    tidy_generators_up()
+            response.set_etag(etag)
+            return response
     entries = generator.get_entries()
     if len(entries) < app.config['PAGE_SIZE']:
         next_url = None
-        if not entries:
-            remove_entry_generator(url_token)
     else:
+        entry_after = format_entry_after(entries[-1][0])
+        entry_generators.put(url_token, generator, entry_after, cached.size)
         next_url = make_next_url(
             category_id,
             url_token,
-            entries[-1]['entry_id'],
+            entry_after,
             read,
             starred,
             feed_id
         )
-    response = jsonify(
+    response = jsonify_entries(
+        [fragment for _, fragment in entries],
         title=text_type(feed.title),
-        entries=entries,
         next_url=next_url,
         read_url=url_for('read_all_entries',
                          feed_id=feed_id,
@@ -519,13 +823,47 @@ def feed_entries(category_id, feed_id):
     )
     if feed.__revision__:
         response.last_modified = updated_at
+    response.set_etag(etag)
     return response
 
 
+class DescendingKey(object):
+    """Wraps a sort key to reverse its order, so that :mod:`heapq`, which
+    is a min-heap, pops the greatest (i.e. newest) key first.
+
+    :param key: the key to wrap
+    :type key: :class:`tuple`
+
+    """
+
+    __slots__ = 'key',
+
+    def __init__(self, key):
+        self.key = key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+    def __ne__(self, other):
+        return self.key != other.key
+
+    def __lt__(self, other):
+        return self.key > other.key
+
+
 class CategoryEntryGenerator():
+    """Merges entries of child :class:`FeedEntryGenerator` objects newest
+    first.  Heads of children are kept in a heap, so taking an entry costs
+    O(log F) for F feeds.
+
+    """
 
     def __init__(self):
-        self.generators = []
+        self.heap = []
+        self.sequence = itertools.count()
+        #: (:class:`numbers.Integral`) The approximate number of bytes of
+        #: feeds that child generators hold.
+        self.size = 0
 
     def add(self, feed_entry_generator):
         if not isinstance(feed_entry_generator, FeedEntryGenerator):
@@ -534,57 +872,58 @@ class CategoryEntryGenerator():
                 '{0.__module__}.{0.__name__}, not {1!r}'.format(
                     FeedEntryGenerator, feed_entry_generator)
             )
-        self.generators.append(feed_entry_generator)
+        self.push(feed_entry_generator)
 
-    def sort_generators(self):
-        self.generators = sorted(self.generators, key=lambda generator:
-                                 generator.entry.updated_at, reverse=True)
+    def push(self, generator):
+        key = DescendingKey(get_entry_key(generator.entry))
+        heapq.heappush(self.heap, (key, next(self.sequence), generator))
 
-    def remove_if_iterator_ends(self, generator):
-        try:
-            generator.find_next_entry()
-        except StopIteration:
-            self.generators.remove(generator)
+    def get_entries(self):
+        entries = []
+        while self.heap and len(entries) < app.config['PAGE_SIZE']:
+            _, _, generator = heapq.heappop(self.heap)
+            entries.append(generator.get_entry_fragment())
+            try:
+                generator.find_next_entry()
+            except StopIteration:
+                continue
+            self.push(generator)
+        return entries
 
-    def set_generators(self, entry_after, time_after):
-        empty_generators = []
-        for generator in self.generators:
-            while (self.entry_newer_than_timestamp(generator, time_after) or
-                   self.entry_same_as_latest_entry(generator, entry_after)):
-                try:
-                    generator.find_next_entry()
-                except StopIteration:
-                    empty_generators.append(generator)
-                    break
-        for generator in empty_generators:
-            self.generators.remove(generator)
-        self.sort_generators()
 
-    def entry_newer_than_timestamp(self, generator, time_after):
-        return (time_after and
-                generator.entry.updated_at > Rfc3339().decode(time_after))
+class TimelineEntryGenerator():
+    """Lists entries of a category from the :data:`timeline
+    <earthreader.web.timeline.timeline>` index instead of merging entries
+    of every feed in the category.  Only feeds of listed entries are read.
 
-    def entry_same_as_latest_entry(self, generator, entry_id):
-        return generator.entry.id == entry_id
+    """
 
-    def find_next_generator(self):
-        while self.generators:
-            self.sort_generators()
-            latest = self.generators[0]
-            yield latest
-            self.remove_if_iterator_ends(latest)
+    def __init__(self, category_id, subscriptions, after, read, starred):
+        self.category_id = category_id
+        self.feed_ids = frozenset(sub.feed_id for sub in subscriptions)
+        self.after = after
+        self.read = read
+        self.starred = starred
 
     def get_entries(self):
         entries = []
-        generator_generator = self.find_next_generator()
-        while len(entries) < app.config['PAGE_SIZE']:
-            try:
-                generator = next(generator_generator)
-                entry_data = generator.get_entry_data()
-                entries.append(entry_data)
-            except StopIteration:
-                return entries
-        self.remove_if_iterator_ends(generator)
+        with stage:
+            timeline.refresh(stage, self.feed_ids)
+            rows = timeline.iter_rows(self.feed_ids, self.after,
+                                      self.read, self.starred)
+            for _, entry_id, feed_id, _, _ in rows:
+                try:
+                    cached = feed_cache.load(stage, feed_id)
+                except KeyError:
+                    continue
+                entry = cached.find_entry(entry_id)
+                if entry is None:
+                    continue
+                entries.append((entry, get_entry_fragment(
+                    self.category_id, feed_id, cached, entry
+                )))
+                if len(entries) >= app.config['PAGE_SIZE']:
+                    break
         return entries
 
 
@@ -592,11 +931,28 @@ class CategoryEntryGenerator():
 @app.route('/<path:category_id>/entries/')
 def category_entries(category_id):
     cursor = Cursor(category_id)
+    etag = get_etag(sub.feed_id for sub in cursor.recursive_subscriptions)
+    if etag in request.if_none_match:
+        return make_not_modified(etag)
     generator = None
     url_token, entry_after, read, starred = get_optional_args()
-    if url_token:
+    try:
+        after = entry_after and parse_entry_after(entry_after) or None
+    except ValueError:
+        r = jsonify(
+            error='entry-after-invalid',
+            message='Given entry_after cursor is invalid'
+        )
+        r.status_code = 400
+        return r
+    if app.config['CATEGORY_TIMELINE']:
+        url_token = None
+        generator = TimelineEntryGenerator(category_id,
+                                           cursor.recursive_subscriptions,
+                                           after, read, starred)
+    elif url_token:
         try:
-            generator = get_entry_generator(url_token)
+            generator = entry_generators.pop(url_token, entry_after)
         except IteratorNotFound:
             pass
     else:
@@ -604,60 +960,51 @@ def category_entries(category_id):
     if not generator:
         subscriptions = cursor.recursive_subscriptions
         generator = CategoryEntryGenerator()
-        if entry_after:
-            id_after, time_after = entry_after.split('@')
-        else:
-            time_after = None
-            id_after = None
         for subscription in subscriptions:
             try:
                 with stage:
-                    feed = stage.feeds[subscription.feed_id]
+                    cached = feed_cache.load(stage, subscription.feed_id)
             except KeyError:
                 continue
-            feed_title = text_type(feed.title)
-            it = iter(feed.entries)
-            feed_permalink = get_permalink(feed)
+            it = cached.iter_entries(after, read, starred)
             try:
                 child = FeedEntryGenerator(category_id, subscription.feed_id,
-                                           feed_title, feed_permalink, it,
-                                           now(), read, starred)
+                                           cached, it, now())
             except StopIteration:
                 continue
             generator.add(child)
-        generator.set_generators(id_after, time_after)
-    save_entry_generators(url_token, generator)
-    tidy_generators_up()
+            generator.size += cached.size
     entries = generator.get_entries()
     if not entries or len(entries) < app.config['PAGE_SIZE']:
         next_url = None
-        if not entries:
-            remove_entry_generator(url_token)
     else:
-        entry_after = entries[-1]['entry_id'] + '@' + entries[-1]['updated']
+        entry_after = format_entry_after(entries[-1][0])
+        if url_token:
+            entry_generators.put(url_token, generator, entry_after,
+                                 generator.size)
         next_url = make_next_url(category_id, url_token, entry_after, read,
                                  starred)
 
-    # FIXME: use Entry.updated_at instead of from json data.
-    codec = Rfc3339()
     last_updated_at = ''
     if len(entries) and not entry_after:
-        last_updated_at = max(codec.decode(x['updated'])
-                              for x in entries).isoformat()
+        last_updated_at = max(entry.updated_at.astimezone(utc)
+                              for entry, _ in entries).isoformat()
 
     if worker.is_running():
         crawl_url = url_for('update_entries', category_id=category_id),
     else:
         crawl_url = None
-    return jsonify(
+    response = jsonify_entries(
+        [fragment for _, fragment in entries],
         title=category_id.split('/')[-1][1:] or app.config['ALLFEED'],
-        entries=entries,
         read_url=url_for('read_all_entries', category_id=category_id,
                          last_updated=last_updated_at,
                          _external=True),
         crawl_url=crawl_url,
         next_url=next_url
     )
+    response.set_etag(etag)
+    return response
 
 
 @app.route('/feeds/<feed_id>/entries/', defaults={'category_id': ''},
@@ -668,37 +1015,65 @@ def category_entries(category_id):
 def update_entries(category_id, feed_id=None):
     if worker.is_running():
         cursor = Cursor(category_id)
-        worker.add_job(cursor, feed_id)
-        r = jsonify()
+        job = worker.add_job(cursor, feed_id)
+        job_url = url_for('crawl_job', job_id=job.id, _external=True)
+        r = jsonify(job_url=job_url)
         r.status_code = 202
+        r.headers['Location'] = job_url
         return r
     else:
         raise WorkerNotRunning('Worker thread is not running.')
 
 
+@app.route('/jobs/<job_id>/', methods=['GET'])
+def crawl_job(job_id):
+    job = worker.get_job(job_id)
+    if job is None:
+        raise JobNotFound('The crawl job does not exist.')
+    return jsonify(
+        id=job.id,
+        status=job.status,
+        feeds=len(job.feed_urls),
+        crawled=job.crawled,
+        failed=job.failed,
+        bytes=job.bytes,
+        elapsed=job.elapsed
+    )
+
+
 def find_feed_and_entry(feed_id, entry_id):
     try:
         with stage:
-            feed = stage.feeds[feed_id]
+            feed, entry = feed_cache.get_entry(stage, feed_id, entry_id)
+    except KeyError:
+        raise FeedNotFound('The feed is not reachable')
+    if entry is None:
+        raise EntryNotFound('The entry is not reachable')
+    return feed, get_permalink(feed), entry, get_permalink(entry)
+
+
+def mark_entry(feed_id, entry_id, **marks):
+    try:
+        entry = feed_cache.mark(stage, feed_id, entry_id, **marks)
     except KeyError:
         raise FeedNotFound('The feed is not reachable')
-    feed_permalink = get_permalink(feed)
-    for entry in feed.entries:
-        entry_permalink = get_permalink(entry)
-        if entry_id == get_hash(entry.id):
-            return feed, feed_permalink, entry, entry_permalink
-    raise EntryNotFound('The entry is not reachable')
+    if entry is None:
+        raise EntryNotFound('The entry is not reachable')
+    timeline.mark(feed_id, entry_id, **marks)
 
 
 @app.route('/feeds/<feed_id>/entries/<entry_id>/',
            defaults={'category_id': ''})
 @app.route('/<path:category_id>/feeds/<feed_id>/entries/<entry_id>/')
 def feed_entry(category_id, feed_id, entry_id):
+    etag = get_etag([feed_id], subscriptions=False)
+    if etag in request.if_none_match:
+        return make_not_modified(etag)
     feed, feed_permalink, entry, entry_permalink = \
         find_feed_and_entry(feed_id, entry_id)
     content = entry.content or entry.summary
     if content is not None:
-        content = content.sanitized_html
+        content = content_cache.get(feed_id, entry_id, content)
 
     entry_data = {
         'title': text_type(entry.title),
@@ -724,7 +1099,9 @@ def feed_entry(category_id, feed_id, entry_id):
         feed_id
     )
     entry_data['feed'] = feed_data
-    return jsonify(entry_data)
+    response = jsonify(entry_data)
+    response.set_etag(etag)
+    return response
 
 
 @app.route('/feeds/<feed_id>/entries/<entry_id>/read/',
@@ -732,10 +1109,7 @@ def feed_entry(category_id, feed_id, entry_id):
 @app.route('/<path:category_id>/feeds/<feed_id>/entries/<entry_id>/read/',
            methods=['PUT'])
 def read_entry(category_id, feed_id, entry_id):
-    feed, _, entry, _ = find_feed_and_entry(feed_id, entry_id)
-    entry.read = True
-    with stage:
-        stage.feeds[feed_id] = feed
+    mark_entry(feed_id, entry_id, read=True)
     return jsonify()
 
 
@@ -744,10 +1118,7 @@ def read_entry(category_id, feed_id, entry_id):
 @app.route('/<path:category_id>/feeds/<feed_id>/entries/<entry_id>/read/',
            methods=['DELETE'])
 def unread_entry(category_id, feed_id, entry_id):
-    feed, _, entry, _ = find_feed_and_entry(feed_id, entry_id)
-    entry.read = False
-    with stage:
-        stage.feeds[feed_id] = feed
+    mark_entry(feed_id, entry_id, read=False)
     return jsonify()
 
 
@@ -772,11 +1143,19 @@ def read_all_entries(category_id='', feed_id=None):
     for feed_id in feed_ids:
         try:
             with stage:
-                feed = stage.feeds[feed_id]
-                for entry in feed.entries:
-                    if not last_updated or entry.updated_at <= last_updated:
-                        entry.read = True
-                stage.feeds[feed_id] = feed
+                feed = feed_cache.get(stage, feed_id)
+                entry_ids = [get_hash(entry.id) for entry in feed.entries
+                             if not entry.read and
+                             (not last_updated or
+                              entry.updated_at <= last_updated)]
+            # Marked through the feed cache so that pending marks of
+            # entries are replaced instead of applied again
+            feed_cache.mark_entries(
+                stage, feed_id,
+                dict((entry_id, {'read': True}) for entry_id in entry_ids)
+            )
+            for entry_id in entry_ids:
+                timeline.mark(feed_id, entry_id, read=True)
         except KeyError:
             if feed_id:
                 r = jsonify(
@@ -795,10 +1174,7 @@ def read_all_entries(category_id='', feed_id=None):
 @app.route('/<path:category_id>/feeds/<feed_id>/entries/<entry_id>/star/',
            methods=['PUT'])
 def star_entry(category_id, feed_id, entry_id):
-    feed, _, entry, _ = find_feed_and_entry(feed_id, entry_id)
-    entry.starred = True
-    with stage:
-        stage.feeds[feed_id] = feed
+    mark_entry(feed_id, entry_id, starred=True)
     return jsonify()
 
 
@@ -807,8 +1183,81 @@ def star_entry(category_id, feed_id, entry_id):
 @app.route('/<path:category_id>/feeds/<feed_id>/entries/<entry_id>/star/',
            methods=['DELETE'])
 def unstar_entry(category_id, feed_id, entry_id):
-    feed, _, entry, _ = find_feed_and_entry(feed_id, entry_id)
-    entry.starred = False
-    with stage:
-        stage.feeds[feed_id] = feed
+    mark_entry(feed_id, entry_id, starred=False)
     return jsonify()
+
+
+def parse_mark_operation(operation):
+    if isinstance(operation, dict):
+        feed_id = operation.get('feed_id')
+        entry_id = operation.get('entry_id')
+        values = [operation.get('read'), operation.get('starred')]
+    elif isinstance(operation, list) and 2 <= len(operation) <= 4:
+        feed_id, entry_id = operation[:2]
+        values = operation[2:]
+    else:
+        raise ValueError('invalid mark operation: ' + repr(operation))
+    if not (isinstance(feed_id, string_type) and
+            isinstance(entry_id, string_type)):
+        raise ValueError('invalid mark operation: ' + repr(operation))
+    marks = {}
+    for attr, value in zip(('read', 'starred'), values):
+        if value is None:
+            continue
+        elif not isinstance(value, bool):
+            raise ValueError('invalid mark operation: ' + repr(operation))
+        marks[attr] = value
+    return feed_id, entry_id, marks
+
+
+@app.route('/entries/marks/', methods=['PUT'])
+def mark_entries():
+    """Mark several entries at once.  It takes a JSON list of operations,
+    each of which is ``{"feed_id": ..., "entry_id": ..., "read": ...,
+    "starred": ...}`` or ``[feed_id, entry_id, read, starred]`` (``read``
+    and ``starred`` are optional), and each touched feed is read and written
+    only once.  The result of each operation is listed in the same order.
+
+    """
+    operations = request.get_json(force=True, silent=True)
+    if not isinstance(operations, list):
+        r = jsonify(
+            error='invalid-marks',
+            message='Expected a JSON list of mark operations'
+        )
+        r.status_code = 400
+        return r
+    results = [None] * len(operations)
+    feed_marks = {}
+    for i, operation in enumerate(operations):
+        try:
+            feed_id, entry_id, marks = parse_mark_operation(operation)
+        except ValueError:
+            results[i] = {
+                'error': 'invalid-mark',
+                'message': 'Given mark operation is not valid'
+            }
+            continue
+        entry_marks, indices = feed_marks.setdefault(feed_id, ({}, []))
+        entry_marks.setdefault(entry_id, {}).update(marks)
+        indices.append((i, entry_id))
+    for feed_id, (entry_marks, indices) in feed_marks.items():
+        try:
+            entries = feed_cache.mark_entries(stage, feed_id, entry_marks)
+        except KeyError:
+            entries = {}
+            error = FeedNotFound
+        else:
+            error = EntryNotFound
+        for i, entry_id in indices:
+            result = {'feed_id': feed_id, 'entry_id': entry_id}
+            entry = entries.get(entry_id)
+            if entry is None:
+                result.update(error=error.error, message=error.message)
+            else:
+                result.update(read=bool(entry.read),
+                              starred=bool(entry.starred))
+                timeline.mark(feed_id, entry_id, result['read'],
+                              result['starred'])
+            results[i] = result
+    return jsonify(results=results)
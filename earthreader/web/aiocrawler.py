@@ -0,0 +1,379 @@
+""":mod:`earthreader.web.aiocrawler` --- Asyncio crawl engine
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+The default crawl engine (:func:`earthreader.web.crawler.crawl()`) fetches
+feeds on a pool of threads, so only as many fetches as threads can be in
+flight at a time.  This engine fetches feeds on an :mod:`asyncio` event
+loop instead, so that hundreds of fetches can be in flight with bounded
+concurrency.  Fetched feeds are parsed in the same way as the default
+engine does.
+
+Connections are kept alive per host during a crawl, and requests follow
+per-host limits of :data:`~earthreader.web.connection.connection_pool`.
+
+It requires Python 3.4 to 3.10, since coroutines of it are generators
+decorated by :func:`asyncio.coroutine()` which was removed in Python 3.11.
+Get the engine through
+:func:`earthreader.web.crawler.get_engine()` rather than importing this
+module directly.
+
+"""
+import asyncio
+import threading
+import zlib
+
+from libearth.crawler import DEFAULT_TIMEOUT, CrawlError
+from libearth.version import VERSION
+from six.moves import queue
+from six.moves.urllib.parse import urljoin, urlsplit
+
+from .connection import connection_pool
+from .crawler import get_conditional_headers, parse_feed
+
+__all__ = ('MAX_REDIRECTS', 'CrawlIterator', 'HostConnections', 'crawl',
+           'fetch_feed')
+
+
+#: (:class:`numbers.Integral`) The maximum number of redirects to follow.
+MAX_REDIRECTS = 5
+
+REDIRECT_STATUSES = frozenset([301, 302, 303, 307, 308])
+
+
+@asyncio.coroutine
+def read_chunked(reader):
+    chunks = []
+    while True:
+        line = yield from reader.readline()
+        size = int(line.split(b';', 1)[0].strip(), 16)
+        if not size:
+            break
+        chunks.append((yield from reader.readexactly(size)))
+        yield from reader.readline()
+    while (yield from reader.readline()) not in (b'\r\n', b'\n', b''):
+        # Skip trailers
+        continue
+    return b''.join(chunks)
+
+
+@asyncio.coroutine
+def send_request(reader, writer, parts, headers):
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    lines = [
+        'GET {0} HTTP/1.1'.format(path),
+        'Host: ' + parts.netloc.rpartition('@')[2],
+        'User-Agent: libearth/' + VERSION,
+        'Accept-Encoding: gzip'
+    ]
+    lines.extend('{0}: {1}'.format(name, value) for name, value in headers)
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+    status_line = yield from reader.readline()
+    try:
+        version, status = status_line.split(None, 2)[:2]
+        status = int(status)
+    except ValueError:
+        raise ValueError('invalid status line: {0!r}'.format(status_line))
+    response_headers = {}
+    while True:
+        line = yield from reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        response_headers[name.strip().lower()] = value.strip()
+    connection = response_headers.get('connection', '').lower()
+    keep_alive = (connection == 'keep-alive' or
+                  version == b'HTTP/1.1' and connection != 'close')
+    encoding = response_headers.get('transfer-encoding', '').lower()
+    if status in (204, 304):
+        body = b''
+    elif encoding == 'chunked':
+        body = yield from read_chunked(reader)
+    elif 'content-length' in response_headers:
+        body = yield from reader.readexactly(
+            int(response_headers['content-length'])
+        )
+    else:
+        body = yield from reader.read()
+        keep_alive = False
+    return status, response_headers, body, keep_alive
+
+
+class HostConnections(object):
+    """Keep-alive connections per host of a crawl on an event loop.
+    Requests follow the per-host limits of the connection ``pool``,
+    and are counted to its statistics.  Since connections belong to
+    the event loop, they aren't shared with other crawls.
+
+    :param pool: the connection pool of which limits to follow
+    :type pool: :class:`~earthreader.web.connection.ConnectionPool`
+    :param concurrency: the maximum number of requests in flight
+    :type concurrency: :class:`numbers.Integral`
+    :param loop: the event loop of the crawl.  it has to be set as
+                 the event loop of the current thread
+    :type loop: :class:`asyncio.AbstractEventLoop`
+
+    """
+
+    def __init__(self, pool, concurrency, loop):
+        self.pool = pool
+        self.loop = loop
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.host_semaphores = {}
+        self.idle = {}
+
+    @asyncio.coroutine
+    def request(self, url, headers=(), timeout=None):
+        """Send a ``GET`` request to the ``url`` and read the whole
+        response.  Redirects are not followed.
+
+        :param url: the http or https url to request
+        :type url: :class:`str`
+        :param headers: pairs of additional header names and values
+        :type headers: :class:`collections.Iterable`
+        :param timeout: optional timeout for connecting and reading.
+                        time waiting for the per-host limits is not
+                        counted
+        :type timeout: :class:`numbers.Real`
+        :returns: a triple of the status code, headers of lowercased names,
+                  and the body
+        :rtype: :class:`tuple`
+        :raises ValueError: when the url isn't http nor https
+        :raises asyncio.TimeoutError: when it timed out
+
+        """
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError('unsupported url: ' + url)
+        key = parts.scheme, parts.netloc.rpartition('@')[2]
+        host_semaphore = self.host_semaphores.get(key)
+        if host_semaphore is None:
+            host_semaphore = asyncio.Semaphore(self.pool.max_connections)
+            self.host_semaphores[key] = host_semaphore
+        with (yield from host_semaphore):
+            delay = self.pool.reserve(key)
+            if delay > 0:
+                yield from asyncio.sleep(delay)
+            with (yield from self.semaphore):
+                status, response_headers, body = yield from asyncio.wait_for(
+                    self.send(key, parts, headers), timeout
+                )
+        if response_headers.get('content-encoding', '').lower() == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return status, response_headers, body
+
+    @asyncio.coroutine
+    def send(self, key, parts, headers):
+        while True:
+            idle = self.idle.get(key)
+            reused = bool(idle)
+            if reused:
+                reader, writer = idle.pop()
+            else:
+                secure = parts.scheme == 'https'
+                reader, writer = yield from asyncio.open_connection(
+                    parts.hostname, parts.port or (443 if secure else 80),
+                    ssl=secure
+                )
+            try:
+                status, response_headers, body, keep_alive = \
+                    yield from send_request(reader, writer, parts, headers)
+            except (asyncio.IncompleteReadError, ConnectionError,
+                    ValueError):
+                writer.close()
+                if reused:
+                    # The server may have closed the idle connection
+                    continue
+                raise
+            except BaseException:
+                # e.g. cancelled by timeout
+                writer.close()
+                raise
+            break
+        self.pool.record(key, reused)
+        if keep_alive:
+            self.idle.setdefault(key, []).append((reader, writer))
+        else:
+            writer.close()
+        return status, response_headers, body
+
+    def close(self):
+        """Close all idle connections."""
+        for connections in self.idle.values():
+            for _, writer in connections:
+                writer.close()
+        self.idle.clear()
+
+
+@asyncio.coroutine
+def fetch_feed(feed_url, validators, timeout, connections):
+    """The coroutine version of :func:`earthreader.web.crawler.fetch_feed()`.
+
+    :param feed_url: the feed url to fetch
+    :type feed_url: :class:`str`
+    :param validators: validators returned by the last fetch
+    :type validators: :class:`collections.Mapping`
+    :param timeout: timeout for connecting and reading each request
+    :type timeout: :class:`numbers.Real`
+    :param connections: connections of the crawl to request through
+    :type connections: :class:`HostConnections`
+    :returns: the same triple to
+              :func:`earthreader.web.crawler.fetch_feed()`
+    :rtype: :class:`tuple`
+    :raises libearth.crawler.CrawlError: when it failed to fetch or parse
+                                         the feed
+
+    """
+    validators = validators or {}
+    headers = get_conditional_headers(validators)
+    url = feed_url
+    try:
+        for _ in range(MAX_REDIRECTS + 1):
+            status, response_headers, body = yield from connections.request(
+                url, headers, timeout
+            )
+            if status not in REDIRECT_STATUSES or \
+               'location' not in response_headers:
+                break
+            url = urljoin(url, response_headers['location'])
+        else:
+            raise CrawlError(feed_url, '{0} failed: too many redirects'
+                                       .format(feed_url))
+    except CrawlError:
+        raise
+    except asyncio.TimeoutError:
+        raise CrawlError(feed_url, '{0} failed: timed out'.format(feed_url))
+    except Exception as e:
+        raise CrawlError(feed_url, '{0} failed: {1}'.format(feed_url, e))
+    if status == 304 and validators:
+        return None, validators, 0
+    elif not 200 <= status < 300:
+        raise CrawlError(feed_url, '{0} failed: HTTP Error {1}'
+                                   .format(feed_url, status))
+    return parse_feed(feed_url, body, response_headers)
+
+
+class CrawlIterator(object):
+    """Iterator of crawl results which :func:`crawl()` returns.  Feeds are
+    fetched on an event loop of a background thread, and results are
+    yielded in order of completion, as soon as each fetch completes.
+
+    Unlike iterators of :func:`earthreader.web.crawler.crawl()`, it
+    raises :exc:`~libearth.crawler.CrawlError` for each failed feed,
+    and can be iterated further after that.
+
+    :param feeds: feed urls to their validators
+    :type feeds: :class:`collections.Mapping`
+    :param concurrency: the maximum number of fetches in flight
+    :type concurrency: :class:`numbers.Integral`
+    :param timeout: optional timeout for each request
+    :type timeout: :class:`numbers.Real`
+    :param connections: the connection pool of which per-host limits to
+                        follow.
+                        :data:`~earthreader.web.connection.connection_pool`
+                        by default
+    :type connections: :class:`~earthreader.web.connection.ConnectionPool`
+
+    """
+
+    def __init__(self, feeds, concurrency, timeout=DEFAULT_TIMEOUT,
+                 connections=None):
+        self.results = queue.Queue()
+        self.remaining = len(feeds)
+        if feeds:
+            thread = threading.Thread(
+                target=self.run,
+                args=(dict(feeds), concurrency, timeout,
+                      connections or connection_pool)
+            )
+            thread.daemon = True
+            thread.start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.remaining:
+            raise StopIteration()
+        self.remaining -= 1
+        result = self.results.get()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def run(self, feeds, concurrency, timeout, pool):
+        # Feed urls of which results aren't delivered yet
+        pending = set(feeds)
+        error = 'crawl stopped'
+        try:
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                connections = HostConnections(pool, concurrency, loop)
+                try:
+                    loop.run_until_complete(
+                        self.fetch_all(feeds, timeout, connections, pending)
+                    )
+                finally:
+                    connections.close()
+            finally:
+                asyncio.set_event_loop(None)
+                loop.close()
+        except Exception as e:
+            error = e
+        finally:
+            # The consumer always gets as many results as feeds
+            for feed_url in pending:
+                self.results.put(CrawlError(
+                    feed_url, '{0} failed: {1}'.format(feed_url, error)
+                ))
+
+    @asyncio.coroutine
+    def fetch_all(self, feeds, timeout, connections, pending):
+        def deliver(feed_url, result):
+            pending.discard(feed_url)
+            self.results.put(result)
+
+        @asyncio.coroutine
+        def fetch(feed_url):
+            try:
+                result = yield from fetch_feed(feed_url, feeds[feed_url],
+                                               timeout, connections)
+            except CrawlError as e:
+                deliver(feed_url, e)
+            except Exception as e:
+                deliver(feed_url, CrawlError(
+                    feed_url, '{0} failed: {1}'.format(feed_url, e)
+                ))
+            else:
+                deliver(feed_url, (feed_url,) + result)
+        loop = asyncio.get_event_loop()
+        yield from asyncio.wait([loop.create_task(fetch(feed_url))
+                                 for feed_url in feeds])
+
+
+def crawl(feeds, pool_size, timeout=DEFAULT_TIMEOUT, connections=None):
+    """Crawl feeds concurrently on an :mod:`asyncio` event loop.
+    It takes the same arguments to :func:`earthreader.web.crawler.crawl()`
+    and returns the same quadruples.
+
+    :param feeds: feed urls to their validators
+    :type feeds: :class:`collections.Mapping`
+    :param pool_size: the maximum number of fetches in flight
+    :type pool_size: :class:`numbers.Integral`
+    :param timeout: optional timeout for each request
+    :type timeout: :class:`numbers.Real`
+    :param connections: the connection pool of which per-host limits to
+                        follow.
+                        :data:`~earthreader.web.connection.connection_pool`
+                        by default
+    :type connections: :class:`~earthreader.web.connection.ConnectionPool`
+    :returns: quadruples of the feed url, the
+              :class:`~libearth.crawler.CrawlResult` (or :const:`None` if
+              the feed has not been modified), new validators, and
+              downloaded bytes
+    :rtype: :class:`CrawlIterator`
+
+    """
+    return CrawlIterator(feeds, pool_size, timeout, connections)
@@ -0,0 +1,124 @@
+""":mod:`earthreader.web.assets` --- Static assets
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Static files are referred with URLs containing hashes of their contents,
+so that browsers can cache them for a long time and still get new ones
+as soon as they change.  Textual static files can be also compressed
+ahead of time by :program:`earthreader compress-static`, and those
+precompressed ``.gz`` files are served as they are to clients accepting
+``gzip``.
+
+"""
+import hashlib
+import os
+import os.path
+import threading
+import zlib
+
+__all__ = ('COMPRESSIBLE_EXTENSIONS', 'compress_file',
+           'compress_static_files', 'find_compressed_file', 'get_file_hash')
+
+
+#: (:class:`collections.Set`) The set of file extensions to precompress.
+COMPRESSIBLE_EXTENSIONS = frozenset([
+    '.css', '.html', '.js', '.json', '.svg', '.txt', '.xml'
+])
+
+file_hashes = {}
+file_hashes_lock = threading.Lock()
+
+
+def get_file_hash(path):
+    """Get the short hash of the contents of the file.  The hash is
+    computed once per modification of the file.
+
+    :param path: the path of the file
+    :type path: :class:`str`
+    :returns: the hex digest
+    :rtype: :class:`str`
+    :raises OSError: when the file doesn't exist
+
+    """
+    stat = os.stat(path)
+    key = stat.st_mtime, stat.st_size
+    with file_hashes_lock:
+        cached = file_hashes.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    file_hash = digest.hexdigest()[:12]
+    with file_hashes_lock:
+        file_hashes[path] = key, file_hash
+    return file_hash
+
+
+def find_compressed_file(path):
+    """Find the precompressed ``.gz`` file of the given file.  Compressed
+    files older than the original are ignored.
+
+    :param path: the path of the original file
+    :type path: :class:`str`
+    :returns: the path of the compressed file or :const:`None`
+    :rtype: :class:`str`
+
+    """
+    compressed_path = path + '.gz'
+    try:
+        if os.stat(compressed_path).st_mtime >= os.stat(path).st_mtime:
+            return compressed_path
+    except OSError:
+        pass
+
+
+def compress_file(path, compress_level=9):
+    """Write the ``gzip`` compressed file of the given file next to it,
+    with ``.gz`` suffix.
+
+    :param path: the path of the file to compress
+    :type path: :class:`str`
+    :param compress_level: the zlib compression level from 1 to 9
+    :type compress_level: :class:`numbers.Integral`
+    :returns: the path of the compressed file
+    :rtype: :class:`str`
+
+    """
+    compressed_path = path + '.gz'
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    with open(path, 'rb') as src:
+        with open(compressed_path, 'wb') as dst:
+            for chunk in iter(lambda: src.read(64 * 1024), b''):
+                dst.write(compressor.compress(chunk))
+            dst.write(compressor.flush())
+    return compressed_path
+
+
+def compress_static_files(directory, min_size=512, compress_level=9):
+    """Precompress textual files in the ``directory`` recursively.
+    Files which are already compressed and not changed since then are
+    skipped, and files smaller than ``min_size`` aren't compressed.
+
+    :param directory: the static directory
+    :type directory: :class:`str`
+    :param min_size: the minimum size of files to compress
+    :type min_size: :class:`numbers.Integral`
+    :param compress_level: the zlib compression level from 1 to 9
+    :type compress_level: :class:`numbers.Integral`
+    :returns: paths of newly compressed files
+    :rtype: :class:`collections.Sequence`
+
+    """
+    compressed = []
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            ext = os.path.splitext(filename)[1].lower()
+            if ext not in COMPRESSIBLE_EXTENSIONS or \
+               os.path.getsize(path) < min_size or \
+               find_compressed_file(path):
+                continue
+            compressed.append(compress_file(path, compress_level))
+    return compressed
@@ -0,0 +1,1100 @@
+""":mod:`earthreader.web.cache` --- Feed cache
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Parsing feed documents is the most expensive part of most views, so parsed
+:class:`~libearth.feed.Feed` objects are kept in memory and reused as long as
+revisions of the document stored in the repository don't change.
+
+The subscription list is cached in the same way by
+:class:`SubscriptionCache`.
+
+The feed cache also buffers read/starred marks of entries.  Marks are applied to
+cached feeds immediately, and written to the stage later in bulk by
+:meth:`FeedCache.flush()`, so that marking entries one by one doesn't rewrite
+the whole feed document every time.
+
+"""
+import bisect
+import errno
+import io
+import logging
+import os
+import os.path
+import shutil
+import threading
+import time
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+from libearth.compat import text_type
+from libearth.feed import Mark
+from libearth.repository import RepositoryKeyError
+from libearth.session import parse_revision
+from libearth.stage import Stage, compile_format_to_pattern
+from libearth.subscribe import SubscriptionList
+from libearth.tz import now
+
+from .exceptions import IteratorNotFound
+from .util import get_hash
+
+__all__ = ('CachedFeed', 'ContentCache', 'FeedCache', 'IteratorStore',
+           'SubscriptionCache', 'READ_FLAG', 'STARRED_FLAG', 'content_cache',
+           'count_entries', 'estimate_feed_size', 'feed_cache',
+           'get_entry_flags', 'get_entry_key', 'index_categories',
+           'subscription_cache')
+
+
+#: (:class:`numbers.Integral`) The flag bit of read entries.
+#: See also :func:`get_entry_flags()`.
+READ_FLAG = 1
+
+#: (:class:`numbers.Integral`) The flag bit of starred entries.
+#: See also :func:`get_entry_flags()`.
+STARRED_FLAG = 2
+
+
+def estimate_feed_size(feed):
+    """Roughly estimate how many bytes the given ``feed`` takes in memory.
+    Only texts of entries are counted, and the rest is approximated as
+    a constant overhead per entry.
+
+    :param feed: the feed to measure
+    :type feed: :class:`~libearth.feed.Feed`
+    :returns: the approximate number of bytes
+    :rtype: :class:`numbers.Integral`
+
+    """
+    size = 1024
+    for entry in feed.entries:
+        size += 512
+        for text in entry.title, entry.summary, entry.content:
+            if text is not None and text.value:
+                size += len(text.value)
+    return size
+
+
+def count_entries(feed):
+    """Count unread entries and starred entries of the given ``feed``.
+
+    :param feed: the feed to count
+    :type feed: :class:`~libearth.feed.Feed`
+    :returns: a pair of the number of unread entries and the number of
+              starred entries
+    :rtype: :class:`tuple`
+
+    """
+    unread = starred = 0
+    for entry in feed.entries:
+        if not entry.read:
+            unread += 1
+        if entry.starred:
+            starred += 1
+    return unread, starred
+
+
+def get_entry_key(entry):
+    """Get the sort key of the given ``entry``.  Entries are listed in
+    descending order of their keys, i.e. newest first, and ties are broken
+    by hashes of entry ids so that the order is total and stable across
+    processes.
+
+    :param entry: the entry to get its key
+    :type entry: :class:`~libearth.feed.Entry`
+    :returns: a pair of :attr:`~libearth.feed.Entry.updated_at` and
+              the hash of the entry id
+    :rtype: :class:`tuple`
+
+    """
+    return entry.updated_at, get_hash(entry.id)
+
+
+def get_entry_flags(entry):
+    """Get the read/starred flag bits of the given ``entry``.
+
+    :param entry: the entry to get its flags
+    :type entry: :class:`~libearth.feed.Entry`
+    :returns: the combination of :const:`READ_FLAG` and
+              :const:`STARRED_FLAG`
+    :rtype: :class:`numbers.Integral`
+
+    """
+    return ((READ_FLAG if entry.read else 0) |
+            (STARRED_FLAG if entry.starred else 0))
+
+
+class CachedFeed(object):
+    """The cached feed and indices derived from it.  Since indices are
+    bound to the parsed feed object, they are dropped together with it
+    whenever the feed is rewritten or reloaded, and built again lazily.
+
+    :param revisions: revisions that :meth:`FeedCache.get_revisions()`
+                      returned
+    :type revisions: :class:`tuple`
+    :param feed: the parsed feed
+    :type feed: :class:`~libearth.feed.Feed`
+
+    """
+
+    def __init__(self, revisions, feed):
+        self.revisions = revisions
+        self.feed = feed
+        self.size = estimate_feed_size(feed)
+        self.entry_index = None
+        self.timeline = None
+        #: (:class:`dict`) Pre-encoded JSON fragments of entries, which are
+        #: valid as long as the parsed feed is.
+        self.fragments = {}
+
+    def find_entry(self, entry_id):
+        """Find the entry of the given ``entry_id`` hash.  The index that
+        maps entry id hashes to positions of entries is built at the first
+        call.
+
+        :param entry_id: the hash of the entry id to find
+        :type entry_id: :class:`str`
+        :returns: the found entry, or :const:`None` if there's no such entry
+        :rtype: :class:`~libearth.feed.Entry`
+
+        """
+        index = self.entry_index
+        if index is None:
+            index = dict((get_hash(entry.id), position)
+                         for position, entry in enumerate(self.feed.entries))
+            self.entry_index = index
+        try:
+            return self.feed.entries[index[entry_id]]
+        except (KeyError, IndexError):
+            return None
+
+    def get_timeline(self):
+        """Get the timeline of entries, which is built at the first call.
+        It consists of three sequences aligned with each other: keys of
+        entries (see :func:`get_entry_key()`), entries, and
+        a :class:`bytearray` of their flags (see :func:`get_entry_flags()`),
+        all in ascending order of keys.
+
+        :returns: a triple of keys, entries and flags
+        :rtype: :class:`tuple`
+
+        """
+        timeline = self.timeline
+        if timeline is None:
+            entries = sorted(self.feed.entries, key=get_entry_key)
+            timeline = ([get_entry_key(entry) for entry in entries], entries,
+                        bytearray(get_entry_flags(entry) for entry in entries))
+            self.timeline = timeline
+        return timeline
+
+    def update_flags(self, entry):
+        """Update flags of the ``entry`` in the timeline after it's marked.
+
+        :param entry: the marked entry of the feed
+        :type entry: :class:`~libearth.feed.Entry`
+
+        """
+        if self.timeline is None:
+            return
+        keys, entries, flags = self.timeline
+        position = bisect.bisect_left(keys, get_entry_key(entry))
+        if position < len(entries) and entries[position] is entry:
+            flags[position] = get_entry_flags(entry)
+
+    def iter_entries(self, after=None, read=None, starred=None):
+        """Iterate entries newest first.  If ``after`` key is given,
+        it starts from the entry right next to the key, which is found by
+        bisection of the timeline, so a page can be resumed from the key
+        alone.  See also :func:`get_entry_key()`.
+
+        Entries can be filtered by ``read`` and ``starred`` flags.  Matched
+        entries are found by searching flags of the timeline, without
+        looking at entries that don't match.
+
+        :param after: the key of the last entry of the previous page
+        :type after: :class:`tuple`
+        :param read: iterate only read entries if :const:`True` or unread
+                     entries if :const:`False`.  all entries by default
+        :type read: :class:`bool`
+        :param starred: iterate only starred entries if :const:`True` or
+                        unstarred entries if :const:`False`.  all entries by
+                        default
+        :type starred: :class:`bool`
+        :returns: entries older than ``after``
+        :rtype: :class:`collections.Iterable`
+
+        """
+        keys, entries, flags = self.get_timeline()
+        if after is None:
+            position = len(keys)
+        else:
+            position = bisect.bisect_left(keys, after)
+        if read is None and starred is None:
+            for position in range(position - 1, -1, -1):
+                yield entries[position]
+            return
+        needles = {}
+        for value in range((READ_FLAG | STARRED_FLAG) + 1):
+            if (read is None or bool(value & READ_FLAG) == read) and \
+               (starred is None or bool(value & STARRED_FLAG) == starred):
+                needles[value] = bytearray([value])
+        # The last position where each matching value was found
+        found = dict((value, flags.rfind(needle, 0, position))
+                     for value, needle in needles.items())
+        while True:
+            position = max(found.values())
+            if position < 0:
+                break
+            if flags[position] in needles:
+                yield entries[position]
+            for value, needle in needles.items():
+                if found[value] >= position:
+                    found[value] = flags.rfind(needle, 0, position)
+
+
+class FeedCache(object):
+    """Read-through LRU cache of parsed feeds.  Cached feeds are keyed by
+    their feed id and revisions of the documents in the repository, so
+    a feed is parsed again only when its document has changed.
+
+    :param max_count: the maximum number of feeds to keep
+    :type max_count: :class:`numbers.Integral`
+    :param max_bytes: the maximum approximate bytes of feeds to keep.
+                      see also :func:`estimate_feed_size()`
+    :type max_bytes: :class:`numbers.Integral`
+    :param flush_threshold: the number of pending marks that makes
+                            the flusher thread flush them without waiting
+                            for the next interval
+    :type flush_threshold: :class:`numbers.Integral`
+
+    """
+
+    #: (:class:`collections.Sequence`) The repository key of the directory
+    #: where feed documents are stored.
+    FEEDS_KEY = Stage.feeds.key_spec[:1]
+
+    def __init__(self, max_count=1000, max_bytes=64 * 1024 * 1024,
+                 flush_threshold=100):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.flush_threshold = flush_threshold
+        self.lock = threading.RLock()
+        self.items = OrderedDict()
+        self.size = 0
+        self.pending = {}
+        self.counts = {}
+        self.flusher = None
+        self.flush_event = threading.Event()
+        self.feed_locks = {}
+        #: (:class:`collections.Sequence`) Functions called with
+        #: ``(stage, feed_id, feed)`` whenever a feed is written by
+        #: :meth:`store()`.  They are called inside the transaction of
+        #: the ``stage``.
+        self.listeners = []
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, feed_id):
+        return feed_id in self.items
+
+    def get_revisions(self, stage, feed_id):
+        """Read only revisions of the feed documents of ``feed_id`` (one per
+        session) without parsing the whole documents.  It has to be called
+        inside a transaction of the ``stage``.
+
+        :param stage: the stage to read
+        :type stage: :class:`~libearth.stage.Stage`
+        :param feed_id: the feed id to read
+        :type feed_id: :class:`str`
+        :returns: pairs of the document name and its revision
+        :rtype: :class:`tuple`
+        :raises KeyError: when there's no such feed
+
+        """
+        repository = stage.get_current_transaction()
+        key = list(self.FEEDS_KEY) + [feed_id]
+        try:
+            names = repository.list(key)
+        except RepositoryKeyError:
+            raise KeyError(feed_id)
+        revisions = []
+        for name in sorted(names):
+            if name.endswith('.xml'):
+                pair = parse_revision(repository.read(key + [name]))
+                revisions.append((name, pair and pair[0]))
+        if not revisions:
+            raise KeyError(feed_id)
+        return tuple(revisions)
+
+    def load(self, stage, feed_id):
+        """Load the :class:`CachedFeed` of ``feed_id``.  The feed is read
+        from the ``stage`` only when it isn't cached yet or the cached one
+        is outdated.  It has to be called inside a transaction of
+        the ``stage``.
+
+        :param stage: the stage to read
+        :type stage: :class:`~libearth.stage.Stage`
+        :param feed_id: the feed id to read
+        :type feed_id: :class:`str`
+        :returns: the cached feed
+        :rtype: :class:`CachedFeed`
+        :raises KeyError: when there's no such feed
+
+        """
+        revisions = self.get_revisions(stage, feed_id)
+        with self.lock:
+            try:
+                cached = self.items.pop(feed_id)
+            except KeyError:
+                pass
+            else:
+                if cached.revisions == revisions:
+                    self.items[feed_id] = cached
+                    return cached
+                self.size -= cached.size
+        cached = CachedFeed(revisions, stage.feeds[feed_id])
+        with self.lock:
+            for entry_id, marks in self.pending.get(feed_id, {}).items():
+                entry = cached.find_entry(entry_id)
+                if entry is not None:
+                    for attr, mark in marks.items():
+                        setattr(entry, attr, mark)
+            self.put(feed_id, cached)
+            self.counts[feed_id] = (revisions,) + count_entries(cached.feed)
+        return cached
+
+    def get(self, stage, feed_id):
+        """Get the feed of ``feed_id``.  It has to be called inside
+        a transaction of the ``stage``.  See also :meth:`load()`.
+
+        :param stage: the stage to read
+        :type stage: :class:`~libearth.stage.Stage`
+        :param feed_id: the feed id to read
+        :type feed_id: :class:`str`
+        :returns: the feed
+        :rtype: :class:`~libearth.feed.Feed`
+        :raises KeyError: when there's no such feed
+
+        """
+        return self.load(stage, feed_id).feed
+
+    def get_entry(self, stage, feed_id, entry_id):
+        """Get the feed of ``feed_id`` and its entry of ``entry_id``
+        using the entry index of the cached feed.  It has to be called
+        inside a transaction of the ``stage``.
+
+        :param stage: the stage to read
+        :type stage: :class:`~libearth.stage.Stage`
+        :param feed_id: the feed id to read
+        :type feed_id: :class:`str`
+        :param entry_id: the hash of the entry id to find
+        :type entry_id: :class:`str`
+        :returns: a pair of the feed and the found entry.  the entry is
+                  :const:`None` if there's no such entry
+        :rtype: :class:`tuple`
+        :raises KeyError: when there's no such feed
+
+        """
+        cached = self.load(stage, feed_id)
+        return cached.feed, cached.find_entry(entry_id)
+
+    def get_counts(self, stage, feed_id):
+        """Get the number of unread entries and starred entries of the feed
+        of ``feed_id``.  Counts are maintained apart from cached feeds, so
+        the feed is parsed again only when its document has changed since
+        counts were updated.  It has to be called inside a transaction of
+        the ``stage``.
+
+        :param stage: the stage to read
+        :type stage: :class:`~libearth.stage.Stage`
+        :param feed_id: the feed id to count
+        :type feed_id: :class:`str`
+        :returns: a pair of the number of unread entries and the number of
+                  starred entries
+        :rtype: :class:`tuple`
+        :raises KeyError: when there's no such feed
+
+        """
+        revisions = self.get_revisions(stage, feed_id)
+        with self.lock:
+            counts = self.counts.get(feed_id)
+            if counts is not None and counts[0] == revisions:
+                return counts[1:]
+        cached = self.load(stage, feed_id)
+        with self.lock:
+            counts = self.counts.get(feed_id)
+            if counts is not None and counts[0] == cached.revisions:
+                return counts[1:]
+            return count_entries(cached.feed)
+
+    def put(self, feed_id, cached):
+        """Cache the ``cached`` feed, and evict least recently used feeds
+        if limits are exceeded.
+
+        :param feed_id: the feed id
+        :type feed_id: :class:`str`
+        :param cached: the feed to cache
+        :type cached: :class:`CachedFeed`
+
+        """
+        with self.lock:
+            self.invalidate(feed_id)
+            if cached.size > self.max_bytes:
+                return
+            self.items[feed_id] = cached
+            self.size += cached.size
+            while (len(self.items) > self.max_count or
+                   self.size > self.max_bytes):
+                _, evicted = self.items.popitem(last=False)
+                self.size -= evicted.size
+
+    def get_feed_lock(self, feed_id):
+        """Get the lock which serializes writes of the feed of ``feed_id``,
+        so that :meth:`store()` doesn't have to hold the cache-wide lock while
+        the feed is being written.
+
+        :param feed_id: the feed id
+        :type feed_id: :class:`str`
+        :returns: the lock of the feed
+        :rtype: :class:`threading.Lock`
+
+        """
+        with self.lock:
+            try:
+                return self.feed_locks[feed_id]
+            except KeyError:
+                lock = self.feed_locks[feed_id] = threading.Lock()
+                return lock
+
+    def store(self, stage, feed_id, feed):
+        """Write the ``feed`` to the ``stage`` and invalidate the cached one.
+        Pending marks of the feed are applied to the ``feed`` and written
+        together.  Counts of the feed are updated if the ``feed`` is
+        the cached one, and otherwise dropped to be counted again.
+        It has to be called inside a transaction of the ``stage``.
+
+        :param stage: the stage to write
+        :type stage: :class:`~libearth.stage.Stage`
+        :param feed_id: the feed id to write
+        :type feed_id: :class:`str`
+        :param feed: the feed to write
+        :type feed: :class:`~libearth.feed.Feed`
+
+        """
+        with self.get_feed_lock(feed_id):
+            try:
+                revisions = self.get_revisions(stage, feed_id)
+            except KeyError:
+                revisions = None
+            with self.lock:
+                cached = self.items.get(feed_id)
+                complete = (cached is not None and cached.feed is feed and
+                            cached.revisions == revisions)
+                applied = {}
+                pending = self.pending.get(feed_id)
+                if pending:
+                    for entry in feed.entries:
+                        entry_id = get_hash(entry.id)
+                        marks = pending.get(entry_id)
+                        if marks:
+                            for attr, mark in marks.items():
+                                setattr(entry, attr, mark)
+                            applied[entry_id] = dict(marks)
+            # The feed is written outside of the lock so that other feeds
+            # can be read and marked meanwhile.
+            try:
+                stage.feeds[feed_id] = feed
+                if complete:
+                    revisions = self.get_revisions(stage, feed_id)
+            except Exception:
+                with self.lock:
+                    self.invalidate(feed_id)
+                    self.counts.pop(feed_id, None)
+                raise
+            with self.lock:
+                self.invalidate(feed_id)
+                if complete:
+                    # The feed was read from the latest document, so the
+                    # written document is the same to it.
+                    self.counts[feed_id] = (revisions,) + count_entries(feed)
+                else:
+                    self.counts.pop(feed_id, None)
+                pending = self.pending.get(feed_id, {})
+                for entry_id, marks in applied.items():
+                    # Marks made while the feed was being written are left
+                    # to be written next time.
+                    entry_marks = pending.get(entry_id, {})
+                    for attr, mark in marks.items():
+                        if entry_marks.get(attr) is mark:
+                            del entry_marks[attr]
+                    if not entry_marks:
+                        pending.pop(entry_id, None)
+                if not pending:
+                    self.pending.pop(feed_id, None)
+        for listener in self.listeners:
+            listener(stage, feed_id, feed)
+
+    def add_listener(self, listener):
+        """Register the function to be called whenever a feed is written.
+        See also :attr:`listeners`.
+
+        :param listener: the function to register
+        :type listener: :class:`collections.Callable`
+
+        """
+        self.listeners.append(listener)
+
+    def mark(self, stage, feed_id, entry_id, **marks):
+        """Mark the entry e.g. ``read=True``, ``starred=False``.  It's
+        a shortcut of :meth:`mark_entries()` for a single entry.
+        It has to be called outside of transactions of the ``stage``.
+
+        :param stage: the stage to read and write
+        :type stage: :class:`~libearth.stage.Stage`
+        :param feed_id: the feed id of the entry
+        :type feed_id: :class:`str`
+        :param entry_id: the hash of the entry id to mark
+        :type entry_id: :class:`str`
+        :returns: the marked entry, or :const:`None` if there's no such entry
+        :rtype: :class:`~libearth.feed.Entry`
+        :raises KeyError: when there's no such feed
+
+        """
+        return self.mark_entries(stage, feed_id, {entry_id: marks})[entry_id]
+
+    def mark_entries(self, stage, feed_id, entry_marks):
+        """Mark entries of the same feed at once.  Marks are applied to
+        the cached feed at once, but written to the ``stage`` by the flusher
+        thread later if it's running (see :meth:`start_flusher()`).
+        Otherwise the feed is written immediately, only once however many
+        entries are marked.  It has to be called outside of transactions of
+        the ``stage``.
+
+        :param stage: the stage to read and write
+        :type stage: :class:`~libearth.stage.Stage`
+        :param feed_id: the feed id of entries
+        :type feed_id: :class:`str`
+        :param entry_marks: the mapping of hashes of entry ids to mappings of
+                            marks e.g. ``{'read': True, 'starred': False}``
+        :type entry_marks: :class:`collections.Mapping`
+        :returns: the mapping of hashes of entry ids to marked entries.
+                  an entry is :const:`None` if there's no such entry
+        :rtype: :class:`collections.Mapping`
+        :raises KeyError: when there's no such feed
+
+        """
+        updated_at = now()
+        entries = {}
+        with stage:
+            cached = self.load(stage, feed_id)
+            with self.lock:
+                pending = self.pending.setdefault(feed_id, {})
+                counts = self.counts.get(feed_id)
+                if counts is not None and counts[0] == cached.revisions:
+                    counts = list(counts)
+                else:
+                    counts = None
+                for entry_id, marks in entry_marks.items():
+                    entry = cached.find_entry(entry_id)
+                    entries[entry_id] = entry
+                    if entry is None or not marks:
+                        continue
+                    for attr, value in marks.items():
+                        mark = Mark(marked=bool(value), updated_at=updated_at)
+                        if counts is not None and \
+                           bool(getattr(entry, attr)) != mark.marked:
+                            if attr == 'read':
+                                counts[1] += -1 if mark.marked else 1
+                            elif attr == 'starred':
+                                counts[2] += 1 if mark.marked else -1
+                        setattr(entry, attr, mark)
+                        pending.setdefault(entry_id, {})[attr] = mark
+                    cached.update_flags(entry)
+                if counts is None:
+                    self.counts.pop(feed_id, None)
+                else:
+                    self.counts[feed_id] = tuple(counts)
+                if not pending:
+                    del self.pending[feed_id]
+                    return entries
+                count = sum(len(m) for m in self.pending.values())
+            if not self.is_flusher_running():
+                self.store(stage, feed_id, cached.feed)
+                return entries
+        if count >= self.flush_threshold:
+            self.flush_event.set()
+        return entries
+
+    def get_last_marked_at(self, feed_id):
+        """Get the time when the feed of ``feed_id`` was marked the last
+        among its pending marks that aren't written yet.
+
+        :param feed_id: the feed id
+        :type feed_id: :class:`str`
+        :returns: the last marked time, or :const:`None` if there are no
+                  pending marks
+        :rtype: :class:`datetime.datetime`
+
+        """
+        with self.lock:
+            times = [mark.updated_at
+                     for marks in self.pending.get(feed_id, {}).values()
+                     for mark in marks.values()]
+        return max(times) if times else None
+
+    def flush(self, stage, feed_ids=None):
+        """Write pending marks to the ``stage``.  Each feed is read and
+        written only once however many entries of it are marked.  It has to
+        be called outside of transactions of the ``stage``.
+
+        :param stage: the stage to write
+        :type stage: :class:`~libearth.stage.Stage`
+        :param feed_ids: feed ids to flush.  all feeds that have pending
+                         marks by default
+        :type feed_ids: :class:`collections.Iterable`
+
+        """
+        with self.lock:
+            if feed_ids is None:
+                feed_ids = list(self.pending)
+            else:
+                feed_ids = [f for f in feed_ids if f in self.pending]
+        for feed_id in feed_ids:
+            with stage:
+                try:
+                    feed = self.get(stage, feed_id)
+                except KeyError:
+                    with self.lock:
+                        self.pending.pop(feed_id, None)
+                    continue
+                self.store(stage, feed_id, feed)
+
+    def start_flusher(self, interval, flush):
+        """Start the daemon thread that calls ``flush`` every ``interval``
+        seconds, or as soon as the number of pending marks reaches
+        :attr:`flush_threshold`.
+
+        :param interval: the interval in seconds
+        :type interval: :class:`numbers.Real`
+        :param flush: the function that flushes pending marks e.g.
+                      ``lambda: cache.flush(stage)``
+        :type flush: :class:`collections.Callable`
+
+        """
+        if self.is_flusher_running():
+            return
+        thread = threading.Thread(target=self.run_flusher,
+                                  args=(interval, flush))
+        thread.setDaemon(True)
+        self.flusher = thread
+        thread.start()
+
+    def run_flusher(self, interval, flush):
+        thread = threading.current_thread()
+        while True:
+            self.flush_event.wait(interval)
+            self.flush_event.clear()
+            try:
+                flush()
+            except Exception as e:
+                logger = logging.getLogger(__name__ + '.FeedCache.flusher')
+                logger.exception('failed to flush marks: %s', e)
+            if self.flusher is not thread:
+                break
+
+    def stop_flusher(self):
+        """Stop the flusher thread after it flushes pending marks for
+        the last time.
+
+        """
+        thread = self.flusher
+        if thread is not None:
+            self.flusher = None
+            self.flush_event.set()
+            thread.join()
+
+    def is_flusher_running(self):
+        thread = self.flusher
+        return thread is not None and thread.is_alive()
+
+    def invalidate(self, feed_id):
+        """Remove the cached feed of ``feed_id`` if exists.
+
+        :param feed_id: the feed id to remove
+        :type feed_id: :class:`str`
+
+        """
+        with self.lock:
+            try:
+                cached = self.items.pop(feed_id)
+            except KeyError:
+                pass
+            else:
+                self.size -= cached.size
+
+    def clear(self):
+        """Remove all cached feeds."""
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+
+class IteratorStore(object):
+    """LRU store of iterators of paged views, keyed by url tokens.
+    An iterator is checked out by :meth:`pop()` and put back by
+    :meth:`put()` after a page is taken from it, so no two requests advance
+    the same iterator at once.  A request that finds no iterator has to
+    resume the page from its cursor instead.
+
+    :param max_count: the maximum number of iterators to keep
+    :type max_count: :class:`numbers.Integral`
+    :param ttl: seconds to keep unused iterators
+    :type ttl: :class:`numbers.Real`
+
+    """
+
+    def __init__(self, max_count=10, ttl=1800):
+        self.max_count = max_count
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        self.items = OrderedDict()
+        self.size = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, token):
+        return token in self.items
+
+    def put(self, token, iterator, cursor, size=0):
+        """Store the ``iterator`` positioned at the ``cursor``, and evict
+        expired or least recently used iterators.
+
+        :param token: the url token
+        :type token: :class:`str`
+        :param iterator: the iterator to store
+        :param cursor: the cursor of the next page that the ``iterator``
+                       continues from
+        :type cursor: :class:`str`
+        :param size: the approximate number of bytes the ``iterator`` holds.
+                     see also :func:`estimate_feed_size()`
+        :type size: :class:`numbers.Integral`
+
+        """
+        with self.lock:
+            self.discard(token)
+            self.items[token] = iterator, cursor, size, time.time()
+            self.size += size
+            self.expire()
+            while len(self.items) > self.max_count:
+                _, (_, _, evicted, _) = self.items.popitem(last=False)
+                self.size -= evicted
+
+    def pop(self, token, cursor):
+        """Check out the iterator of the ``token``.  It's removed from
+        the store until it's put back.
+
+        :param token: the url token
+        :type token: :class:`str`
+        :param cursor: the cursor of the requested page
+        :type cursor: :class:`str`
+        :returns: the iterator positioned at the ``cursor``
+        :raises IteratorNotFound: when there's no such iterator, or it's
+                                  positioned at the other page
+
+        """
+        with self.lock:
+            self.expire()
+            if token not in self.items:
+                raise IteratorNotFound('The iterator does not exist')
+            iterator, stored_cursor, _, _ = self.items[token]
+            self.discard(token)
+        if stored_cursor != cursor:
+            raise IteratorNotFound('The iterator is at the other page')
+        return iterator
+
+    def discard(self, token):
+        """Remove the iterator of the ``token`` if it exists.
+
+        :param token: the url token
+        :type token: :class:`str`
+
+        """
+        with self.lock:
+            item = self.items.pop(token, None)
+            if item is not None:
+                self.size -= item[2]
+
+    def expire(self):
+        """Evict iterators unused longer than :attr:`ttl`.  Since iterators
+        are ordered by the time they were put, only the oldest ones are
+        looked at.
+
+        """
+        deadline = time.time() - self.ttl
+        with self.lock:
+            while self.items:
+                token = next(iter(self.items))
+                if self.items[token][3] >= deadline:
+                    break
+                self.discard(token)
+
+    def get_sizes(self):
+        """Get the approximate number of bytes each stored iterator holds,
+        e.g. for monitoring.  The total is :attr:`size`.
+
+        :returns: the mapping of url tokens to bytes
+        :rtype: :class:`collections.Mapping`
+
+        """
+        with self.lock:
+            return dict((token, item[2]) for token, item in self.items.items())
+
+    def clear(self):
+        """Remove all iterators."""
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+
+class ContentCache(object):
+    """LRU cache of sanitized HTML of entry contents, since sanitizing
+    long contents with heavy markup is expensive.  Contents are keyed by
+    digests of their raw values, so marking entries, which changes
+    revisions of the feed, doesn't make them sanitized again.
+
+    If :attr:`persist` is a directory path, sanitized contents are also
+    written to the directory, so that they survive restarts.  It's meant to
+    be a local directory outside the repository, since it's only a cache
+    which doesn't have to be synchronized.  Only the latest content of each
+    entry is kept there, and contents of a feed can be removed by
+    :meth:`discard()`.
+
+    :param max_bytes: the maximum bytes of sanitized contents to keep
+                      in memory
+    :type max_bytes: :class:`numbers.Integral`
+    :param persist: the directory path to persist sanitized contents to.
+                    they aren't persisted by default
+    :type persist: :class:`str`
+
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, persist=None):
+        self.max_bytes = max_bytes
+        self.persist = persist
+        self.lock = threading.RLock()
+        self.items = OrderedDict()
+        self.size = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, feed_id, entry_id, content):
+        """Get the sanitized HTML of the ``content``.
+
+        :param feed_id: the feed id of the entry
+        :type feed_id: :class:`str`
+        :param entry_id: the hash of the entry id
+        :type entry_id: :class:`str`
+        :param content: the content or summary of the entry
+        :type content: :class:`~libearth.feed.Text`
+        :returns: the sanitized html
+        :rtype: :class:`str`
+
+        """
+        digest = get_hash(content.type + '\n' + (content.value or ''))
+        cache_key = feed_id, entry_id, digest
+        with self.lock:
+            html = self.items.pop(cache_key, None)
+            if html is not None:
+                self.items[cache_key] = html
+                return html
+        html = None
+        if self.persist:
+            path = os.path.join(self.persist, feed_id, entry_id,
+                                digest + '.html')
+            try:
+                with io.open(path, encoding='utf-8') as f:
+                    html = f.read()
+            except (IOError, OSError):
+                pass
+        if html is None:
+            html = text_type(content.sanitized_html)
+            if self.persist:
+                self.write(path, html)
+        self.put(cache_key, html)
+        return html
+
+    def write(self, path, html):
+        directory = os.path.dirname(path)
+        try:
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            # Contents the entry had before are stale
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+            with io.open(path, 'w', encoding='utf-8') as f:
+                f.write(html)
+        except (IOError, OSError) as e:
+            logger = logging.getLogger(__name__ + '.ContentCache.write')
+            logger.warning('failed to persist %s: %s', path, e)
+
+    def put(self, cache_key, html):
+        with self.lock:
+            if cache_key in self.items or len(html) > self.max_bytes:
+                return
+            self.items[cache_key] = html
+            self.size += len(html)
+            while self.size > self.max_bytes:
+                _, evicted = self.items.popitem(last=False)
+                self.size -= len(evicted)
+
+    def discard(self, feed_id):
+        """Remove sanitized contents of the feed of ``feed_id`` from
+        memory and the :attr:`persist` directory.
+
+        :param feed_id: the feed id to remove
+        :type feed_id: :class:`str`
+
+        """
+        with self.lock:
+            for cache_key in list(self.items):
+                if cache_key[0] == feed_id:
+                    self.size -= len(self.items.pop(cache_key))
+        if self.persist:
+            shutil.rmtree(os.path.join(self.persist, feed_id),
+                          ignore_errors=True)
+
+    def clear(self):
+        """Remove all sanitized contents from memory."""
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+
+def index_categories(subscription_set, path=(), index=None):
+    """Map paths of all categories in the given ``subscription_set`` tree
+    to :class:`~libearth.subscribe.Category` objects.  A path is a tuple of
+    category labels from the root e.g. ``('categoryone', 'categorytwo')``.
+
+    :param subscription_set: the subscription list or category to index
+    :type subscription_set: :class:`~libearth.subscribe.SubscriptionSet`
+    :returns: the mapping of paths to categories
+    :rtype: :class:`collections.Mapping`
+
+    """
+    if index is None:
+        index = {}
+    for label, category in subscription_set.categories.items():
+        category_path = path + (label,)
+        index[category_path] = category
+        index_categories(category, category_path, index)
+    return index
+
+
+class SubscriptionCache(object):
+    """Read-through cache of the parsed subscription list.  Like
+    :class:`FeedCache`, it's keyed by revisions of the documents in
+    the repository, so it's parsed again only when the subscription list
+    has changed.  Categories in the cached subscription list are indexed
+    by their paths (see :func:`index_categories()`).
+
+    """
+
+    #: (:class:`re.RegexObject`) The pattern of names of subscription list
+    #: documents in the repository.
+    KEY_PATTERN = compile_format_to_pattern(Stage.subscriptions.key_spec[-1])
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.cached = None
+
+    def get_revisions(self, stage):
+        """Read only revisions of the subscription list documents (one per
+        session) without parsing the whole documents.  It has to be called
+        inside a transaction of the ``stage``.
+
+        :param stage: the stage to read
+        :type stage: :class:`~libearth.stage.Stage`
+        :returns: pairs of the document name and its revision
+        :rtype: :class:`tuple`
+
+        """
+        repository = stage.get_current_transaction()
+        key = list(Stage.subscriptions.key_spec[:-1])
+        revisions = []
+        for name in sorted(repository.list(key)):
+            if self.KEY_PATTERN.match(name):
+                pair = parse_revision(repository.read(key + [name]))
+                revisions.append((name, pair and pair[0]))
+        return tuple(revisions)
+
+    def load(self, stage, fresh=False):
+        """Load the subscription list and the index of its categories.
+        An empty subscription list is made if there's no subscription list
+        yet.  It has to be called inside a transaction of the ``stage``.
+
+        The cached subscription list is shared by concurrent requests, so
+        it must not be changed.  Callers which change the subscription list
+        have to load a ``fresh`` one instead, and :meth:`store()` it.
+
+        :param stage: the stage to read
+        :type stage: :class:`~libearth.stage.Stage`
+        :param fresh: read the subscription list from the ``stage`` rather
+                      than the cache, so that it can be changed
+        :type fresh: :class:`bool`
+        :returns: a pair of the subscription list and the mapping of
+                  category paths to categories
+        :rtype: :class:`tuple`
+
+        """
+        if fresh:
+            subscriptions = stage.subscriptions or SubscriptionList()
+            return subscriptions, index_categories(subscriptions)
+        revisions = self.get_revisions(stage)
+        if not revisions:
+            return SubscriptionList(), {}
+        with self.lock:
+            cached = self.cached
+            if cached is not None and cached[0] == revisions:
+                return cached[1:]
+        subscriptions = stage.subscriptions or SubscriptionList()
+        categories = index_categories(subscriptions)
+        with self.lock:
+            self.cached = revisions, subscriptions, categories
+        return subscriptions, categories
+
+    def store(self, stage, subscriptions):
+        """Write the ``subscriptions`` to the ``stage`` and invalidate
+        the cached one.  It has to be called inside a transaction of
+        the ``stage``.
+
+        :param stage: the stage to write
+        :type stage: :class:`~libearth.stage.Stage`
+        :param subscriptions: the subscription list to write
+        :type subscriptions: :class:`~libearth.subscribe.SubscriptionList`
+
+        """
+        try:
+            stage.subscriptions = subscriptions
+        finally:
+            self.invalidate()
+
+    def invalidate(self):
+        """Remove the cached subscription list."""
+        with self.lock:
+            self.cached = None
+
+
+#: (:class:`FeedCache`) The process-wide feed cache.
+feed_cache = FeedCache()
+
+#: (:class:`SubscriptionCache`) The process-wide subscription list cache.
+subscription_cache = SubscriptionCache()
+
+#: (:class:`ContentCache`) The process-wide sanitized content cache.
+content_cache = ContentCache()
@@ -9,15 +9,21 @@ import sys
 import traceback
 
 from libearth.compat.parallel import cpu_count
-from libearth.crawler import crawl, CrawlError
+from libearth.crawler import CrawlError
 from libearth.repository import from_url
 from libearth.schema import SchemaError
 from libearth.session import Session
 from libearth.stage import Stage
+from sassutils.builder import Manifest
 from sassutils.wsgi import SassMiddleware
 from waitress import serve
 
 from . import app
+from .assets import compress_static_files
+from .connection import connection_pool
+from .crawler import (ENGINES, crawl, get_engine, load_validators,
+                      merge_feed, save_validators)
+from .timeline import timeline
 from .util import autofix_repo_url
 
 __all__ = 'crawl', 'main'
@@ -46,18 +52,50 @@ def crawl_command(args):
         if not feed_map:
             print('No feeds to crawl', file=sys.stderr)
             return
-    threads_count = args.threads if args.threads is not None else cpu_count()
-    iterator = iter(crawl(feed_map.keys(), threads_count))
+    engine = args.engine or app.config['CRAWL_ENGINE']
+    if args.threads is not None:
+        threads_count = args.threads
+    elif engine == 'asyncio':
+        threads_count = app.config['CRAWL_CONCURRENCY']
+    else:
+        threads_count = cpu_count()
+    with stage:
+        feeds = dict((feed_url, load_validators(stage, feed_id))
+                     for feed_url, feed_id in feed_map.items())
+    try:
+        crawl_feeds = get_engine(engine)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return
+    connection_pool.max_connections = app.config['CRAWL_HOST_CONNECTIONS']
+    connection_pool.interval = app.config['CRAWL_HOST_INTERVAL']
+    iterator = crawl_feeds(feeds, threads_count)
     while 1:
         try:
-            feed_url, feed_data, crawler_hints = next(iterator)
-            if args.verbose:
-                print('{0.title} - {1} entries'.format(
-                    feed_data, len(feed_data.entries)
-                ))
+            feed_url, result, validators, _ = next(iterator)
+            if result is None:
+                if args.verbose:
+                    print(feed_url, '- not modified')
+                continue
+            feed_url, feed_data, crawler_hints = result
             with stage:
                 feed_id = feed_map[feed_url]
-                stage.feeds[feed_id] = feed_data
+                try:
+                    stored = stage.feeds[feed_id]
+                except KeyError:
+                    stored = None
+                merged = merge_feed(stored, feed_data)
+                if merged is not None:
+                    stage.feeds[feed_id] = merged
+                if validators != feeds[feed_url]:
+                    save_validators(stage, feed_id, validators)
+            if args.verbose:
+                if merged is None:
+                    print(feed_url, '- no changes')
+                else:
+                    print('{0.title} - {1} entries'.format(
+                        feed_data, len(feed_data.entries)
+                    ))
         except (CrawlError, SchemaError) as e:
             if isinstance(e, CrawlError):
                 print('Something went wrong with', e.feed_uri, file=sys.stderr)
@@ -67,6 +105,42 @@ def crawl_command(args):
                 print(e, file=sys.stderr)
         except StopIteration:
             break
+    if args.verbose:
+        stats = connection_pool.get_stats()
+        print('{0[requests]} requests, {0[connections]} connections opened, '
+              '{0[reused]} reused, {0[throttled]} throttled'.format(stats))
+
+
+def timeline_command(args):
+    persist = args.persist or app.config['TIMELINE_PERSIST']
+    if not persist:
+        print('The timeline index is not persisted; specify the directory '
+              'to persist it to by -d/--dir option', file=sys.stderr)
+        return
+    timeline.persist = persist
+    repo = from_url(args.repository)
+    session = Session(args.session_id)
+    stage = Stage(session, repo)
+    with stage:
+        opml = stage.subscriptions
+        if not opml:
+            print('OPML does not exist in the repository', file=sys.stderr)
+            return
+        feed_ids = set(sub.feed_id for sub in opml.recursive_subscriptions)
+        count = timeline.rebuild(stage, feed_ids)
+    if args.verbose:
+        print('{0} feeds - {1} entries'.format(count, len(timeline.rows)))
+
+
+def compress_static_command(args):
+    manifest = Manifest('static/scss/', 'static/css/')
+    manifest.build(app.root_path)
+    compressed = compress_static_files(app.static_folder,
+                                       min_size=args.min_size)
+    if args.verbose:
+        for path in compressed:
+            print(path)
+    print('{0} files compressed'.format(len(compressed)))
 
 
 def server_command(args):
@@ -75,6 +149,7 @@ def server_command(args):
     app.debug = args.debug
     if args.no_worker:
         app.config.update(USE_WORKER=False)
+    app.config.update(CRAWL_SCHEDULER=not args.no_scheduler)
     if args.profile:
         try:
             from linesman.middleware import make_linesman_middleware
@@ -129,13 +204,21 @@ server_parser.add_argument('-w', '--no-worker',
                            default=False,
                            action='store_true',
                            help='Disable worker thread that crawl feeds')
+server_parser.add_argument('-S', '--no-scheduler',
+                           default=False,
+                           action='store_true',
+                           help='Disable crawling subscriptions periodically')
 server_parser.add_argument('repository', help='repository for Earth Reader')
 
 crawl_parser = subparsers.add_parser('crawl', help='crawl feeds in the opml')
 crawl_parser.set_defaults(function=crawl_command)
 crawl_parser.add_argument('-n', '--threads',
                           type=int,
-                          help='the number of workers')
+                          help='the number of workers, or concurrent fetches '
+                               'for the asyncio engine')
+crawl_parser.add_argument('-e', '--engine', choices=ENGINES,
+                          help='the crawl engine.  [default: CRAWL_ENGINE '
+                               'config, which is {0}]'.format(ENGINES[0]))
 crawl_parser.add_argument('-i', '--session-id',
                           default=Session().identifier,
                           help='session identifier.  [default: %(default)s]')
@@ -146,6 +229,37 @@ crawl_parser.add_argument('-f', '--feed-id',
                                'crawl all subscriptions by default')
 crawl_parser.add_argument('repository', help='repository which has the opml')
 
+timeline_parser = subparsers.add_parser(
+    'timeline',
+    help='rebuild the timeline index of entries for category views'
+)
+timeline_parser.set_defaults(function=timeline_command)
+timeline_parser.add_argument('-i', '--session-id',
+                             default=Session().identifier,
+                             help='session identifier.  '
+                                  '[default: %(default)s]')
+timeline_parser.add_argument('-d', '--dir', dest='persist',
+                             help='the local directory to persist the index '
+                                  'to.  [default: TIMELINE_PERSIST config]')
+timeline_parser.add_argument('-v', '--verbose', default=False,
+                             action='store_true', help='verbose mode')
+timeline_parser.add_argument('repository',
+                             help='repository which has the opml')
+
+compress_static_parser = subparsers.add_parser(
+    'compress-static',
+    help='build stylesheets and precompress static files'
+)
+compress_static_parser.set_defaults(function=compress_static_command)
+compress_static_parser.add_argument('-s', '--min-size',
+                                    type=int,
+                                    default=512,
+                                    help='the minimum size of files to '
+                                         'compress.  [default: %(default)s]')
+compress_static_parser.add_argument('-v', '--verbose', default=False,
+                                    action='store_true',
+                                    help='verbose mode')
+
 
 def main():
     args = parser.parse_args()
@@ -153,7 +267,8 @@ def main():
         parser.print_help()
         exit(1)
 
-    args.repository = autofix_repo_url(args.repository)
+    if hasattr(args, 'repository'):
+        args.repository = autofix_repo_url(args.repository)
 
     args.function(args)
 
@@ -0,0 +1,262 @@
+""":mod:`earthreader.web.connection` --- Per-host connection pool
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Many subscriptions tend to live on the same few hosts e.g. blog platforms.
+Crawlers request them through :class:`ConnectionPool`, which keeps
+connections alive per host and reuses them for following requests, so that
+each feed doesn't pay for a new connection (and a TLS handshake).
+
+The pool is also polite to hosts: it limits how many requests can be sent
+to a host at a time, and how often.
+
+"""
+import io
+import socket
+import threading
+import time
+
+from libearth.crawler import DEFAULT_TIMEOUT
+from libearth.version import VERSION
+from six.moves import http_client
+from six.moves.urllib.request import BaseHandler, Request, build_opener
+from six.moves.urllib.response import addinfourl
+from six.moves.urllib.error import URLError
+
+__all__ = 'ConnectionPool', 'KeepAliveHandler', 'connection_pool'
+
+
+class KeepAliveHandler(BaseHandler):
+    """The :mod:`urllib2` handler which sends requests through
+    the connection ``pool``.
+
+    :param pool: the connection pool to use
+    :type pool: :class:`ConnectionPool`
+
+    """
+
+    # Go ahead of the default HTTPHandler and HTTPSHandler
+    handler_order = 400
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def http_open(self, request):
+        return self.pool.send(request, 'http')
+
+    if hasattr(http_client, 'HTTPSConnection'):
+        def https_open(self, request):
+            if getattr(request, '_tunnel_host', None):
+                # Tunneling through proxies isn't pooled
+                return
+            return self.pool.send(request, 'https')
+
+
+class Host(object):
+    """The state of a host in :class:`ConnectionPool`."""
+
+    def __init__(self, max_connections):
+        self.semaphore = threading.BoundedSemaphore(max_connections)
+        #: (:class:`collections.Sequence`) Pairs of idle connections and
+        #: when they've been released.
+        self.idle = []
+        self.next_request_at = 0
+        self.stats = {'requests': 0, 'connections': 0, 'reused': 0,
+                      'throttled': 0}
+
+
+class ConnectionPool(object):
+    """The pool of keep-alive HTTP connections per host.  It also limits
+    concurrent requests and the request rate per host.  Limits can be
+    changed until the pool sends the first request.
+
+    :param max_connections: the maximum number of concurrent requests
+                            (and idle connections) per host
+    :type max_connections: :class:`numbers.Integral`
+    :param interval: the minimum seconds between requests to a host
+    :type interval: :class:`numbers.Real`
+    :param idle_timeout: seconds to keep idle connections
+    :type idle_timeout: :class:`numbers.Real`
+
+    """
+
+    def __init__(self, max_connections=4, interval=0, idle_timeout=30):
+        self.max_connections = max_connections
+        self.interval = interval
+        self.idle_timeout = idle_timeout
+        #: (:class:`dict`) Pairs of the scheme and the host to
+        #: :class:`Host` objects.
+        self.hosts = {}
+        self.lock = threading.Lock()
+        self.opener = build_opener(KeepAliveHandler(self))
+
+    def get_host(self, key):
+        with self.lock:
+            host = self.hosts.get(key)
+            if host is None:
+                host = Host(self.max_connections)
+                self.hosts[key] = host
+            return host
+
+    def open(self, request, timeout=DEFAULT_TIMEOUT):
+        """Open the url through the pool.  It works like
+        :func:`libearth.crawler.open_url()` except the returned response
+        is already read.
+
+        :param request: the url or the request to open
+        :type request: :class:`str`, :class:`urllib2.Request`
+        :param timeout: optional timeout for each connection attempt
+        :type timeout: :class:`numbers.Real`
+        :returns: the response
+        :raises urllib2.URLError: when it failed to open the url
+
+        """
+        if not isinstance(request, Request):
+            request = Request(request)
+        request.add_header('User-agent', 'libearth/' + VERSION)
+        return self.opener.open(request, timeout=timeout)
+
+    def reserve(self, key):
+        """Reserve the time to send a request to the host of the ``key``
+        following the :attr:`interval`.
+
+        :param key: the pair of the scheme and the host
+        :type key: :class:`tuple`
+        :returns: seconds to wait before sending the request
+        :rtype: :class:`numbers.Real`
+
+        """
+        host = self.get_host(key)
+        with self.lock:
+            now = time.time()
+            request_at = max(now, host.next_request_at)
+            host.next_request_at = request_at + self.interval
+            if request_at > now:
+                host.stats['throttled'] += 1
+        return request_at - now
+
+    def record(self, key, reused):
+        """Count a request sent to the host of the ``key``.
+
+        :param key: the pair of the scheme and the host
+        :type key: :class:`tuple`
+        :param reused: whether the request reused an idle connection
+        :type reused: :class:`bool`
+
+        """
+        host = self.get_host(key)
+        with self.lock:
+            host.stats['requests'] += 1
+            host.stats['reused' if reused else 'connections'] += 1
+
+    def acquire(self, key, timeout):
+        host = self.get_host(key)
+        expired_at = time.time() - self.idle_timeout
+        with self.lock:
+            while host.idle:
+                connection, released_at = host.idle.pop()
+                if released_at >= expired_at:
+                    connection.timeout = timeout
+                    if connection.sock is not None:
+                        connection.sock.settimeout(timeout)
+                    return connection, True
+                connection.close()
+        scheme, netloc = key
+        if scheme == 'https':
+            connection = http_client.HTTPSConnection(netloc, timeout=timeout)
+        else:
+            connection = http_client.HTTPConnection(netloc, timeout=timeout)
+        return connection, False
+
+    def release(self, key, connection):
+        host = self.get_host(key)
+        with self.lock:
+            if len(host.idle) < self.max_connections:
+                host.idle.append((connection, time.time()))
+                return
+        connection.close()
+
+    def send(self, request, scheme):
+        """Send the ``request`` through a pooled connection and read
+        the whole response.  It's called by :class:`KeepAliveHandler`.
+
+        :param request: the request to send
+        :type request: :class:`urllib2.Request`
+        :param scheme: ``'http'`` or ``'https'``
+        :type scheme: :class:`str`
+        :returns: the response
+        :raises urllib2.URLError: when it failed to send the request
+
+        """
+        netloc = getattr(request, 'host', None) or request.get_host()
+        if not netloc:
+            raise URLError('no host given')
+        selector = getattr(request, 'selector', None) or \
+            request.get_selector()
+        headers = dict(request.unredirected_hdrs)
+        headers.update(request.headers)
+        headers = dict((name.title(), value)
+                       for name, value in headers.items())
+        headers.pop('Connection', None)
+        key = scheme, netloc
+        host = self.get_host(key)
+        with host.semaphore:
+            delay = self.reserve(key)
+            if delay > 0:
+                time.sleep(delay)
+            while True:
+                connection, reused = self.acquire(key, request.timeout)
+                try:
+                    connection.request(request.get_method(), selector,
+                                       request.data, headers)
+                    response = connection.getresponse()
+                    body = response.read()
+                except (http_client.HTTPException, socket.error) as e:
+                    connection.close()
+                    if reused:
+                        # The server may have closed the idle connection
+                        continue
+                    raise URLError(e)
+                break
+            self.record(key, reused)
+            if response.will_close:
+                connection.close()
+            else:
+                self.release(key, connection)
+        result = addinfourl(io.BytesIO(body), response.msg,
+                            request.get_full_url(), response.status)
+        result.msg = response.reason
+        return result
+
+    def get_stats(self):
+        """Get statistics of requests and connection reuse.
+
+        :returns: totals of ``requests``, ``connections`` (newly opened),
+                  ``reused`` (requests through idle connections), and
+                  ``throttled`` (requests delayed for the request rate),
+                  and the same numbers per host in ``hosts``
+        :rtype: :class:`collections.Mapping`
+
+        """
+        with self.lock:
+            hosts = dict((netloc if scheme == 'http'
+                          else scheme + '://' + netloc, dict(host.stats))
+                         for (scheme, netloc), host in self.hosts.items())
+        stats = {'requests': 0, 'connections': 0, 'reused': 0,
+                 'throttled': 0}
+        for host_stats in hosts.values():
+            for name in stats:
+                stats[name] += host_stats[name]
+        stats['hosts'] = hosts
+        return stats
+
+    def clear(self):
+        """Close all idle connections."""
+        with self.lock:
+            for host in self.hosts.values():
+                for connection, _ in host.idle:
+                    connection.close()
+                del host.idle[:]
+
+
+#: (:class:`ConnectionPool`) The process-wide connection pool.
+connection_pool = ConnectionPool()
@@ -0,0 +1,379 @@
+""":mod:`earthreader.web.crawler` --- Conditional crawler
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Most feeds don't change between two crawls.  The crawler remembers
+validators (``ETag`` and ``Last-Modified``) of each feed in the repository
+and sends conditional requests with them, so that feeds not modified
+since the last crawl are neither downloaded nor parsed again.
+
+Feeds which are modified are compared with the stored ones by
+:func:`merge_feed()` before they're written, so that feeds of which no
+entries are new or updated aren't written either.
+
+Feeds are fetched by one of :const:`ENGINES`: a pool of threads by default,
+or an :mod:`asyncio` event loop for large subscription lists.
+
+"""
+import json
+import sys
+import xml.etree.ElementTree
+
+from libearth.compat import string_type, text_type
+from libearth.compat.parallel import parallel_map
+from libearth.crawler import DEFAULT_TIMEOUT, CrawlError, CrawlResult, Request
+from libearth.feed import Link
+from libearth.parser.autodiscovery import get_format
+from libearth.parser.rss2 import parse_rss
+from libearth.repository import RepositoryKeyError
+from six.moves.urllib.error import HTTPError
+
+from .connection import connection_pool
+
+__all__ = ('ENGINES', 'KEY', 'ErrorIterator', 'crawl', 'diff_entries',
+           'fetch_feed', 'get_conditional_headers', 'get_engine',
+           'load_validators', 'merge_feed', 'parse_feed', 'parse_skip_hints',
+           'save_validators')
+
+
+#: (:class:`collections.Sequence`) The repository key of the directory
+#: where validators are stored, one file per feed.
+KEY = ['.earthreader-web', 'validators']
+
+#: (:class:`collections.Sequence`) Names of available crawl engines.
+#: ``'threads'`` is :func:`crawl()` which is the default, and
+#: ``'asyncio'`` is :func:`earthreader.web.aiocrawler.crawl()` which
+#: can keep much more fetches in flight.
+ENGINES = 'threads', 'asyncio'
+
+
+def load_validators(stage, feed_id):
+    """Load validators of the feed stored by :func:`save_validators()`.
+    It has to be called inside a transaction of the ``stage``.
+
+    :param stage: the stage to read
+    :type stage: :class:`~libearth.stage.Stage`
+    :param feed_id: the feed id
+    :type feed_id: :class:`str`
+    :returns: validators of the feed.  empty if there's nothing stored
+    :rtype: :class:`collections.Mapping`
+
+    """
+    repository = stage.get_current_transaction()
+    try:
+        data = b''.join(repository.read(KEY + [feed_id + '.json']))
+        validators = json.loads(data.decode('utf-8'))
+    except (RepositoryKeyError, ValueError):
+        return {}
+    return validators if isinstance(validators, dict) else {}
+
+
+def save_validators(stage, feed_id, validators):
+    """Store validators of the feed.  It has to be called inside
+    a transaction of the ``stage``.
+
+    :param stage: the stage to write
+    :type stage: :class:`~libearth.stage.Stage`
+    :param feed_id: the feed id
+    :type feed_id: :class:`str`
+    :param validators: validators :func:`fetch_feed()` returned
+    :type validators: :class:`collections.Mapping`
+
+    """
+    repository = stage.get_current_transaction()
+    repository.write(KEY + [feed_id + '.json'],
+                     [text_type(json.dumps(validators)).encode('utf-8')])
+
+
+def get_conditional_headers(validators):
+    """Make headers of a conditional request from validators.
+
+    :param validators: validators returned by the last fetch
+    :type validators: :class:`collections.Mapping`
+    :returns: pairs of header names and values
+    :rtype: :class:`collections.Sequence`
+
+    """
+    headers = []
+    if validators.get('etag'):
+        headers.append(('If-None-Match', validators['etag']))
+    if validators.get('last_modified'):
+        headers.append(('If-Modified-Since', validators['last_modified']))
+    return headers
+
+
+def fetch_feed(feed_url, validators=None, timeout=DEFAULT_TIMEOUT,
+               connections=None):
+    """Fetch and parse the feed if it has been modified since validators
+    were given.  It's similar to :func:`libearth.crawler.get_feed()`
+    except it sends a conditional request and doesn't look for favicons.
+
+    :param feed_url: the feed url to fetch
+    :type feed_url: :class:`str`
+    :param validators: validators returned by the last fetch
+    :type validators: :class:`collections.Mapping`
+    :param timeout: optional timeout for connection attempts
+    :type timeout: :class:`numbers.Integral`
+    :param connections: the connection pool to request through.
+                        :data:`~earthreader.web.connection.connection_pool`
+                        by default
+    :type connections: :class:`~earthreader.web.connection.ConnectionPool`
+    :returns: a triple of the :class:`~libearth.crawler.CrawlResult`,
+              new validators, and downloaded bytes.  the result is
+              :const:`None` if the feed has not been modified
+    :rtype: :class:`tuple`
+    :raises libearth.crawler.CrawlError: when it failed to fetch or parse
+                                         the feed
+
+    """
+    validators = validators or {}
+    request = Request(feed_url)
+    for name, value in get_conditional_headers(validators):
+        request.add_header(name, value)
+    try:
+        f = (connections or connection_pool).open(request, timeout=timeout)
+    except HTTPError as e:
+        if e.code == 304 and validators:
+            return None, validators, 0
+        raise CrawlError(feed_url, '{0} failed: {1}'.format(feed_url, e))
+    except Exception as e:
+        raise CrawlError(feed_url, '{0} failed: {1}'.format(feed_url, e))
+    try:
+        feed_xml = f.read()
+        headers = f.info()
+    except Exception as e:
+        raise CrawlError(feed_url, '{0} failed: {1}'.format(feed_url, e))
+    finally:
+        f.close()
+    return parse_feed(feed_url, feed_xml, headers)
+
+
+def parse_skip_hints(feed_xml):
+    """Extract ``<skipHours>`` and ``<skipDays>`` of the RSS 2.0 document.
+    The RSS parser of libearth drops them because they have no text but
+    child elements.
+
+    :param feed_xml: the RSS 2.0 document
+    :type feed_xml: :class:`bytes`
+    :returns: crawler hints of ``skipHours`` and ``skipDays`` which are
+              whitespace-separated hours and days.  empty if the document
+              has neither
+    :rtype: :class:`collections.Mapping`
+
+    """
+    if b'<skipHours' not in feed_xml and b'<skipDays' not in feed_xml:
+        return {}
+    try:
+        root = xml.etree.ElementTree.fromstring(feed_xml)
+    except xml.etree.ElementTree.ParseError:
+        return {}
+    hints = {}
+    for name, child in (('skipHours', 'hour'), ('skipDays', 'day')):
+        values = [element.text.strip()
+                  for element in root.findall('channel/{0}/{1}'
+                                              .format(name, child))
+                  if element.text and element.text.strip()]
+        if values:
+            hints[name] = ' '.join(values)
+    return hints
+
+
+def parse_feed(feed_url, feed_xml, headers):
+    """Parse the fetched feed document.  It's the common part of crawl
+    engines after they fetched the feed.
+
+    :param feed_url: the fetched feed url
+    :type feed_url: :class:`str`
+    :param feed_xml: the fetched feed document
+    :type feed_xml: :class:`bytes`
+    :param headers: the response headers.  names have to be looked up
+                    case-insensitively, or stored in lowercase
+    :type headers: :class:`collections.Mapping`
+    :returns: the same triple to :func:`fetch_feed()`
+    :rtype: :class:`tuple`
+    :raises libearth.crawler.CrawlError: when it failed to parse the feed
+
+    """
+    try:
+        parser = get_format(feed_xml)
+        if parser is None:
+            raise CrawlError(feed_url,
+                             'failed to detect the format of ' + feed_url)
+        feed, crawler_hints = parser(feed_xml, feed_url)
+        if all(link.relation != 'self' for link in feed.links):
+            feed.links.append(Link(relation='self', uri=feed_url,
+                                   mimetype=headers.get('content-type')))
+        feed.entries = sorted(feed.entries,
+                              key=lambda entry: entry.updated_at,
+                              reverse=True)
+    except CrawlError:
+        raise
+    except Exception as e:
+        raise CrawlError(feed_url, '{0} failed: {1}'.format(feed_url, e))
+    crawler_hints = crawler_hints or {}
+    if parser is parse_rss:
+        crawler_hints.update(parse_skip_hints(feed_xml))
+    new_validators = {
+        'etag': headers.get('etag'),
+        'last_modified': headers.get('last-modified'),
+        # Kept for feeds not modified, e.g. skipHours for the scheduler
+        'hints': dict((k, v) for k, v in crawler_hints.items()
+                      if isinstance(v, string_type))
+    }
+    return (CrawlResult(feed_url, feed, crawler_hints), new_validators,
+            len(feed_xml))
+
+
+def diff_entries(stored, fetched):
+    """Compare entries of the ``fetched`` feed with the ``stored`` one by
+    their ids and :attr:`~libearth.feed.Entry.updated_at`.
+
+    :param stored: the feed stored in the repository
+    :type stored: :class:`~libearth.feed.Feed`
+    :param fetched: the feed just crawled
+    :type fetched: :class:`~libearth.feed.Feed`
+    :returns: a pair of new entries and modified entries of the ``fetched``
+    :rtype: :class:`tuple`
+
+    """
+    stored_entries = dict((entry.id, entry) for entry in stored.entries)
+    new = []
+    modified = []
+    for entry in fetched.entries:
+        stored_entry = stored_entries.get(entry.id)
+        if stored_entry is None:
+            new.append(entry)
+        elif stored_entry.updated_at != entry.updated_at:
+            modified.append(entry)
+    return new, modified
+
+
+def merge_feed(stored, fetched):
+    """Merge the ``fetched`` feed into the ``stored`` one.  Only new or
+    modified entries are taken from the ``fetched``, and modified entries
+    keep read/starred marks of their stored ones.  Stored entries are
+    kept as they are.
+
+    :param stored: the feed stored in the repository.  :const:`None`
+                   if it's not stored yet
+    :type stored: :class:`~libearth.feed.Feed`
+    :param fetched: the feed just crawled.  it can be changed in place
+    :type fetched: :class:`~libearth.feed.Feed`
+    :returns: the feed to write, or :const:`None` if there's nothing
+              changed so the write can be skipped
+    :rtype: :class:`~libearth.feed.Feed`
+
+    """
+    if stored is None:
+        return fetched
+    new, modified = diff_entries(stored, fetched)
+    if not (new or modified or
+            text_type(stored.title) != text_type(fetched.title)):
+        return
+    changed = dict((entry.id, entry) for entry in new + modified)
+    stored_entries = dict((entry.id, entry) for entry in stored.entries)
+    entries = []
+    for entry in fetched.entries:
+        stored_entry = stored_entries.pop(entry.id, None)
+        if entry.id not in changed:
+            if stored_entry is not None:
+                entries.append(stored_entry)
+            continue
+        if stored_entry is not None:
+            entry.read = stored_entry.read
+            entry.starred = stored_entry.starred
+        entries.append(entry)
+    # Entries which disappeared from the feed document are kept as well
+    entries.extend(entry for entry in stored.entries
+                   if entry.id in stored_entries)
+    # Assigning a new list doesn't reset the length hint of the element
+    # list, so the list is refilled in place.
+    del fetched.entries[:]
+    fetched.entries.extend(entries)
+    return fetched
+
+
+class ErrorIterator(object):
+    """Iterator which raises :exc:`~libearth.crawler.CrawlError` items of
+    the ``iterable`` instead of yielding them, and can be iterated further
+    after that.  Fetches on :func:`~libearth.compat.parallel.parallel_map()`
+    return errors through it, since the map stops at the first error it
+    raises.
+
+    :param iterable: results and errors
+    :type iterable: :class:`collections.Iterable`
+
+    """
+
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = next(self.iterator)
+        if isinstance(item, CrawlError):
+            raise item
+        return item
+
+    next = __next__
+
+
+def crawl(feeds, pool_size, timeout=DEFAULT_TIMEOUT, connections=None):
+    """Crawl feeds in parallel with conditional requests, using a pool of
+    threads.
+
+    :param feeds: feed urls to their validators
+    :type feeds: :class:`collections.Mapping`
+    :param pool_size: the number of concurrent workers
+    :type pool_size: :class:`numbers.Integral`
+    :param timeout: optional timeout for connection attempts
+    :type timeout: :class:`numbers.Integral`
+    :param connections: the connection pool to request through.
+                        :data:`~earthreader.web.connection.connection_pool`
+                        by default
+    :type connections: :class:`~earthreader.web.connection.ConnectionPool`
+    :returns: quadruples of the feed url, the
+              :class:`~libearth.crawler.CrawlResult` (or :const:`None` if
+              the feed has not been modified), new validators, and
+              downloaded bytes.  it raises
+              :exc:`~libearth.crawler.CrawlError` for each failed feed
+    :rtype: :class:`ErrorIterator`
+
+    """
+    def fetch(feed_url):
+        try:
+            return (feed_url,) + fetch_feed(feed_url, feeds[feed_url],
+                                            timeout, connections)
+        except CrawlError as e:
+            return e
+    if not feeds:
+        return iter(())
+    return ErrorIterator(parallel_map(min(pool_size, len(feeds)), fetch,
+                                      list(feeds)))
+
+
+def get_engine(name):
+    """Get the crawl engine function of the ``name``.  Every engine
+    function takes the same arguments to :func:`crawl()` (``pool_size``
+    means the number of concurrent fetches) and returns the same
+    quadruples.
+
+    :param name: the name of the engine.  one of :const:`ENGINES`
+    :type name: :class:`str`
+    :returns: the crawl engine function
+    :rtype: :class:`collections.Callable`
+    :raises ValueError: when the engine is unknown or not available
+
+    """
+    if name == 'threads':
+        return crawl
+    elif name == 'asyncio':
+        # The module isn't even syntactically valid on Python 2, and
+        # asyncio.coroutine() it's written with was removed in Python 3.11
+        if not (3, 4) <= sys.version_info < (3, 11):
+            raise ValueError('asyncio crawl engine requires Python 3.4 to '
+                             '3.10')
+        from .aiocrawler import crawl as crawl_asyncio
+        return crawl_asyncio
+    raise ValueError('unknown crawl engine: ' + repr(name))
@@ -42,6 +42,13 @@ class EntryNotFound(ValueError, JsonException):
     message = 'The entry you request does not exist'
 
 
+class JobNotFound(ValueError, JsonException):
+    """Raised when the crawl job does not exist or is too old."""
+
+    error = 'job-not-found'
+    message = 'The crawl job you request does not exist'
+
+
 class WorkerNotRunning(ValueError, JsonException):
     """Raised when the worker thread is not running."""
 
@@ -0,0 +1,371 @@
+""":mod:`earthreader.web.scheduler` --- Periodic crawl scheduler
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+:class:`Scheduler` crawls every subscription periodically through
+the :class:`~earthreader.web.worker.Worker`, so that feeds are fresh even
+if the user doesn't request to crawl them.  Each feed has its own interval
+that adapts to how often the feed is actually updated, and respects
+crawler hints of the feed e.g. ``<ttl>`` and ``<skipHours>`` of RSS 2.0.
+
+"""
+import datetime
+import logging
+import random
+import re
+import threading
+import time
+
+from .cache import subscription_cache
+from .stage import stage
+from .worker import BACKGROUND_PRIORITY
+
+__all__ = ('FeedSchedule', 'Scheduler', 'estimate_interval', 'parse_skip_days',
+           'parse_skip_hours', 'parse_ttl')
+
+
+#: (:class:`collections.Sequence`) Lowercased names of weekdays in
+#: the order of :meth:`datetime.datetime.weekday()`.
+WEEKDAYS = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday',
+            'saturday', 'sunday')
+
+
+def parse_ttl(crawler_hints):
+    """Get the ``ttl`` hint in seconds.
+
+    :param crawler_hints: crawler hints of the feed
+    :type crawler_hints: :class:`collections.Mapping`
+    :returns: the ttl in seconds or :const:`None`
+    :rtype: :class:`numbers.Integral`
+
+    """
+    try:
+        return int(crawler_hints['ttl'].strip()) * 60
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+def parse_skip_hours(crawler_hints):
+    """Get the set of GMT hours in the ``skipHours`` hint.
+
+    :param crawler_hints: crawler hints of the feed
+    :type crawler_hints: :class:`collections.Mapping`
+    :returns: the set of hours from 0 to 23
+    :rtype: :class:`frozenset`
+
+    """
+    text = crawler_hints.get('skipHours') or ''
+    return frozenset(int(hour) % 24 for hour in re.findall(r'\d+', text))
+
+
+def parse_skip_days(crawler_hints):
+    """Get the set of days in the ``skipDays`` hint.
+
+    :param crawler_hints: crawler hints of the feed
+    :type crawler_hints: :class:`collections.Mapping`
+    :returns: the set of weekdays, where Monday is 0 and Sunday is 6
+    :rtype: :class:`frozenset`
+
+    """
+    text = (crawler_hints.get('skipDays') or '').lower()
+    return frozenset(WEEKDAYS.index(day)
+                     for day in re.findall(r'[a-z]+', text)
+                     if day in WEEKDAYS)
+
+
+def estimate_interval(feed, samples=10):
+    """Estimate how often the ``feed`` is updated from its recent
+    entries.
+
+    :param feed: the feed to estimate
+    :type feed: :class:`~libearth.feed.Feed`
+    :param samples: the number of recent entries to look at
+    :type samples: :class:`numbers.Integral`
+    :returns: the mean interval between entries in seconds, or
+              :const:`None` if there are too few entries
+    :rtype: :class:`numbers.Real`
+
+    """
+    dates = sorted((entry.updated_at for entry in feed.entries
+                    if entry.updated_at is not None),
+                   reverse=True)[:samples]
+    if len(dates) < 2:
+        return None
+    span = dates[0] - dates[-1]
+    return (span.days * 86400 + span.seconds) / float(len(dates) - 1)
+
+
+class FeedSchedule(object):
+    """The crawl schedule of a feed.
+
+    :param feed_url: the feed url
+    :type feed_url: :class:`str`
+    :param feed_id: the feed id
+    :type feed_id: :class:`str`
+    :param next_crawl_at: the timestamp to crawl the feed next time
+    :type next_crawl_at: :class:`numbers.Real`
+
+    """
+
+    def __init__(self, feed_url, feed_id, next_crawl_at):
+        self.feed_url = feed_url
+        self.feed_id = feed_id
+        #: (:class:`numbers.Real`) The timestamp to crawl the feed next time.
+        self.next_crawl_at = next_crawl_at
+        #: (:class:`numbers.Real`) The last interval in seconds.
+        self.interval = None
+        #: (:class:`numbers.Real`) How often the feed is updated in seconds,
+        #: estimated from its entries.  See :func:`estimate_interval()`.
+        self.estimated_interval = None
+        #: (:class:`datetime.datetime`) The last update time of the entries
+        #: seen so far.
+        self.last_updated_at = None
+        #: (:class:`numbers.Integral`) The number of crawls in a row that
+        #: found nothing new.
+        self.misses = 0
+        #: (:class:`numbers.Integral`) The number of failed crawls in a row.
+        self.failures = 0
+        #: (:class:`numbers.Real`) The timestamp when the feed was queued
+        #: to the worker, or :const:`None` if it's not queued.
+        self.dispatched_at = None
+
+
+class Scheduler(object):
+    """Crawls subscriptions periodically through the ``worker``.
+
+    :param worker: the worker to crawl feeds
+    :type worker: :class:`~earthreader.web.worker.Worker`
+    :param min_interval: the minimum interval of a feed in seconds
+    :type min_interval: :class:`numbers.Real`
+    :param max_interval: the maximum interval of a feed in seconds
+    :type max_interval: :class:`numbers.Real`
+    :param rate_limit: the maximum number of feeds to crawl a minute
+    :type rate_limit: :class:`numbers.Integral`
+    :param jitter: the ratio of random jitter added to intervals
+    :type jitter: :class:`numbers.Real`
+    :param tick: how often to check feeds to crawl in seconds
+    :type tick: :class:`numbers.Real`
+
+    """
+
+    #: (:class:`numbers.Real`) The interval of feeds that there's no clue
+    #: how often they are updated.
+    default_interval = 60 * 60
+
+    #: (:class:`numbers.Real`) The factor to multiply intervals by for
+    #: each crawl that found nothing new.
+    backoff = 1.5
+
+    def __init__(self, worker, min_interval=15 * 60,
+                 max_interval=24 * 60 * 60, rate_limit=60, jitter=0.1,
+                 tick=30):
+        self.worker = worker
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.rate_limit = rate_limit
+        self.jitter = jitter
+        self.tick = tick
+        #: (:class:`dict`) Feed urls to their :class:`FeedSchedule`.
+        self.schedules = {}
+        self.lock = threading.RLock()
+        self.tokens = float(rate_limit)
+        self.refilled_at = time.time()
+        self.thread = None
+        self.stopped = threading.Event()
+        worker.add_listener(self.crawled)
+
+    def start(self):
+        """Start the scheduler thread if it's not running."""
+        if self.is_running():
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the scheduler thread."""
+        self.stopped.set()
+        if self.is_running():
+            self.thread.join()
+
+    def is_running(self):
+        return self.thread is not None and self.thread.isAlive()
+
+    def run(self):
+        logger = logging.getLogger(__name__ + '.Scheduler.run')
+        while True:
+            self.stopped.wait(self.tick)
+            if self.stopped.is_set():
+                break
+            try:
+                self.check()
+            except Exception as e:
+                logger.exception(e)
+
+    def check(self):
+        """Crawl subscriptions that are due.  It does nothing if
+        the stage isn't ready yet.
+
+        :returns: the job of crawling due feeds or :const:`None`
+        :rtype: :class:`~earthreader.web.worker.CrawlJob`
+
+        """
+        app = self.worker.app
+        with app.app_context():
+            if 'STAGE' not in app.config or not self.worker.is_running():
+                return
+            with stage:
+                subscriptions, _ = subscription_cache.load(stage)
+        return self.dispatch(subscriptions.recursive_subscriptions)
+
+    def sync(self, subscriptions, now):
+        """Update the set of feeds to crawl.  New feeds are scheduled to be
+        crawled within :attr:`min_interval` at random, so that they don't
+        burst at once.
+
+        :param subscriptions: subscriptions to crawl
+        :type subscriptions: :class:`collections.Iterable`
+        :param now: the current timestamp
+        :type now: :class:`numbers.Real`
+
+        """
+        urls = dict((sub.feed_uri, sub.feed_id) for sub in subscriptions)
+        with self.lock:
+            for feed_url in list(self.schedules):
+                if feed_url not in urls:
+                    del self.schedules[feed_url]
+            for feed_url, feed_id in urls.items():
+                if feed_url not in self.schedules:
+                    self.schedules[feed_url] = FeedSchedule(
+                        feed_url, feed_id,
+                        now + random.uniform(0, self.min_interval)
+                    )
+
+    def refill(self, now):
+        elapsed = max(0, now - self.refilled_at)
+        self.tokens = min(float(self.rate_limit),
+                          self.tokens + elapsed * self.rate_limit / 60.0)
+        self.refilled_at = now
+
+    def dispatch(self, subscriptions, now=None):
+        """Queue feeds that are due to the worker, as many as
+        :attr:`rate_limit` allows.
+
+        :param subscriptions: all subscriptions to crawl
+        :type subscriptions: :class:`collections.Iterable`
+        :param now: the current timestamp.  :func:`time.time()` by default
+        :type now: :class:`numbers.Real`
+        :returns: the job of crawling due feeds or :const:`None`
+        :rtype: :class:`~earthreader.web.worker.CrawlJob`
+
+        """
+        if now is None:
+            now = time.time()
+        self.sync(subscriptions, now)
+        with self.lock:
+            self.refill(now)
+            # Feeds queued too long ago are considered to be dropped
+            # from the queue.
+            expired = now - self.max_interval
+            due = sorted(
+                (s for s in self.schedules.values()
+                 if s.next_crawl_at <= now and
+                 (s.dispatched_at is None or s.dispatched_at < expired)),
+                key=lambda s: s.next_crawl_at
+            )[:int(self.tokens)]
+            if not due:
+                return
+            self.tokens -= len(due)
+            for schedule in due:
+                schedule.dispatched_at = now
+        urls = dict((s.feed_url, s.feed_id) for s in due)
+        return self.worker.add_feeds(urls, caller=self,
+                                     priority=BACKGROUND_PRIORITY)
+
+    def crawled(self, feed_url, feed_data, crawler_hints, now=None):
+        """Reschedule the feed.  It's registered as a listener of
+        the worker.
+
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            schedule = self.schedules.get(feed_url)
+            if schedule is None:
+                return
+            schedule.dispatched_at = None
+            if crawler_hints is None:
+                schedule.failures += 1
+                interval = self.min_interval * 2 ** min(schedule.failures, 10)
+            else:
+                schedule.failures = 0
+                interval = self.get_interval(schedule, feed_data,
+                                             crawler_hints or {})
+            interval = max(self.min_interval, min(self.max_interval, interval))
+            if self.jitter:
+                interval *= 1 + random.uniform(-self.jitter, self.jitter)
+            schedule.interval = interval
+            next_crawl_at = now + interval
+            if crawler_hints:
+                next_crawl_at = self.skip(next_crawl_at,
+                                          parse_skip_hours(crawler_hints),
+                                          parse_skip_days(crawler_hints))
+            schedule.next_crawl_at = next_crawl_at
+
+    def get_interval(self, schedule, feed_data, crawler_hints):
+        """Compute the next interval of the feed from how often it's
+        updated and its crawler hints.
+
+        :param schedule: the schedule of the feed
+        :type schedule: :class:`FeedSchedule`
+        :param feed_data: the crawled feed, or :const:`None` if it has
+                          not been modified
+        :type feed_data: :class:`~libearth.feed.Feed`
+        :param crawler_hints: crawler hints of the feed
+        :type crawler_hints: :class:`collections.Mapping`
+        :returns: the interval in seconds
+        :rtype: :class:`numbers.Real`
+
+        """
+        if feed_data is None:
+            # Not modified since the last crawl
+            updated_at = None
+        else:
+            updated_at = max([entry.updated_at
+                              for entry in feed_data.entries
+                              if entry.updated_at is not None] or [None])
+            schedule.estimated_interval = estimate_interval(feed_data)
+        if updated_at is not None and (schedule.last_updated_at is None or
+                                       updated_at > schedule.last_updated_at):
+            schedule.last_updated_at = updated_at
+            schedule.misses = 0
+        else:
+            schedule.misses += 1
+        interval = schedule.estimated_interval or self.default_interval
+        interval *= self.backoff ** min(schedule.misses, 10)
+        ttl = parse_ttl(crawler_hints)
+        if ttl:
+            interval = max(interval, ttl)
+        return interval
+
+    def skip(self, timestamp, skip_hours, skip_days):
+        """Postpone the ``timestamp`` to the first hour that isn't skipped.
+
+        :param timestamp: the timestamp to postpone
+        :type timestamp: :class:`numbers.Real`
+        :param skip_hours: GMT hours to skip
+        :type skip_hours: :class:`collections.Set`
+        :param skip_days: weekdays to skip
+        :type skip_days: :class:`collections.Set`
+        :returns: the postponed timestamp
+        :rtype: :class:`numbers.Real`
+
+        """
+        if len(skip_hours) >= 24 or len(skip_days) >= 7:
+            return timestamp
+        for _ in range(24 * 7):
+            dt = datetime.datetime.utcfromtimestamp(timestamp)
+            if dt.hour not in skip_hours and dt.weekday() not in skip_days:
+                break
+            timestamp = (int(timestamp) // 3600 + 1) * 3600
+        return timestamp
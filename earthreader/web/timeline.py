@@ -0,0 +1,358 @@
+""":mod:`earthreader.web.timeline` --- Category timeline index
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Listing entries of a category used to open every feed in the category
+and merge their entries.  :class:`Timeline` instead maintains a single
+index of entries of all feeds sorted newest first, and a category view
+is served by filtering the index with the feed set of the category, so
+that only feeds of entries actually listed in a page are opened.
+
+The index is only a cache of feeds in the repository, so it's never written
+to the repository.  It can be persisted per session to a local directory
+(see :attr:`Timeline.persist`) to be reused after restarts, and otherwise
+it's built lazily as feeds are listed.  Feeds written through the feed cache
+are indexed as soon as they are written, and revisions of feed documents are
+compared at most every :attr:`Timeline.check_interval` seconds to catch up
+with changes made by other processes.  The persisted index can be rebuilt
+from scratch by :program:`earthreader timeline`.
+
+"""
+import bisect
+import errno
+import io
+import json
+import logging
+import os.path
+import threading
+import time
+
+from libearth.codecs import Rfc3339
+from libearth.compat import text_type
+from libearth.session import RevisionCodec
+
+from .cache import feed_cache, get_entry_key
+
+__all__ = 'Timeline', 'encode_revisions', 'timeline'
+
+
+def encode_revisions(revisions):
+    """Encode revisions that :meth:`FeedCache.get_revisions()
+    <earthreader.web.cache.FeedCache.get_revisions>` returned into
+    a hashable value which can be serialized to JSON.
+
+    :param revisions: pairs of the document name and its revision
+    :type revisions: :class:`tuple`
+    :returns: pairs of the document name and its encoded revision
+    :rtype: :class:`tuple`
+
+    """
+    codec = RevisionCodec()
+    return tuple((name, revision and codec.encode(revision))
+                 for name, revision in revisions)
+
+
+class Timeline(object):
+    """Index of entries of all feeds sorted newest first.  Each row of
+    the index is a list of ``[updated_at, entry_id, feed_id, read,
+    starred]`` where ``entry_id`` is the hash of the entry id.
+
+    :param feed_cache: the feed cache to read feeds through
+    :type feed_cache: :class:`~earthreader.web.cache.FeedCache`
+    :param persist: the directory path to persist the index to, one file
+                    per session.  it's meant to be a local directory outside
+                    the repository.  the index isn't persisted by default
+    :type persist: :class:`str`
+
+    """
+
+    #: (:class:`numbers.Integral`) The version of the persisted format.
+    VERSION = 1
+
+    #: (:class:`numbers.Real`) Seconds to trust the indexed revisions of
+    #: a feed before :meth:`refresh()` compares them again.
+    check_interval = 60
+
+    def __init__(self, feed_cache, persist=None):
+        self.feed_cache = feed_cache
+        self.persist = persist
+        self.lock = threading.RLock()
+        self.clear()
+        feed_cache.add_listener(self.stored)
+
+    def clear(self):
+        """Empty the index."""
+        with self.lock:
+            self.source = None
+            self.rows = []
+            self.entries = {}
+            self.revisions = {}
+            #: (:class:`dict`) Feed ids to the timestamp when their
+            #: revisions were compared the last.
+            self.checked_at = {}
+            self.dirty = False
+
+    def get_path(self, stage):
+        return os.path.join(self.persist, stage.session.identifier + '.json')
+
+    def bind(self, stage):
+        """Load the index persisted for the ``stage`` if the index isn't
+        loaded for the ``stage`` yet.  Feeds of the loaded index are
+        compared with the ``stage`` by the next :meth:`refresh()`.
+
+        :param stage: the stage to load the index from
+        :type stage: :class:`~libearth.stage.Stage`
+
+        """
+        source = stage.repository, stage.session.identifier
+        with self.lock:
+            if self.source == source:
+                return
+            self.clear()
+            self.source = source
+            if not self.persist:
+                return
+            try:
+                with io.open(self.get_path(stage), encoding='utf-8') as f:
+                    data = json.loads(f.read())
+            except (IOError, OSError, ValueError):
+                return
+            if data.get('version') != self.VERSION:
+                return
+            codec = Rfc3339()
+            for feed_id, revisions in data['revisions'].items():
+                self.revisions[feed_id] = revisions and tuple(
+                    tuple(pair) for pair in revisions
+                )
+                self.entries[feed_id] = {}
+            for updated_at, entry_id, feed_id, read, starred in data['rows']:
+                row = [codec.decode(updated_at), entry_id, feed_id,
+                       read, starred]
+                self.rows.append(row)
+                self.entries[feed_id][entry_id] = row
+            self.rows.sort()
+
+    def save(self, stage):
+        """Persist the index for the ``stage`` to the :attr:`persist`
+        directory if it has changed.  It's a no-op if :attr:`persist`
+        isn't set.
+
+        :param stage: the stage the index is of
+        :type stage: :class:`~libearth.stage.Stage`
+
+        """
+        with self.lock:
+            if not self.dirty or not self.persist:
+                return
+            codec = Rfc3339()
+            data = {
+                'version': self.VERSION,
+                'revisions': self.revisions,
+                'rows': [[codec.encode(row[0])] + row[1:]
+                         for row in self.rows]
+            }
+            self.dirty = False
+        path = self.get_path(stage)
+        try:
+            try:
+                os.makedirs(self.persist)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            with io.open(path, 'w', encoding='utf-8') as f:
+                f.write(text_type(json.dumps(data)))
+        except (IOError, OSError) as e:
+            logger = logging.getLogger(__name__ + '.Timeline.save')
+            logger.warning('failed to persist %s: %s', path, e)
+
+    def update(self, stage, feed_ids):
+        """Index feeds of the given ``feed_ids`` again if their documents
+        have changed since they were indexed.  It has to be called inside
+        a transaction of the ``stage``.
+
+        :param stage: the stage to read
+        :type stage: :class:`~libearth.stage.Stage`
+        :param feed_ids: feed ids to update
+        :type feed_ids: :class:`collections.Iterable`
+        :returns: the number of feeds indexed again
+        :rtype: :class:`numbers.Integral`
+
+        """
+        self.bind(stage)
+        outdated = {}
+        checked_at = time.time()
+        for feed_id in feed_ids:
+            try:
+                revisions = self.feed_cache.get_revisions(stage, feed_id)
+            except KeyError:
+                revisions = None
+            else:
+                revisions = encode_revisions(revisions)
+            with self.lock:
+                self.checked_at[feed_id] = checked_at
+                if feed_id in self.revisions and \
+                   self.revisions[feed_id] == revisions:
+                    continue
+            rows = []
+            if revisions is not None:
+                rows = self.make_rows(feed_id,
+                                      self.feed_cache.get(stage, feed_id))
+            outdated[feed_id] = revisions, rows
+        if outdated:
+            self.replace(outdated)
+        return len(outdated)
+
+    def refresh(self, stage, feed_ids):
+        """Index feeds of the given ``feed_ids`` which aren't indexed yet,
+        and feeds which revisions haven't been compared for
+        :attr:`check_interval` seconds if they have changed.  Feeds written
+        through the feed cache are already indexed by :meth:`stored()`,
+        so it doesn't read every feed for every call.  It has to be called
+        inside a transaction of the ``stage``.
+
+        :param stage: the stage to read
+        :type stage: :class:`~libearth.stage.Stage`
+        :param feed_ids: feed ids to refresh
+        :type feed_ids: :class:`collections.Iterable`
+        :returns: the number of feeds indexed again
+        :rtype: :class:`numbers.Integral`
+
+        """
+        self.bind(stage)
+        expired = time.time() - self.check_interval
+        with self.lock:
+            feed_ids = [feed_id for feed_id in feed_ids
+                        if feed_id not in self.revisions or
+                        self.checked_at.get(feed_id, 0) <= expired]
+        if not feed_ids:
+            return 0
+        return self.update(stage, feed_ids)
+
+    def stored(self, stage, feed_id, feed):
+        """Index the ``feed`` just written.  It's registered as a listener
+        of the feed cache.  If entries of the feed are the same to indexed
+        ones, only their flags are updated without sorting the index again,
+        e.g. when marks are written.
+
+        :param stage: the stage the feed is written to
+        :type stage: :class:`~libearth.stage.Stage`
+        :param feed_id: the feed id
+        :type feed_id: :class:`str`
+        :param feed: the written feed
+        :type feed: :class:`~libearth.feed.Feed`
+
+        """
+        self.bind(stage)
+        revisions = encode_revisions(
+            self.feed_cache.get_revisions(stage, feed_id)
+        )
+        feed_rows = self.make_rows(feed_id, feed)
+        with self.lock:
+            self.checked_at[feed_id] = time.time()
+            indexed = self.entries.get(feed_id)
+            if indexed is None or len(indexed) != len(feed_rows) or \
+               any(row[1] not in indexed or indexed[row[1]][0] != row[0]
+                   for row in feed_rows):
+                self.replace({feed_id: (revisions, feed_rows)})
+                return
+            for row in feed_rows:
+                indexed[row[1]][3:] = row[3:]
+            self.revisions[feed_id] = revisions
+            self.dirty = True
+
+    def make_rows(self, feed_id, feed):
+        rows = []
+        for entry in feed.entries:
+            updated_at, entry_id = get_entry_key(entry)
+            rows.append([updated_at, entry_id, feed_id,
+                         bool(entry.read), bool(entry.starred)])
+        return rows
+
+    def replace(self, outdated):
+        with self.lock:
+            rows = [row for row in self.rows if row[2] not in outdated]
+            for feed_id, (revisions, feed_rows) in outdated.items():
+                self.revisions[feed_id] = revisions
+                self.entries[feed_id] = dict((row[1], row)
+                                             for row in feed_rows)
+                rows.extend(feed_rows)
+            rows.sort()
+            self.rows = rows
+            self.dirty = True
+
+    def rebuild(self, stage, feed_ids):
+        """Drop the whole index and build it again from feeds of
+        the given ``feed_ids``, and then persist it if :attr:`persist` is
+        set.  It has to be called inside a transaction of the ``stage``.
+
+        :param stage: the stage to read
+        :type stage: :class:`~libearth.stage.Stage`
+        :param feed_ids: feed ids to index
+        :type feed_ids: :class:`collections.Iterable`
+        :returns: the number of indexed feeds
+        :rtype: :class:`numbers.Integral`
+
+        """
+        with self.lock:
+            self.clear()
+            self.source = stage.repository, stage.session.identifier
+            count = self.update(stage, feed_ids)
+            self.dirty = True
+            self.save(stage)
+        return count
+
+    def mark(self, feed_id, entry_id, read=None, starred=None):
+        """Update flags of the indexed entry e.g. ``read=True``,
+        ``starred=False``.  It's a no-op if there's no such entry in
+        the index.
+
+        :param feed_id: the feed id of the entry
+        :type feed_id: :class:`str`
+        :param entry_id: the hash of the entry id
+        :type entry_id: :class:`str`
+
+        """
+        with self.lock:
+            row = self.entries.get(feed_id, {}).get(entry_id)
+            if row is None:
+                return
+            if read is not None:
+                row[3] = bool(read)
+            if starred is not None:
+                row[4] = bool(starred)
+            self.dirty = True
+
+    def iter_rows(self, feed_ids, after=None, read=None, starred=None):
+        """Iterate rows of the given ``feed_ids`` newest first.
+
+        :param feed_ids: feed ids to filter rows
+        :type feed_ids: :class:`collections.Set`
+        :param after: the key of the last entry of the previous page.
+                      see also :func:`~earthreader.web.cache.get_entry_key()`
+        :type after: :class:`tuple`
+        :param read: list only read entries if :const:`True` or unread
+                     entries if :const:`False`.  all entries by default
+        :type read: :class:`bool`
+        :param starred: list only starred entries if :const:`True` or
+                        unstarred entries if :const:`False`.  all entries
+                        by default
+        :type starred: :class:`bool`
+        :returns: rows of entries older than ``after``
+        :rtype: :class:`collections.Iterable`
+
+        """
+        rows = self.rows
+        if after is None:
+            position = len(rows)
+        else:
+            position = bisect.bisect_left(rows, list(after))
+        for position in range(position - 1, -1, -1):
+            row = rows[position]
+            if row[2] not in feed_ids or \
+               read is not None and row[3] != read or \
+               starred is not None and row[4] != starred:
+                continue
+            yield row
+
+
+#: (:class:`Timeline`) The timeline index of the application.
+timeline = Timeline(feed_cache)
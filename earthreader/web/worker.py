@@ -2,75 +2,651 @@
 ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 """
+import itertools
+import logging
 import threading
-from six.moves import queue
+import time
+import uuid
 
-from libearth.crawler import CrawlError, crawl
+from libearth.compat.parallel import parallel_map
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+from libearth.crawler import CrawlError
 
+from .cache import feed_cache
+from .crawler import (ErrorIterator, fetch_feed, get_engine, load_validators,
+                      merge_feed, save_validators)
 from .stage import stage
 
+__all__ = ('BACKGROUND_PRIORITY', 'CATEGORY_PRIORITY', 'CONTROL_PRIORITY',
+           'FEED_PRIORITY', 'CrawlJob', 'JobQueue', 'Worker')
+
+
+#: (:class:`numbers.Integral`) The priority of control messages to
+#: the worker threads e.g. ``'terminate'``.
+CONTROL_PRIORITY = 0
+
+#: (:class:`numbers.Integral`) The priority of jobs to refresh a single feed
+#: requested by the user.
+FEED_PRIORITY = 1
+
+#: (:class:`numbers.Integral`) The priority of jobs to refresh a category
+#: requested by the user.
+CATEGORY_PRIORITY = 2
+
+#: (:class:`numbers.Integral`) The priority of jobs to crawl feeds
+#: periodically in background.
+BACKGROUND_PRIORITY = 3
+
+
+class JobQueue(object):
+    """The queue of jobs ordered by their priorities.  Lower numbers go
+    first, and items of the same priority go in FIFO order.
+
+    An item gets higher priority the longer it waits, by one class
+    every ``aging`` seconds, so that lower priority items never starve.
+    Items don't age past :const:`FEED_PRIORITY` though, so that control
+    messages e.g. ``'terminate'`` of :const:`CONTROL_PRIORITY` always
+    go first.
+    Priority classes can also limit how many of their items are taken and
+    not done yet at a time, so that e.g. background jobs cannot occupy
+    every worker thread.
+
+    :param aging: seconds for a waiting item to gain a higher priority
+                  class.  :const:`None` to disable aging
+    :type aging: :class:`numbers.Real`
+    :param limits: priority classes to the maximum number of items taken
+                   at a time.  unlimited for classes not in there
+    :type limits: :class:`collections.Mapping`
+
+    """
+
+    def __init__(self, aging=60, limits=None):
+        self.aging = aging
+        self.limits = dict(limits or {})
+        #: (:class:`collections.Sequence`) Lists of ``[priority, sequence,
+        #: enqueued_at, item]``.
+        self.items = []
+        #: (:class:`dict`) Priority classes to the number of items taken
+        #: and not done yet.
+        self.running = {}
+        self.unfinished = 0
+        self.condition = threading.Condition(threading.RLock())
+        self.sequence = itertools.count()
+
+    def put(self, item, priority):
+        """Put the item to the queue.
+
+        :param item: the item to put
+        :param priority: the priority class of the item
+        :type priority: :class:`numbers.Integral`
+
+        """
+        with self.condition:
+            self.items.append([priority, next(self.sequence), time.time(),
+                               item])
+            self.unfinished += 1
+            self.condition.notify_all()
+
+    def promote(self, item, priority):
+        """Raise the priority of the item if it's still in the queue.
+
+        :param item: the item to promote
+        :param priority: the new priority class
+        :type priority: :class:`numbers.Integral`
+        :returns: whether the item has been promoted
+        :rtype: :class:`bool`
+
+        """
+        with self.condition:
+            for entry in self.items:
+                if entry[3] is item and priority < entry[0]:
+                    entry[0] = priority
+                    self.condition.notify_all()
+                    return True
+        return False
+
+    def select(self, now):
+        best = best_key = None
+        for index, (priority, sequence, enqueued_at, _) in \
+                enumerate(self.items):
+            limit = self.limits.get(priority)
+            if limit is not None and self.running.get(priority, 0) >= limit:
+                continue
+            key = priority, sequence
+            if self.aging and priority > FEED_PRIORITY:
+                aged = priority - (now - enqueued_at) / self.aging
+                key = max(aged, FEED_PRIORITY), sequence
+            if best_key is None or key < best_key:
+                best, best_key = index, key
+        return best
+
+    def get(self, timeout=None):
+        """Take the item to do next.  It blocks until there's an item
+        which its priority class allows to take.  The caller has to call
+        :meth:`task_done()` when the item is done.
+
+        :param timeout: optional timeout in seconds
+        :type timeout: :class:`numbers.Real`
+        :returns: a pair of the priority class and the item, or
+                  :const:`None` if it timed out
+        :rtype: :class:`tuple`
+
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while True:
+                now = time.time()
+                index = self.select(now)
+                if index is not None:
+                    priority, _, _, item = self.items.pop(index)
+                    self.running[priority] = self.running.get(priority, 0) + 1
+                    return priority, item
+                if deadline is not None:
+                    if now >= deadline:
+                        return None
+                    self.condition.wait(deadline - now)
+                elif self.aging and self.items:
+                    # Waiting items may be able to get higher priority
+                    self.condition.wait(self.aging)
+                else:
+                    self.condition.wait()
+
+    def task_done(self, priority):
+        """Notify the item of the priority class taken by :meth:`get()`
+        is done.
+
+        :param priority: the priority class :meth:`get()` returned
+        :type priority: :class:`numbers.Integral`
+
+        """
+        with self.condition:
+            self.running[priority] -= 1
+            self.unfinished -= 1
+            self.condition.notify_all()
+
+    def join(self):
+        """Block until all items put to the queue are done."""
+        with self.condition:
+            while self.unfinished:
+                self.condition.wait()
+
+    def clear(self):
+        """Remove all items waiting in the queue.
+
+        :returns: removed items
+        :rtype: :class:`collections.Sequence`
+
+        """
+        with self.condition:
+            items = [entry[3] for entry in self.items]
+            self.unfinished -= len(self.items)
+            self.items = []
+            self.condition.notify_all()
+        return items
+
+    def qsize(self):
+        return len(self.items)
+
+
+class CrawlJob(object):
+    """A request to crawl feeds.  Feeds which are already queued or being
+    crawled by other jobs aren't crawled again, but the job waits for them
+    as well.
+
+    :param feed_urls: feed urls to crawl
+    :type feed_urls: :class:`collections.Set`
+
+    """
+
+    def __init__(self, feed_urls):
+        #: (:class:`str`) The unique identifier of the job.
+        self.id = uuid.uuid4().hex
+        #: (:class:`frozenset`) All feed urls the job waits for.
+        self.feed_urls = frozenset(feed_urls)
+        #: (:class:`set`) Feed urls not crawled yet.
+        self.remaining = set(self.feed_urls)
+        #: (:class:`collections.Sequence`) Feed urls the job crawls by
+        #: itself, i.e. which were not queued by other jobs.
+        self.owned_urls = []
+        #: (:class:`collections.Sequence`) Callers waiting on the job.
+        self.callers = []
+        #: (:class:`numbers.Integral`) The priority class of the job.
+        self.priority = None
+        #: (:class:`numbers.Integral`) The number of crawled feeds,
+        #: including feeds not modified.
+        self.crawled = 0
+        #: (:class:`numbers.Integral`) The number of feeds failed to crawl.
+        self.failed = 0
+        #: (:class:`numbers.Integral`) The total bytes of downloaded feeds.
+        self.bytes = 0
+        #: (:class:`numbers.Real`) The timestamp when the job was created.
+        self.created_at = time.time()
+        #: (:class:`numbers.Real`) The timestamp when any feed of the job
+        #: started to be crawled.
+        self.started_at = None
+        #: (:class:`numbers.Real`) The timestamp when the job was done.
+        self.finished_at = None
+        self.event = threading.Event()
+        if not self.remaining:
+            self.started_at = self.finished_at = self.created_at
+            self.event.set()
+
+    @property
+    def status(self):
+        """(:class:`str`) ``'queued'``, ``'running'`` or ``'done'``."""
+        if self.done:
+            return 'done'
+        elif self.started_at is not None:
+            return 'running'
+        return 'queued'
+
+    @property
+    def elapsed(self):
+        """(:class:`numbers.Real`) Seconds elapsed since the job was created
+        until it's done.
+
+        """
+        return (self.finished_at or time.time()) - self.created_at
+
+    @property
+    def done(self):
+        """(:class:`bool`) Whether all feeds of the job have been crawled."""
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        """Block until all feeds of the job are crawled.
+
+        :param timeout: optional timeout in seconds
+        :type timeout: :class:`numbers.Real`
+        :returns: whether the job is done
+        :rtype: :class:`bool`
+
+        """
+        self.event.wait(timeout)
+        return self.done
+
 
 class Worker(object):
-    """Crawl worker."""
+    """Crawl worker.  It runs a pool of ``WORKER_POOL_SIZE`` threads
+    that take jobs from the same queue, so that a long job e.g. crawling
+    a big category doesn't block other jobs.  Jobs running at the same
+    time share the budget of ``CRAWLER_THREAD`` concurrent fetches, and
+    writes of the same feed are serialized.
+
+    """
 
     def __init__(self, app):
-        self.crawling_queue = queue.Queue()
-        self.worker = threading.Thread(target=self.crawl_category)
-        self.worker.setDaemon(True)
+        self.app = app
+        self.crawling_queue = JobQueue()
+        self.workers = []
         self.worker_num = app.config.get('CRAWLER_THREAD', 4)
+        #: (:class:`threading.BoundedSemaphore`) The budget of concurrent
+        #: fetches shared by all running jobs.
+        self.crawl_budget = threading.BoundedSemaphore(self.worker_num)
+        self.feed_locks = {}
+        self.feed_locks_lock = threading.Lock()
+        self.pool_lock = threading.Lock()
+        #: (:class:`dict`) Queued feed urls to their feed ids.
+        self.pending = {}
+        #: (:class:`dict`) Queued feed urls to the highest priority of
+        #: jobs that own them.
+        self.pending_priorities = {}
+        #: (:class:`set`) Feed urls being crawled.
+        self.crawling = set()
+        #: (:class:`dict`) Feed urls to jobs waiting for them.
+        self.waiting = {}
+        #: (:class:`dict`) Sets of feed urls to their jobs not done yet.
+        self.jobs = {}
+        self.jobs_lock = threading.RLock()
+        #: (:class:`collections.OrderedDict`) Recent jobs by their ids.
+        #: Only the last :attr:`max_recent_jobs` jobs are kept.
+        self.recent_jobs = OrderedDict()
+        self.max_recent_jobs = 256
+        #: (:class:`collections.Sequence`) Functions called with
+        #: ``(feed_url, feed_data, crawler_hints)`` whenever a feed is
+        #: crawled.  ``feed_data`` is :const:`None` if the feed has not been
+        #: modified since the last crawl, and ``crawler_hints`` is also
+        #: :const:`None` if it failed.
+        self.listeners = []
 
     def start_worker(self):
-        if not self.worker.isAlive():
-            try:
-                self.worker.start()
-            except RuntimeError:
-                self.worker = threading.Thread(target=self.crawl_category)
-                self.worker.setDaemon(True)
-                self.worker.start()
+        with self.pool_lock:
+            self.workers = [w for w in self.workers if w.isAlive()]
+            if not self.workers:
+                self.worker_num = self.app.config.get('CRAWLER_THREAD', 4)
+                self.crawl_budget = threading.BoundedSemaphore(
+                    self.worker_num
+                )
+            queue = self.crawling_queue
+            with queue.condition:
+                queue.aging = self.app.config.get('WORKER_AGING', 60)
+                queue.limits = dict(self.app.config.get(
+                    'WORKER_PRIORITY_LIMITS', {BACKGROUND_PRIORITY: 1}
+                ))
+                queue.condition.notify_all()
+            pool_size = self.app.config.get('WORKER_POOL_SIZE', 2)
+            while len(self.workers) < pool_size:
+                worker = threading.Thread(target=self.crawl_category)
+                worker.setDaemon(True)
+                worker.start()
+                self.workers.append(worker)
 
     def kill_worker(self):
-        if self.worker.isAlive():
-            self.crawling_queue.put((0, 'terminate'))
-            self.worker.join()
+        with self.pool_lock:
+            workers = [w for w in self.workers if w.isAlive()]
+            for _ in workers:
+                self.crawling_queue.put('terminate', CONTROL_PRIORITY)
+            for worker in workers:
+                worker.join()
+            self.workers = []
 
     def is_running(self):
-        return self.worker.isAlive()
+        return any(w.isAlive() for w in self.workers)
+
+    def add_job(self, cursor, feed_id, caller=None, priority=None):
+        """Request to crawl feeds in the ``cursor``.  Feed urls already
+        queued or being crawled aren't queued again, and the same request
+        made while its job is still pending gets the existing job.
+
+        :param cursor: the category to crawl
+        :param feed_id: crawl only the feed of the id if it's present
+        :type feed_id: :class:`str`
+        :param caller: optional value to identify who waits on the job
+        :param priority: the priority class of the job.
+                         :const:`FEED_PRIORITY` if ``feed_id`` is present
+                         or :const:`CATEGORY_PRIORITY` by default
+        :type priority: :class:`numbers.Integral`
+        :returns: the job
+        :rtype: :class:`CrawlJob`
+
+        """
+        urls = dict((sub.feed_uri, sub.feed_id)
+                    for sub in cursor.recursive_subscriptions
+                    if not feed_id or sub.feed_id == feed_id)
+        if priority is None:
+            priority = FEED_PRIORITY if feed_id else CATEGORY_PRIORITY
+        return self.add_feeds(urls, caller, priority)
+
+    def add_feeds(self, urls, caller=None, priority=CATEGORY_PRIORITY):
+        """The same to :meth:`add_job()` except it takes feed urls and
+        their feed ids instead of a category.
+
+        Feed urls queued by jobs of lower priority are taken over by
+        the new job, so that it doesn't wait behind them.
+
+        :param urls: feed urls to their feed ids
+        :type urls: :class:`collections.Mapping`
+        :param caller: optional value to identify who waits on the job
+        :param priority: the priority class of the job
+        :type priority: :class:`numbers.Integral`
+        :returns: the job
+        :rtype: :class:`CrawlJob`
+
+        """
+        key = frozenset(urls)
+        with self.jobs_lock:
+            job = self.jobs.get(key)
+            if job is None:
+                job = CrawlJob(key)
+                job.priority = priority
+                for feed_url, url_feed_id in urls.items():
+                    if feed_url in self.crawling:
+                        job.started_at = job.started_at or time.time()
+                    elif feed_url not in self.pending or \
+                            priority < self.pending_priorities[feed_url]:
+                        # Whichever job claims the url first crawls it.
+                        self.pending[feed_url] = url_feed_id
+                        self.pending_priorities[feed_url] = priority
+                        job.owned_urls.append(feed_url)
+                    self.waiting.setdefault(feed_url, []).append(job)
+                if not job.done:
+                    self.jobs[key] = job
+                self.recent_jobs[job.id] = job
+                while len(self.recent_jobs) > self.max_recent_jobs:
+                    self.recent_jobs.popitem(last=False)
+                if job.owned_urls:
+                    self.crawling_queue.put(job, priority)
+            elif priority < job.priority:
+                if self.crawling_queue.promote(job, priority):
+                    job.priority = priority
+                    for feed_url in job.owned_urls:
+                        if feed_url in self.pending_priorities:
+                            self.pending_priorities[feed_url] = min(
+                                priority, self.pending_priorities[feed_url]
+                            )
+            if caller is not None:
+                job.callers.append(caller)
+        return job
+
+    def get_job(self, job_id):
+        """Find the recent job by its id.
+
+        :param job_id: the job id
+        :type job_id: :class:`str`
+        :returns: the job or :const:`None` if there's no such job
+        :rtype: :class:`CrawlJob`
+
+        """
+        with self.jobs_lock:
+            return self.recent_jobs.get(job_id)
+
+    def add_listener(self, listener):
+        """Register the function to be called whenever a feed is crawled.
+        See also :attr:`listeners`.
+
+        :param listener: the function to register
+        :type listener: :class:`collections.Callable`
+
+        """
+        self.listeners.append(listener)
+
+    def notify(self, feed_url, feed_data=None, crawler_hints=None):
+        for listener in self.listeners:
+            listener(feed_url, feed_data, crawler_hints)
+
+    def claim(self, job):
+        """Move feed urls the ``job`` owns from :attr:`pending` to
+        :attr:`crawling`.
 
-    def add_job(self, cursor, feed_id):
-        self.crawling_queue.put((1, (cursor, feed_id)))
+        :param job: the job to start
+        :type job: :class:`CrawlJob`
+        :returns: feed urls to their feed ids
+        :rtype: :class:`dict`
+
+        """
+        with self.jobs_lock:
+            urls = {}
+            now = time.time()
+            for feed_url in job.owned_urls:
+                try:
+                    urls[feed_url] = self.pending.pop(feed_url)
+                except KeyError:
+                    continue
+                del self.pending_priorities[feed_url]
+                self.crawling.add(feed_url)
+                for waiting_job in self.waiting.get(feed_url, ()):
+                    if waiting_job.started_at is None:
+                        waiting_job.started_at = now
+            return urls
+
+    def finish(self, feed_url, failed=False, size=0):
+        """Mark the feed url as crawled, and notify jobs waiting for it.
+
+        :param feed_url: the crawled feed url
+        :type feed_url: :class:`str`
+        :param failed: whether it failed to crawl the feed
+        :type failed: :class:`bool`
+        :param size: the downloaded bytes
+        :type size: :class:`numbers.Integral`
+
+        """
+        with self.jobs_lock:
+            self.crawling.discard(feed_url)
+            self.pending.pop(feed_url, None)
+            self.pending_priorities.pop(feed_url, None)
+            now = time.time()
+            for job in self.waiting.pop(feed_url, ()):
+                job.remaining.discard(feed_url)
+                if failed:
+                    job.failed += 1
+                else:
+                    job.crawled += 1
+                job.bytes += size
+                if not job.remaining:
+                    if self.jobs.get(job.feed_urls) is job:
+                        del self.jobs[job.feed_urls]
+                    job.finished_at = now
+                    job.event.set()
 
     def empty_queue(self):
-        with self.crawling_queue.mutex:
-            self.crawling_queue.queue.clear()
+        self.crawling_queue.clear()
+        with self.jobs_lock:
+            feed_urls = list(self.pending)
+            for feed_url in feed_urls:
+                self.finish(feed_url, failed=True)
+        for feed_url in feed_urls:
+            self.notify(feed_url)
 
     def qsize(self):
         return self.crawling_queue.qsize()
 
+    def get_feed_lock(self, feed_id):
+        """Get the lock to serialize writes of the feed.
+
+        :param feed_id: the feed id to lock
+        :type feed_id: :class:`str`
+        :returns: the lock of the feed
+        :rtype: :class:`threading.Lock`
+
+        """
+        with self.feed_locks_lock:
+            try:
+                return self.feed_locks[feed_id]
+            except KeyError:
+                lock = threading.Lock()
+                self.feed_locks[feed_id] = lock
+                return lock
+
+    def fetch(self, feed_url, validators):
+        with self.crawl_budget:
+            try:
+                result, validators, size = fetch_feed(feed_url, validators)
+            except CrawlError as e:
+                # Returned instead of raised, since parallel_map() stops
+                # at the first error
+                return e
+        return feed_url, result, validators, size
+
+    def crawl(self, feeds):
+        """The same to :func:`earthreader.web.crawler.crawl()` except it
+        fetches feeds within :attr:`crawl_budget`.  If ``CRAWL_ENGINE``
+        config is not ``'threads'``, the engine fetches feeds instead,
+        at most ``CRAWL_CONCURRENCY`` at a time.
+
+        :param feeds: feed urls to their validators
+        :type feeds: :class:`collections.Mapping`
+        :returns: quadruples of the feed url, the
+                  :class:`~libearth.crawler.CrawlResult` (or :const:`None`
+                  if the feed has not been modified), new validators, and
+                  downloaded bytes.  it raises
+                  :exc:`~libearth.crawler.CrawlError` for each failed feed
+        :rtype: :class:`collections.Iterable`
+
+        """
+        feed_urls = list(feeds)
+        if not feed_urls:
+            return iter(())
+        engine = self.app.config.get('CRAWL_ENGINE', 'threads')
+        if engine != 'threads':
+            crawl = get_engine(engine)
+            return crawl(feeds, self.app.config.get('CRAWL_CONCURRENCY', 100))
+        pool_size = min(self.worker_num, len(feed_urls))
+        return ErrorIterator(parallel_map(
+            pool_size, self.fetch, feed_urls,
+            [feeds[feed_url] for feed_url in feed_urls]
+        ))
+
     def crawl_category(self):
+        logger = logging.getLogger(__name__ + '.Worker.crawl_category')
         running = True
         while running:
             priority, arguments = self.crawling_queue.get()
-            if priority == 0:
+            if priority == CONTROL_PRIORITY:
                 if arguments == 'terminate':
                     running = False
-                self.crawling_queue.task_done()
-            elif priority == 1:
-                cursor, feed_id = arguments
-                if not feed_id:
-                    urls = dict((sub.feed_uri, sub.feed_id)
-                                for sub in cursor.recursive_subscriptions)
-                else:
-                    urls = dict((sub.feed_uri, sub.feed_id)
-                                for sub in cursor.recursive_subscriptions
-                                if sub.feed_id == feed_id)
-                iterator = iter(crawl(urls, self.worker_num))
-                while True:
-                    try:
-                        feed_url, feed_data, crawler_hints = next(iterator)
-                        with stage:
-                            stage.feeds[urls[feed_url]] = feed_data
-                    except CrawlError:
+                self.crawling_queue.task_done(priority)
+            else:
+                urls = self.claim(arguments)
+                finished = set()
+                try:
+                    self.crawl_feeds(urls, finished)
+                except Exception as e:
+                    logger.exception(e)
+                finally:
+                    # Feed urls finished by crawl_feeds() may have been
+                    # queued again by other jobs since then
+                    for feed_url in urls:
+                        if feed_url not in finished:
+                            self.notify(feed_url)
+                            self.finish(feed_url, failed=True)
+                self.crawling_queue.task_done(priority)
+
+    def crawl_feeds(self, urls, finished):
+        """Crawl the feeds and write them.
+
+        :param urls: feed urls to their feed ids
+        :type urls: :class:`collections.Mapping`
+        :param finished: the set to add feed urls which have been finished
+                         to
+        :type finished: :class:`set`
+
+        """
+        with self.app.app_context():
+            with stage:
+                feeds = dict((feed_url, load_validators(stage, feed_id))
+                             for feed_url, feed_id in urls.items())
+            iterator = self.crawl(feeds)
+            while True:
+                try:
+                    feed_url, result, validators, size = next(iterator)
+                    if result is None:
+                        # Not modified; there's nothing to write.
+                        self.notify(feed_url, None,
+                                    validators.get('hints') or {})
+                        self.finish(feed_url, size=size)
+                        finished.add(feed_url)
                         continue
-                    except StopIteration:
-                        break
-                self.crawling_queue.task_done()
+                    feed_url, feed_data, crawler_hints = result
+                    feed_id = urls[feed_url]
+                    with self.get_feed_lock(feed_id):
+                        with stage:
+                            try:
+                                stored = feed_cache.get(stage, feed_id)
+                            except KeyError:
+                                stored = None
+                            merged = merge_feed(stored, feed_data)
+                            if merged is not None:
+                                feed_cache.store(stage, feed_id, merged)
+                            if validators != feeds[feed_url]:
+                                save_validators(stage, feed_id, validators)
+                        if merged is not None:
+                            # Count entries of the merged feed in advance.
+                            # They're indexed to the timeline as soon as
+                            # the feed is stored.
+                            with stage:
+                                feed_cache.get_counts(stage, feed_id)
+                    # Listeners are notified before jobs waiting on
+                    # the feed are done
+                    self.notify(feed_url, feed_data, crawler_hints or {})
+                    self.finish(feed_url, size=size)
+                    finished.add(feed_url)
+                except CrawlError as e:
+                    self.notify(e.feed_uri)
+                    self.finish(e.feed_uri, failed=True)
+                    finished.add(e.feed_uri)
+                    continue
+                except StopIteration:
+                    break
@@ -3,8 +3,11 @@
 
 """
 import re
+import zlib
 
-__all__ = 'MethodRewriteMiddleware',
+from werkzeug.http import parse_accept_header
+
+__all__ = 'GzipMiddleware', 'MethodRewriteMiddleware', 'accepts_gzip'
 
 
 class MethodRewriteMiddleware(object):
@@ -57,3 +60,158 @@ class MethodRewriteMiddleware(object):
                 environ = dict(environ)
                 environ['REQUEST_METHOD'] = match.group(1)
         return self.app(environ, start_response)
+
+
+def accepts_gzip(environ):
+    """Whether the client of the request accepts ``gzip`` content coding.
+
+    :param environ: the WSGI environment of the request
+    :type environ: :class:`collections.Mapping`
+    :returns: :const:`True` if ``Accept-Encoding`` allows ``gzip``
+    :rtype: :class:`bool`
+
+    """
+    encodings = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING'))
+    return encodings['gzip'] > 0 or \
+        'gzip' not in encodings and encodings['*'] > 0
+
+
+class GzipMiddleware(object):
+    """The WSGI middleware that compresses responses with ``gzip`` if
+    the client accepts it.  Only responses of textual types that are
+    large enough to benefit from compression are compressed, and
+    the response body is compressed chunk by chunk as the application
+    yields it, so that streaming responses keep streaming.
+
+    Responses that already have ``Content-Encoding`` e.g. precompressed
+    static files are passed through as they are.
+
+    Since a compressed response is a different representation from
+    the identity one, its strong ``ETag`` gets :attr:`ETAG_SUFFIX`.
+    The suffix is stripped from ``If-None-Match`` of requests, so that
+    the application can answer conditional requests for both
+    representations with its own etags.
+
+    :param app: WSGI application to wrap
+    :type app: :class:`collections.Callable`
+    :param min_size: responses with ``Content-Length`` smaller than this
+                     aren't compressed.  responses without
+                     ``Content-Length`` are always compressed
+    :type min_size: :class:`numbers.Integral`
+    :param compress_level: the zlib compression level from 1 to 9
+    :type compress_level: :class:`numbers.Integral`
+
+    """
+
+    #: (:class:`collections.Set`) The set of compressible mimetypes
+    #: besides ``text/*``, ``*+xml`` and ``*+json``.
+    MIMETYPES = frozenset([
+        'application/javascript', 'application/json',
+        'application/x-javascript', 'application/xml', 'image/svg+xml'
+    ])
+
+    #: (:class:`collections.Set`) The set of status codes that responses
+    #: of are never compressed.
+    EXCLUDED_STATUSES = frozenset(['204', '206', '304'])
+
+    #: (:class:`str`) The suffix appended to strong etags of compressed
+    #: responses.
+    ETAG_SUFFIX = '-gzip'
+
+    def __init__(self, app, min_size=512, compress_level=6):
+        self.app = app
+        self.min_size = min_size
+        self.compress_level = compress_level
+
+    def is_compressible(self, mimetype):
+        mimetype = mimetype.split(';', 1)[0].strip().lower()
+        return (mimetype.startswith('text/') or
+                mimetype.endswith(('+xml', '+json')) or
+                mimetype in self.MIMETYPES)
+
+    def add_etag_suffix(self, etag):
+        if etag.startswith('W/') or not etag.endswith('"'):
+            # Weak etags are shared by representations
+            return etag
+        return etag[:-1] + self.ETAG_SUFFIX + '"'
+
+    def replace_etag(self, headers):
+        return [(name, self.add_etag_suffix(value)
+                 if name.lower() == 'etag' else value)
+                for name, value in headers]
+
+    def __call__(self, environ, start_response):
+        if environ.get('REQUEST_METHOD', '').upper() == 'HEAD' or \
+           not accepts_gzip(environ):
+            return self.app(environ, start_response)
+        state = {}
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match and self.ETAG_SUFFIX in if_none_match:
+            environ = dict(environ)
+            environ['HTTP_IF_NONE_MATCH'] = if_none_match.replace(
+                self.ETAG_SUFFIX + '"', '"'
+            )
+
+        def start_gzip_response(status, headers, exc_info=None):
+            state['started'] = True
+            headers = list(headers)
+            names = dict((name.lower(), value) for name, value in headers)
+            etag = names.get('etag')
+            if status.startswith('304') and etag and \
+               self.add_etag_suffix(etag) in (if_none_match or ''):
+                # The client has validated the compressed representation
+                headers = self.replace_etag(headers)
+            compress = (
+                status[:3] not in self.EXCLUDED_STATUSES and
+                not status.startswith('1') and
+                'content-encoding' not in names and
+                self.is_compressible(names.get('content-type', '')) and
+                int(names.get('content-length', self.min_size)) >=
+                self.min_size
+            )
+            if self.is_compressible(names.get('content-type', '')):
+                vary = names.get('vary')
+                if not vary:
+                    headers.append(('Vary', 'Accept-Encoding'))
+                elif 'accept-encoding' not in vary.lower():
+                    headers = [(name, value) for name, value in headers
+                               if name.lower() != 'vary']
+                    headers.append(('Vary', vary + ', Accept-Encoding'))
+            if compress:
+                headers = [(name, value) for name, value in headers
+                           if name.lower() != 'content-length']
+                headers.append(('Content-Encoding', 'gzip'))
+                headers = self.replace_etag(headers)
+                compressor = zlib.compressobj(self.compress_level,
+                                              zlib.DEFLATED,
+                                              16 + zlib.MAX_WBITS)
+                state['compressor'] = compressor
+            write = start_response(status, headers, exc_info)
+            if not compress:
+                return write
+            return lambda data: write(compressor.compress(data) +
+                                      compressor.flush(zlib.Z_SYNC_FLUSH))
+
+        iterable = self.app(environ, start_gzip_response)
+        if state.get('started') and 'compressor' not in state:
+            return iterable
+        # The application may not have started the response yet if it
+        # calls start_response() lazily, so decide on the first chunk.
+        return self.compress(iterable, state)
+
+    def compress(self, iterable, state):
+        try:
+            for chunk in iterable:
+                compressor = state.get('compressor')
+                if compressor is None:
+                    yield chunk
+                elif chunk:
+                    yield (compressor.compress(chunk) +
+                           compressor.flush(zlib.Z_SYNC_FLUSH))
+            compressor = state.get('compressor')
+            if compressor is not None:
+                yield compressor.flush()
+        finally:
+            close = getattr(iterable, 'close', None)
+            if callable(close):
+                close()
@@ -41,7 +41,7 @@ install_requires = [
     'waitress'
 ]
 if sys.version_info < (2, 7):
-    install_requires.append('argparse >= 1.1')
+    install_requires.extend(['argparse >= 1.1', 'ordereddict'])
 install_requires.extend(setup_requires)
 
 
@@ -0,0 +1,33 @@
+import os
+import zlib
+
+from earthreader.web.assets import (compress_static_files,
+                                    find_compressed_file, get_file_hash)
+
+
+def test_compress_static_files(tmpdir):
+    tmpdir.join('js').mkdir()
+    script = tmpdir.join('js', 'master.js')
+    script.write(b'var earth = "reader";\n' * 100, 'wb')
+    tmpdir.join('js', 'tiny.js').write(b'1;', 'wb')
+    tmpdir.join('favicon.ico').write(b'\0' * 1000, 'wb')
+    assert compress_static_files(str(tmpdir)) == [str(script) + '.gz']
+    assert compress_static_files(str(tmpdir)) == []
+    compressed = find_compressed_file(str(script))
+    assert compressed == str(script) + '.gz'
+    with open(compressed, 'rb') as f:
+        data = zlib.decompress(f.read(), 16 + zlib.MAX_WBITS)
+    assert data == script.read(mode='rb')
+    os.utime(compressed, (0, 0))
+    assert find_compressed_file(str(script)) is None
+    assert find_compressed_file(str(tmpdir.join('js', 'tiny.js'))) is None
+
+
+def test_get_file_hash(tmpdir):
+    path = tmpdir.join('a.css')
+    path.write(b'a {}', 'wb')
+    file_hash = get_file_hash(str(path))
+    assert file_hash == get_file_hash(str(path))
+    path.write(b'b {}', 'wb')
+    os.utime(str(path), (1, 1))
+    assert get_file_hash(str(path)) != file_hash
@@ -0,0 +1,430 @@
+import datetime
+import threading
+import time
+
+from libearth.feed import Content
+from libearth.subscribe import Category, Subscription, SubscriptionList
+from pytest import fixture, mark, raises
+
+from earthreader.web.cache import (CachedFeed, ContentCache, FeedCache,
+                                   IteratorStore, SubscriptionCache,
+                                   estimate_feed_size, get_entry_key,
+                                   index_categories)
+from earthreader.web.exceptions import IteratorNotFound
+from earthreader.web.util import get_hash
+
+from .conftest import make_feed
+
+
+@fixture
+def fx_stage(fx_stage):
+    with fx_stage:
+        for feed_id in 'a', 'b', 'c':
+            fx_stage.feeds[feed_id] = make_feed(feed_id)
+    return fx_stage
+
+
+def test_feed_cache_hit(fx_stage):
+    cache = FeedCache()
+    with fx_stage:
+        feed = cache.get(fx_stage, 'a')
+        assert feed.id == 'a'
+        assert cache.get(fx_stage, 'a') is feed
+    assert len(cache) == 1
+
+
+def test_feed_cache_outdated(fx_stage):
+    cache = FeedCache()
+    with fx_stage:
+        feed = cache.get(fx_stage, 'a')
+    with fx_stage:
+        fx_stage.feeds['a'] = make_feed('a', entries=2)
+    with fx_stage:
+        updated = cache.get(fx_stage, 'a')
+    assert updated is not feed
+    assert len(updated.entries) == 2
+
+
+def test_feed_cache_store(fx_stage):
+    cache = FeedCache()
+    with fx_stage:
+        feed = cache.get(fx_stage, 'a')
+        feed.entries[0].read = True
+        cache.store(fx_stage, 'a', feed)
+        assert 'a' not in cache
+    with fx_stage:
+        assert cache.get(fx_stage, 'a').entries[0].read
+
+
+def test_feed_cache_key_error(fx_stage):
+    cache = FeedCache()
+    with fx_stage:
+        with raises(KeyError):
+            cache.get(fx_stage, 'does-not-exist')
+    assert not len(cache)
+
+
+def test_feed_cache_max_count(fx_stage):
+    cache = FeedCache(max_count=2)
+    with fx_stage:
+        cache.get(fx_stage, 'a')
+        cache.get(fx_stage, 'b')
+        cache.get(fx_stage, 'a')
+        cache.get(fx_stage, 'c')
+    assert 'a' in cache
+    assert 'b' not in cache
+    assert 'c' in cache
+
+
+def test_feed_cache_max_bytes(fx_stage):
+    cache = FeedCache(max_bytes=estimate_feed_size(make_feed('a')) + 1)
+    with fx_stage:
+        cache.get(fx_stage, 'a')
+        cache.get(fx_stage, 'b')
+    assert 'a' not in cache
+    assert 'b' in cache
+    assert cache.size <= cache.max_bytes
+    cache.clear()
+    assert not len(cache)
+    assert cache.size == 0
+
+
+def test_feed_cache_get_entry(fx_stage):
+    cache = FeedCache()
+    with fx_stage:
+        fx_stage.feeds['d'] = make_feed('d', entries=5)
+    with fx_stage:
+        feed, entry = cache.get_entry(fx_stage, 'd', get_hash('d/3/'))
+        assert entry.id == 'd/3/'
+        assert cache.get_entry(fx_stage, 'd', get_hash('d/3/'))[1] is entry
+        assert cache.get_entry(fx_stage, 'd', get_hash('d/9/')) == (feed, None)
+        with raises(KeyError):
+            cache.get_entry(fx_stage, 'does-not-exist', get_hash('d/3/'))
+
+
+def test_cached_feed_iter_entries():
+    feed = make_feed('a', entries=4)
+    for i, entry in enumerate(feed.entries):
+        entry.updated_at += datetime.timedelta(hours=i % 2)
+    cached = CachedFeed((), feed)
+    entries = list(cached.iter_entries())
+    assert sorted(entries, key=get_entry_key, reverse=True) == entries
+    assert [e.updated_at for e in entries] == sorted(
+        (e.updated_at for e in feed.entries), reverse=True)
+    for i, entry in enumerate(entries):
+        after = list(cached.iter_entries(get_entry_key(entry)))
+        assert after == entries[i + 1:]
+
+
+@mark.parametrize(('read', 'starred'), [
+    (None, None), (True, None), (False, None), (None, True), (None, False),
+    (True, True), (False, True), (True, False), (False, False)
+])
+def test_cached_feed_iter_entries_filter(read, starred):
+    feed = make_feed('a', entries=20)
+    for i, entry in enumerate(feed.entries):
+        entry.updated_at += datetime.timedelta(hours=i)
+        entry.read = i % 3 == 0
+        entry.starred = i % 4 == 0
+    cached = CachedFeed((), feed)
+
+    def match(entry):
+        return ((read is None or bool(entry.read) == read) and
+                (starred is None or bool(entry.starred) == starred))
+    entries = list(cached.iter_entries())
+    expected = [e for e in entries if match(e)]
+    assert list(cached.iter_entries(read=read, starred=starred)) == expected
+    after = get_entry_key(entries[7])
+    assert list(cached.iter_entries(after, read, starred)) == \
+        [e for e in entries[8:] if match(e)]
+
+
+def test_feed_cache_mark_updates_flags(fx_stage):
+    cache = FeedCache()
+    with fx_stage:
+        fx_stage.feeds['d'] = make_feed('d', entries=5)
+    with fx_stage:
+        cached = cache.load(fx_stage, 'd')
+    assert len(list(cached.iter_entries(read=False))) == 5
+    cache.mark(fx_stage, 'd', get_hash('d/2/'), read=True)
+    assert [e.id for e in cached.iter_entries(read=True)] == ['d/2/']
+    assert len(list(cached.iter_entries(read=False))) == 4
+
+
+@fixture
+def fx_flushing_cache(request, fx_stage):
+    cache = FeedCache(flush_threshold=3)
+    cache.start_flusher(3600, lambda: cache.flush(fx_stage))
+    request.addfinalizer(cache.stop_flusher)
+    return cache
+
+
+def test_feed_cache_mark_write_through(fx_stage):
+    cache = FeedCache()
+    entry = cache.mark(fx_stage, 'a', get_hash('a/0/'), read=True)
+    assert entry.read
+    assert not cache.pending
+    with fx_stage:
+        assert fx_stage.feeds['a'].entries[0].read
+    assert cache.mark(fx_stage, 'a', get_hash('a/9/'), read=True) is None
+    with raises(KeyError):
+        cache.mark(fx_stage, 'does-not-exist', get_hash('a/0/'), read=True)
+
+
+def test_feed_cache_mark_write_behind(fx_stage, fx_flushing_cache):
+    cache = fx_flushing_cache
+    cache.mark(fx_stage, 'a', get_hash('a/0/'), read=True)
+    cache.mark(fx_stage, 'a', get_hash('a/0/'), starred=True)
+    assert cache.get_last_marked_at('a')
+    assert cache.get_last_marked_at('b') is None
+    with fx_stage:
+        assert not fx_stage.feeds['a'].entries[0].read
+        cache.invalidate('a')
+        entry = cache.get(fx_stage, 'a').entries[0]
+        assert entry.read and entry.starred
+    cache.flush(fx_stage)
+    assert not cache.pending
+    with fx_stage:
+        entry = fx_stage.feeds['a'].entries[0]
+        assert entry.read and entry.starred
+
+
+def test_feed_cache_mark_threshold(fx_stage, fx_flushing_cache):
+    cache = fx_flushing_cache
+    cache.mark(fx_stage, 'a', get_hash('a/0/'), read=True)
+    cache.mark(fx_stage, 'b', get_hash('b/0/'), read=True)
+    assert len(cache.pending) == 2
+    cache.mark(fx_stage, 'c', get_hash('c/0/'), read=True)
+    for _ in range(50):
+        if not cache.pending:
+            break
+        time.sleep(0.1)
+    assert not cache.pending
+    with fx_stage:
+        for feed_id in 'a', 'b', 'c':
+            assert fx_stage.feeds[feed_id].entries[0].read
+
+
+def test_feed_cache_mark_stop_flusher(fx_stage, fx_flushing_cache):
+    cache = fx_flushing_cache
+    cache.mark(fx_stage, 'a', get_hash('a/0/'), read=True)
+    cache.stop_flusher()
+    assert not cache.is_flusher_running()
+    assert not cache.pending
+    with fx_stage:
+        assert fx_stage.feeds['a'].entries[0].read
+
+
+def test_feed_cache_store_applies_marks(fx_stage, fx_flushing_cache):
+    cache = fx_flushing_cache
+    cache.mark(fx_stage, 'a', get_hash('a/0/'), read=True)
+    with fx_stage:
+        cache.store(fx_stage, 'a', make_feed('a', entries=2))
+    assert not cache.pending
+    with fx_stage:
+        feed = fx_stage.feeds['a']
+        assert len(feed.entries) == 2
+        assert feed.entries[0].read
+
+
+def test_feed_cache_store_unlocked(fx_stage, fx_flushing_cache,
+                                   monkeypatch):
+    cache = fx_flushing_cache
+    cache.mark(fx_stage, 'a', get_hash('a/0/'), read=True)
+    writing = threading.Event()
+    written = threading.Event()
+    write = fx_stage.write
+
+    def blocking_write(key, document, merge=True):
+        if 'a' in key:
+            writing.set()
+            written.wait(5)
+        return write(key, document, merge)
+    monkeypatch.setattr(fx_stage, 'write', blocking_write)
+
+    def store():
+        with fx_stage:
+            cache.store(fx_stage, 'a', cache.get(fx_stage, 'a'))
+    thread = threading.Thread(target=store)
+    thread.start()
+    try:
+        assert writing.wait(5)
+        # Feeds can be read and marked while the feed is being written
+        cache.mark(fx_stage, 'b', get_hash('b/0/'), read=True)
+        cache.mark(fx_stage, 'a', get_hash('a/0/'), starred=True)
+        with fx_stage:
+            assert cache.get_counts(fx_stage, 'b') == (0, 0)
+    finally:
+        written.set()
+        thread.join(5)
+    # The mark made while writing is left to be written next time
+    assert list(cache.pending['a'][get_hash('a/0/')]) == ['starred']
+    cache.flush(fx_stage)
+    assert not cache.pending
+    with fx_stage:
+        entry = fx_stage.feeds['a'].entries[0]
+        assert entry.read and entry.starred
+
+
+def test_feed_cache_counts(fx_stage):
+    cache = FeedCache()
+    with fx_stage:
+        fx_stage.feeds['d'] = make_feed('d', entries=5)
+    with fx_stage:
+        assert cache.get_counts(fx_stage, 'd') == (5, 0)
+    cache.mark(fx_stage, 'd', get_hash('d/0/'), read=True, starred=True)
+    cache.clear()
+    with fx_stage:
+        assert cache.get_counts(fx_stage, 'd') == (4, 1)
+        assert 'd' not in cache
+    cache.mark(fx_stage, 'd', get_hash('d/0/'), read=True)
+    with fx_stage:
+        assert cache.get_counts(fx_stage, 'd') == (4, 1)
+        feed = cache.get(fx_stage, 'd')
+        for entry in feed.entries:
+            entry.read = True
+        cache.store(fx_stage, 'd', feed)
+    with fx_stage:
+        assert cache.get_counts(fx_stage, 'd') == (0, 1)
+    with fx_stage:
+        cache.store(fx_stage, 'd', make_feed('d', entries=7))
+    assert 'd' not in cache.counts
+    with fx_stage:
+        assert cache.get_counts(fx_stage, 'd') == (2, 1)
+    with fx_stage:
+        fx_stage.feeds['d'] = make_feed('d', entries=8)
+    with fx_stage:
+        assert cache.get_counts(fx_stage, 'd') == (3, 1)
+
+
+def test_feed_cache_counts_write_behind(fx_stage, fx_flushing_cache):
+    cache = fx_flushing_cache
+    with fx_stage:
+        assert cache.get_counts(fx_stage, 'a') == (1, 0)
+    cache.mark(fx_stage, 'a', get_hash('a/0/'), read=True, starred=True)
+    with fx_stage:
+        assert cache.get_counts(fx_stage, 'a') == (0, 1)
+    cache.mark(fx_stage, 'a', get_hash('a/0/'), starred=False)
+    cache.clear()
+    with fx_stage:
+        assert cache.get_counts(fx_stage, 'a') == (0, 0)
+    cache.flush(fx_stage)
+    with fx_stage:
+        assert cache.get_counts(fx_stage, 'a') == (0, 0)
+
+
+def make_subscriptions():
+    subscriptions = SubscriptionList()
+    one = Category(label='one', _title='one')
+    two = Category(label='two', _title='two')
+    subscriptions.add(one)
+    one.add(two)
+    subscriptions.add(Subscription(label='a', _title='a', feed_uri='http://a/',
+                                   feed_id=get_hash('http://a/')))
+    return subscriptions
+
+
+def test_index_categories():
+    subscriptions = make_subscriptions()
+    index = index_categories(subscriptions)
+    assert sorted(index) == [('one',), ('one', 'two')]
+    assert index['one', 'two'].label == 'two'
+
+
+def test_subscription_cache(fx_stage):
+    cache = SubscriptionCache()
+    with fx_stage:
+        subscriptions, categories = cache.load(fx_stage)
+        assert not len(subscriptions)
+        assert not categories
+        assert cache.load(fx_stage)[0] is not subscriptions
+        fx_stage.subscriptions = make_subscriptions()
+    with fx_stage:
+        subscriptions, categories = cache.load(fx_stage)
+        assert len(subscriptions) == 2
+        assert ('one', 'two') in categories
+        assert cache.load(fx_stage)[0] is subscriptions
+    with fx_stage:
+        fresh, fresh_categories = cache.load(fx_stage, fresh=True)
+        assert fresh is not subscriptions
+        fresh_categories['one', 'two'].add(Category(label='three'))
+        # The cached one is left as it is until it's stored
+        assert ('one', 'two', 'three') not in cache.load(fx_stage)[1]
+        cache.store(fx_stage, fresh)
+        assert cache.cached is None
+    with fx_stage:
+        subscriptions, categories = cache.load(fx_stage)
+        assert ('one', 'two', 'three') in categories
+    with fx_stage:
+        fx_stage.subscriptions = make_subscriptions()
+    with fx_stage:
+        assert cache.load(fx_stage)[0] is not subscriptions
+
+
+def test_iterator_store():
+    store = IteratorStore(max_count=2)
+    it = iter(range(10))
+    store.put('a', it, 'cursor-a', size=100)
+    store.put('b', iter(range(10)), 'cursor-b', size=10)
+    assert store.size == 110
+    assert store.get_sizes() == {'a': 100, 'b': 10}
+    with raises(IteratorNotFound):
+        store.pop('a', 'other-cursor')
+    assert 'a' not in store
+    store.put('a', it, 'cursor-a', size=100)
+    assert store.pop('a', 'cursor-a') is it
+    with raises(IteratorNotFound):
+        store.pop('a', 'cursor-a')
+    store.put('a', it, 'cursor-a', size=100)
+    store.put('c', iter(range(10)), 'cursor-c', size=1)
+    assert 'b' not in store
+    assert len(store) == 2
+    assert store.size == 101
+    store.clear()
+    assert not len(store)
+    assert store.size == 0
+
+
+def test_iterator_store_ttl():
+    store = IteratorStore(ttl=0.2)
+    store.put('a', iter(range(10)), 'cursor-a', size=100)
+    time.sleep(0.3)
+    store.put('b', iter(range(10)), 'cursor-b', size=10)
+    assert 'a' not in store
+    assert store.size == 10
+
+
+def test_content_cache():
+    cache = ContentCache(max_bytes=20)
+    content = Content(type='html', value='<p onclick="x">a</p>')
+    html = cache.get('a', 'e', content)
+    assert html == '<p>a</p>'
+    assert cache.get('a', 'e', content) is html
+    assert len(cache) == 1
+    content.value = '<p>b</p>'
+    assert cache.get('a', 'e', content) == '<p>b</p>'
+    assert len(cache) == 2
+    cache.get('a', 'f', Content(type='text', value='c' * 10))
+    assert len(cache) == 2
+    assert cache.size <= cache.max_bytes
+
+
+def test_content_cache_persist(tmpdir):
+    cache = ContentCache(persist=str(tmpdir))
+    content = Content(type='html', value='<p onclick="x">a</p>')
+    assert cache.get('a', 'e', content) == '<p>a</p>'
+    digest = get_hash(content.type + '\n' + content.value)
+    path = tmpdir.join('a', 'e', digest + '.html')
+    assert path.check()
+    path.write('<p>persisted</p>')
+    assert ContentCache(persist=str(tmpdir)).get('a', 'e', content) == \
+        '<p>persisted</p>'
+    assert ContentCache().get('a', 'e', content) == '<p>a</p>'
+    # Stale contents of the entry are removed
+    content.value = '<p>b</p>'
+    assert cache.get('a', 'e', content) == '<p>b</p>'
+    assert not path.check()
+    assert len(tmpdir.join('a', 'e').listdir()) == 1
+    cache.discard('a')
+    assert not tmpdir.join('a').check()
+    assert len(cache) == 0 and cache.size == 0
@@ -0,0 +1,128 @@
+import datetime
+import numbers
+import sys
+import threading
+
+from libearth.feed import Entry, Feed, Person, Text
+from libearth.repository import FileSystemRepository
+from libearth.session import Session
+from libearth.stage import Stage
+from libearth.tz import utc
+from pytest import fixture, mark
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+
+
+#: (:class:`bool`) Whether the asyncio crawl engine is available.
+#: See also :func:`earthreader.web.crawler.get_engine()`.
+ASYNCIO_AVAILABLE = (3, 4) <= sys.version_info < (3, 11)
+
+asyncio_only = mark.skipif(not ASYNCIO_AVAILABLE,
+                           reason='asyncio crawl engine requires Python 3.4 '
+                                  'to 3.10')
+
+#: (:class:`datetime.datetime`) The time feeds made by :func:`make_feed()`
+#: are updated at.
+UPDATED_AT = datetime.datetime(2013, 10, 30, 20, 55, 30, tzinfo=utc)
+
+
+def make_feed(feed_id, entries=1, hours=0, offset=0):
+    """Make a feed of ``feed_id`` which has entries of ids like
+    ``'<feed_id>/<key>/'``.
+
+    :param feed_id: the feed id
+    :type feed_id: :class:`str`
+    :param entries: the number of entries of which keys are their indices,
+                    or pairs of entry keys and hours after
+                    :const:`UPDATED_AT` when they're updated
+    :type entries: :class:`numbers.Integral`, :class:`collections.Sequence`
+    :param hours: hours between updates of the numbered entries
+    :type hours: :class:`numbers.Real`
+    :param offset: hours after :const:`UPDATED_AT` when the first of
+                   the numbered entries is updated
+    :type offset: :class:`numbers.Real`
+    :returns: the feed
+    :rtype: :class:`~libearth.feed.Feed`
+
+    """
+    if isinstance(entries, numbers.Integral):
+        entries = [(str(i), offset + hours * i) for i in range(entries)]
+    authors = [Person(name='vio')]
+    feed = Feed(id=feed_id, authors=authors, title=Text(value=feed_id),
+                updated_at=UPDATED_AT)
+    for key, hour in entries:
+        feed.entries.append(
+            Entry(id='{0}/{1}/'.format(feed_id, key), authors=authors,
+                  title=Text(value=key),
+                  updated_at=UPDATED_AT + datetime.timedelta(hours=hour))
+        )
+    return feed
+
+
+class Subscription(object):
+    """Stand-in of :class:`libearth.subscribe.Subscription`."""
+
+    def __init__(self, feed_id, feed_uri=None):
+        self.feed_id = feed_id
+        self.feed_uri = feed_uri or 'http://example.com/' + feed_id
+
+
+class Cursor(object):
+    """Stand-in of :class:`earthreader.web.Cursor` which has the given
+    subscriptions.  Feed ids are also accepted instead of
+    :class:`Subscription` objects.
+
+    """
+
+    def __init__(self, *subscriptions):
+        self.recursive_subscriptions = [
+            subscription if isinstance(subscription, Subscription)
+            else Subscription(subscription)
+            for subscription in subscriptions
+        ]
+
+
+@fixture
+def fx_stage(tmpdir):
+    """An empty stage.  Test modules which need feeds in it override this
+    fixture to write them.
+
+    """
+    return Stage(Session('test'), FileSystemRepository(str(tmpdir)))
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """Base request handler of :func:`serve()` which doesn't log."""
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def serve(request, handler_class):
+    """Start a local HTTP server which stands in for feed hosts.  It's shut
+    down when the test of the ``request`` finishes.
+
+    :param request: the request of the fixture
+    :param handler_class: the subclass of :class:`RequestHandler` to serve
+    :returns: the running server which has ``base_url`` and ``url``
+    :rtype: :class:`StandInServer`
+
+    """
+    server = StandInServer(('127.0.0.1', 0), handler_class)
+    server.base_url = server.url = \
+        'http://127.0.0.1:{0}/'.format(server.server_port)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    def shutdown():
+        server.shutdown()
+        server.server_close()
+    request.addfinalizer(shutdown)
+    return server
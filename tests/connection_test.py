@@ -0,0 +1,148 @@
+import threading
+import time
+
+from pytest import fixture, mark, skip
+
+from earthreader.web.connection import ConnectionPool
+from earthreader.web.crawler import get_engine
+
+from .conftest import ASYNCIO_AVAILABLE, RequestHandler, asyncio_only, serve
+
+
+rss_feed = b'''<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0">
+<channel>
+    <title>Keep-alive Feed</title>
+    <link>http://example.com/</link>
+    <description>Stand-in feed for keep-alive connections</description>
+    <item>
+        <title>Entry</title>
+        <link>http://example.com/1/</link>
+        <guid>http://example.com/1/</guid>
+        <pubDate>Tue, 30 Sep 2014 01:00:00 GMT</pubDate>
+    </item>
+</channel>
+</rss>
+'''
+
+
+class KeepAliveHandler(RequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        RequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        time.sleep(server.delay)
+        with server.lock:
+            server.active -= 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/rss+xml')
+        self.send_header('Content-Length', str(len(rss_feed)))
+        self.end_headers()
+        self.wfile.write(rss_feed)
+        if server.drop:
+            # Close the connection without telling the client
+            self.close_connection = True
+
+
+@fixture
+def fx_server(request):
+    server = serve(request, KeepAliveHandler)
+    server.lock = threading.Lock()
+    server.connections = server.requests = 0
+    server.active = server.max_active = 0
+    server.delay = 0
+    server.drop = False
+    return server
+
+
+@fixture
+def fx_pool(request):
+    pool = ConnectionPool()
+    request.addfinalizer(pool.clear)
+    return pool
+
+
+def test_keep_alive(fx_server, fx_pool):
+    for i in range(3):
+        assert fx_pool.open(fx_server.url + str(i)).read() == rss_feed
+    assert fx_server.connections == 1
+    stats = fx_pool.get_stats()
+    assert (stats['requests'], stats['connections'], stats['reused']) == \
+        (3, 1, 2)
+    host = '127.0.0.1:{0}'.format(fx_server.server_port)
+    assert stats['hosts'][host]['reused'] == 2
+
+
+def test_closed_idle_connection(fx_server, fx_pool):
+    fx_server.drop = True
+    assert fx_pool.open(fx_server.url).read() == rss_feed
+    time.sleep(0.1)
+    assert fx_pool.open(fx_server.url).read() == rss_feed
+    assert fx_server.connections == 2
+    assert fx_pool.get_stats()['connections'] == 2
+
+
+def test_host_concurrency(fx_server, fx_pool):
+    fx_pool.max_connections = 2
+    fx_server.delay = 0.05
+
+    def open_url():
+        fx_pool.open(fx_server.url).read()
+    threads = [threading.Thread(target=open_url) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert fx_server.requests == 6
+    assert fx_server.max_active == 2
+    assert fx_server.connections == 2
+
+
+def test_host_interval(fx_server, fx_pool):
+    fx_pool.interval = 0.05
+    started_at = time.time()
+    for _ in range(5):
+        fx_pool.open(fx_server.url).read()
+    assert time.time() - started_at >= 0.2
+    assert fx_pool.get_stats()['throttled'] >= 4
+
+
+@mark.parametrize('engine', ['threads', 'asyncio'])
+def test_crawl_engine_connections(fx_server, fx_pool, engine):
+    if engine == 'asyncio' and not ASYNCIO_AVAILABLE:
+        skip('asyncio crawl engine requires Python 3.4 to 3.10')
+    fx_pool.max_connections = 2
+    fx_server.delay = 0.02
+    crawl = get_engine(engine)
+    feeds = dict((fx_server.url + '{0}.xml'.format(i), {}) for i in range(10))
+    results = list(crawl(feeds, 10, connections=fx_pool))
+    assert len(results) == 10
+    assert fx_server.max_active <= 2
+    assert fx_server.connections == 2
+    stats = fx_pool.get_stats()
+    assert (stats['requests'], stats['reused']) == (10, 8)
+
+
+@asyncio_only
+def test_asyncio_engine_queueing_timeout(fx_server, fx_pool):
+    fx_pool.max_connections = 2
+    fx_server.delay = 0.1
+    crawl = get_engine('asyncio')
+    feeds = dict((fx_server.url + '{0}.xml'.format(i), {}) for i in range(12))
+    # Requests wait for the host longer than the timeout, but it doesn't
+    # count waiting time
+    started_at = time.time()
+    results = list(crawl(feeds, 12, timeout=0.3, connections=fx_pool))
+    assert time.time() - started_at >= 0.5
+    assert len(results) == 12
+    assert fx_server.max_active <= 2
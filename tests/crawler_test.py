@@ -0,0 +1,309 @@
+import gzip
+import io
+import time
+
+from flask import Flask
+from libearth.feed import Text
+from libearth.crawler import CrawlError
+from pytest import fixture, mark, raises, skip
+
+from earthreader.web.cache import FeedCache
+from earthreader.web.connection import ConnectionPool
+from earthreader.web.crawler import (ENGINES, diff_entries, fetch_feed,
+                                     get_engine, load_validators, merge_feed,
+                                     parse_feed, save_validators)
+from earthreader.web.scheduler import parse_skip_days, parse_skip_hours
+from earthreader.web.worker import Worker
+
+from .conftest import (ASYNCIO_AVAILABLE, Cursor, RequestHandler,
+                       Subscription, asyncio_only, make_feed, serve)
+
+
+rss_feed = b'''<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0">
+<channel>
+    <title>Stand-in Feed</title>
+    <link>http://example.com/</link>
+    <description>Stand-in feed for conditional requests</description>
+    <ttl>60</ttl>
+    <item>
+        <title>Entry {0}</title>
+        <link>http://example.com/{0}/</link>
+        <guid>http://example.com/{0}/</guid>
+        <pubDate>Tue, 30 Sep 2014 0{0}:00:00 GMT</pubDate>
+    </item>
+</channel>
+</rss>
+'''
+
+
+class FeedHandler(RequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers.items()))
+        if server.delay:
+            time.sleep(server.delay)
+        if self.path == '/redirect':
+            self.send_response(302)
+            self.send_header('Location', '/feed.xml')
+            self.end_headers()
+            return
+        elif self.path.startswith('/missing'):
+            self.send_response(404)
+            self.end_headers()
+            return
+        etag = '"v{0}{1}"'.format(server.version, server.salt)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = rss_feed.replace(b'{0}', str(server.version).encode())
+        self.send_response(200)
+        if self.path == '/gzip' and \
+           'gzip' in self.headers.get('Accept-Encoding', ''):
+            buffer_ = io.BytesIO()
+            with gzip.GzipFile(fileobj=buffer_, mode='wb') as f:
+                f.write(body)
+            body = buffer_.getvalue()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Type', 'application/rss+xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@fixture
+def fx_server(request):
+    server = serve(request, FeedHandler)
+    server.version = 1
+    server.delay = 0
+    server.salt = ''
+    server.requests = []
+    server.url = server.base_url + 'feed.xml'
+    return server
+
+
+def test_fetch_feed(fx_server):
+    result, validators, size = fetch_feed(fx_server.url)
+    assert size > 0
+    assert result.feed.entries[0].title.value == 'Entry 1'
+    assert validators['etag'] == '"v1"'
+    assert validators['hints']['ttl'] == '60'
+    assert 'If-None-Match' not in fx_server.requests[-1]
+    assert fetch_feed(fx_server.url, validators) == (None, validators, 0)
+    assert fx_server.requests[-1]['If-None-Match'] == '"v1"'
+    fx_server.version = 2
+    result, new_validators, _ = fetch_feed(fx_server.url, validators)
+    assert result.feed.entries[0].title.value == 'Entry 2'
+    assert new_validators['etag'] == '"v2"'
+
+
+def test_validators(fx_stage):
+    with fx_stage:
+        assert load_validators(fx_stage, 'feed') == {}
+        save_validators(fx_stage, 'feed', {'etag': '"v1"'})
+    with fx_stage:
+        assert load_validators(fx_stage, 'feed') == {'etag': '"v1"'}
+
+
+def test_worker_not_modified(fx_server, fx_stage):
+    app = Flask(__name__)
+    app.config.update(STAGE=fx_stage, CRAWLER_THREAD=1, WORKER_POOL_SIZE=1)
+    worker = Worker(app)
+    crawled = []
+    worker.add_listener(lambda *args: crawled.append(args))
+    cursor = Cursor(Subscription('feed', fx_server.url))
+    worker.start_worker()
+    try:
+        assert worker.add_job(cursor, None).wait(5)
+        with fx_stage:
+            revisions = FeedCache().get_revisions(fx_stage, 'feed')
+            assert load_validators(fx_stage, 'feed')['etag'] == '"v1"'
+        assert crawled[-1][1] is not None
+        assert worker.add_job(cursor, None).wait(5)
+        assert crawled[-1][1:] == (None, {'ttl': '60'})
+        with fx_stage:
+            assert FeedCache().get_revisions(fx_stage, 'feed') == revisions
+        assert len(fx_server.requests) == 2
+    finally:
+        worker.kill_worker()
+
+
+def test_parse_feed_skip_hints():
+    feed_xml = rss_feed.replace(b'<ttl>60</ttl>', b'''<ttl>60</ttl>
+    <skipHours><hour>0</hour><hour> 23 </hour></skipHours>
+    <skipDays><day>Saturday</day><day>Sunday</day></skipDays>''')
+    feed_xml = feed_xml.replace(b'{0}', b'1')
+    result, validators, _ = parse_feed('http://example.com/feed.xml',
+                                       feed_xml, {})
+    _, _, crawler_hints = result
+    assert crawler_hints['ttl'] == '60'
+    assert parse_skip_hours(crawler_hints) == frozenset([0, 23])
+    assert parse_skip_days(crawler_hints) == frozenset([5, 6])
+    # Kept for feeds not modified
+    assert parse_skip_hours(validators['hints']) == frozenset([0, 23])
+    result, validators, _ = parse_feed('http://example.com/feed.xml',
+                                       rss_feed.replace(b'{0}', b'1'), {})
+    assert 'skipHours' not in validators['hints']
+
+
+def test_merge_feed():
+    stored = make_feed('feed', [('a', 1), ('b', 2)])
+    stored.entries[0].read = True
+    stored.entries[1].starred = True
+    fetched = make_feed('feed', [('a', 1), ('b', 2)])
+    assert diff_entries(stored, fetched) == ([], [])
+    assert merge_feed(stored, fetched) is None
+    fetched = make_feed('feed', [('b', 3), ('c', 4)])
+    new, modified = diff_entries(stored, fetched)
+    assert [entry.id for entry in new] == ['feed/c/']
+    assert [entry.id for entry in modified] == ['feed/b/']
+    merged = merge_feed(stored, fetched)
+    assert [entry.id for entry in merged.entries] == [
+        'feed/b/', 'feed/c/', 'feed/a/'
+    ]
+    b, c, a = merged.entries
+    assert a is stored.entries[0] and a.read
+    assert b.updated_at == fetched.entries[0].updated_at
+    assert b.starred and not b.read
+    assert c.read is None
+    renamed = make_feed('feed', [('a', 1), ('b', 2)])
+    renamed.title = Text(value='Renamed')
+    assert merge_feed(stored, renamed) is renamed
+    assert merge_feed(None, fetched) is fetched
+
+
+def test_worker_no_changes(fx_server, fx_stage):
+    app = Flask(__name__)
+    app.config.update(STAGE=fx_stage, CRAWLER_THREAD=1, WORKER_POOL_SIZE=1)
+    worker = Worker(app)
+    cursor = Cursor(Subscription('feed', fx_server.url))
+    worker.start_worker()
+    try:
+        assert worker.add_job(cursor, None).wait(5)
+        with fx_stage:
+            revisions = FeedCache().get_revisions(fx_stage, 'feed')
+        # Modified according to the server, but not actually
+        fx_server.salt = '-1'
+        assert worker.add_job(cursor, None).wait(5)
+        with fx_stage:
+            assert FeedCache().get_revisions(fx_stage, 'feed') == revisions
+            assert load_validators(fx_stage, 'feed')['etag'] == '"v1-1"'
+        fx_server.version = 2
+        assert worker.add_job(cursor, None).wait(5)
+        with fx_stage:
+            assert FeedCache().get_revisions(fx_stage, 'feed') != revisions
+            titles = [entry.title.value
+                      for entry in fx_stage.feeds['feed'].entries]
+        assert sorted(titles) == ['Entry 1', 'Entry 2']
+    finally:
+        worker.kill_worker()
+
+
+@mark.parametrize('engine', ENGINES)
+def test_crawl_engines(fx_server, engine):
+    if engine == 'asyncio' and not ASYNCIO_AVAILABLE:
+        skip('asyncio crawl engine requires Python 3.4 to 3.10')
+    crawl = get_engine(engine)
+    feeds = {
+        fx_server.url: {},
+        fx_server.base_url + 'redirect': {},
+        fx_server.base_url + 'gzip': {},
+        fx_server.base_url + 'not-modified.xml': {'etag': '"v1"'},
+        fx_server.base_url + 'missing': {},
+        fx_server.base_url + 'missing-2': {}
+    }
+    results = {}
+    errors = []
+    iterator = crawl(feeds, 4)
+    while True:
+        try:
+            feed_url, result, validators, size = next(iterator)
+        except CrawlError as e:
+            errors.append(e.feed_uri)
+        except StopIteration:
+            break
+        else:
+            results[feed_url] = result, validators, size
+    assert sorted(errors) == [fx_server.base_url + 'missing',
+                              fx_server.base_url + 'missing-2']
+    not_modified = results.pop(fx_server.base_url + 'not-modified.xml')
+    assert not_modified == (None, {'etag': '"v1"'}, 0)
+    assert len(results) == 3
+    for result, validators, size in results.values():
+        assert result.feed.entries[0].title.value == 'Entry 1'
+        assert validators['etag'] == '"v1"'
+        assert size > 0
+    headers = fx_server.requests[-1]
+    assert headers.get('User-Agent', '').startswith('libearth/')
+
+
+def test_get_engine():
+    assert 'threads' in ENGINES
+    with raises(ValueError):
+        get_engine('does-not-exist')
+    if not ASYNCIO_AVAILABLE:
+        with raises(ValueError):
+            get_engine('asyncio')
+
+
+@asyncio_only
+def test_asyncio_engine_concurrency(fx_server):
+    """Benchmarks engines against the stand-in server of slow feeds."""
+    fx_server.delay = 0.2
+    feeds = dict((fx_server.base_url + '{0}.xml'.format(i), {})
+                 for i in range(40))
+    elapsed = {}
+    for engine in ENGINES:
+        started_at = time.time()
+        concurrency = 4 if engine == 'threads' else 40
+        # Every feed is on the same host of the stand-in server
+        connections = ConnectionPool(max_connections=concurrency)
+        results = list(get_engine(engine)(feeds, concurrency,
+                                          connections=connections))
+        elapsed[engine] = time.time() - started_at
+        assert len(results) == len(feeds)
+    # 10 rounds of 4 fetches vs. a single round of 40 fetches
+    assert elapsed['asyncio'] * 3 < elapsed['threads']
+
+
+@asyncio_only
+def test_asyncio_engine_failure(monkeypatch):
+    from earthreader.web import aiocrawler
+
+    def fail(*args):
+        raise TypeError('broken engine')
+    monkeypatch.setattr(aiocrawler, 'HostConnections', fail)
+    feed_urls = ['http://example.com/a', 'http://example.com/b']
+    iterator = aiocrawler.crawl(dict((url, {}) for url in feed_urls), 4)
+    errors = []
+    for _ in feed_urls:
+        with raises(CrawlError) as e:
+            next(iterator)
+        assert 'broken engine' in str(e.value)
+        errors.append(e.value.feed_uri)
+    assert sorted(errors) == feed_urls
+    with raises(StopIteration):
+        next(iterator)
+
+
+@asyncio_only
+def test_worker_asyncio_engine(fx_server, fx_stage):
+    app = Flask(__name__)
+    app.config.update(STAGE=fx_stage, CRAWLER_THREAD=1, WORKER_POOL_SIZE=1,
+                      CRAWL_ENGINE='asyncio', CRAWL_CONCURRENCY=10)
+    worker = Worker(app)
+    cursor = Cursor(Subscription('feed', fx_server.url))
+    worker.start_worker()
+    try:
+        job = worker.add_job(cursor, None)
+        assert job.wait(5)
+        assert (job.crawled, job.failed) == (1, 0)
+        with fx_stage:
+            assert load_validators(fx_stage, 'feed')['etag'] == '"v1"'
+            entries = fx_stage.feeds['feed'].entries
+            assert entries[0].title.value == 'Entry 1'
+    finally:
+        worker.kill_worker()
@@ -0,0 +1,106 @@
+import datetime
+import time
+
+from pytest import fixture, mark
+
+from earthreader.web.scheduler import (Scheduler, estimate_interval,
+                                       parse_skip_days, parse_skip_hours,
+                                       parse_ttl)
+from earthreader.web.worker import BACKGROUND_PRIORITY
+
+from .conftest import Subscription, make_feed
+
+
+class FakeWorker(object):
+
+    def __init__(self):
+        self.listeners = []
+        self.jobs = []
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def add_feeds(self, urls, caller=None, priority=None):
+        assert priority == BACKGROUND_PRIORITY
+        self.jobs.append(sorted(urls.values()))
+        return urls
+
+
+@fixture
+def fx_scheduler():
+    return Scheduler(FakeWorker(), min_interval=60, max_interval=24 * 3600,
+                     rate_limit=2, jitter=0)
+
+
+def test_parse_crawler_hints():
+    hints = {'ttl': ' 60 ', 'skipHours': '\n 0\n 23 ',
+             'skipDays': 'Saturday Sunday Caturday'}
+    assert parse_ttl(hints) == 3600
+    assert parse_skip_hours(hints) == frozenset([0, 23])
+    assert parse_skip_days(hints) == frozenset([5, 6])
+    assert parse_ttl({}) is None
+    assert parse_ttl({'ttl': 'soon'}) is None
+    assert parse_skip_hours({}) == frozenset()
+    assert parse_skip_days({}) == frozenset()
+
+
+def test_estimate_interval():
+    assert estimate_interval(make_feed('a', 0, hours=-1)) is None
+    assert estimate_interval(make_feed('a', 1, hours=-1)) is None
+    assert estimate_interval(make_feed('a', 5, hours=-1)) == 3600
+
+
+def test_scheduler_dispatch(fx_scheduler):
+    subscriptions = [Subscription(feed_id) for feed_id in 'abc']
+    now = time.time()
+    assert fx_scheduler.dispatch(subscriptions, now) is None
+    assert len(fx_scheduler.dispatch(subscriptions, now + 60)) == 2
+    # rate limited
+    assert fx_scheduler.dispatch(subscriptions, now + 60) is None
+    assert fx_scheduler.dispatch(subscriptions, now + 90)
+    assert sum(len(job) for job in fx_scheduler.worker.jobs) == 3
+    # already queued
+    assert fx_scheduler.dispatch(subscriptions, now + 180) is None
+    # unsubscribed
+    fx_scheduler.dispatch(subscriptions[:1], now + 180)
+    assert list(fx_scheduler.schedules) == ['http://example.com/a']
+
+
+def test_scheduler_adapt(fx_scheduler):
+    fx_scheduler.dispatch([Subscription('a')], 0)
+    schedule = fx_scheduler.schedules['http://example.com/a']
+    feed = make_feed('a', 5, hours=-1)
+    fx_scheduler.crawled(schedule.feed_url, feed, {}, now=0)
+    assert schedule.interval == 3600
+    assert schedule.dispatched_at is None
+    fx_scheduler.crawled(schedule.feed_url, feed, {}, now=0)
+    assert schedule.interval == 3600 * fx_scheduler.backoff
+    fx_scheduler.crawled(schedule.feed_url,
+                         make_feed('a', 5, hours=-1, offset=1), {}, now=0)
+    assert schedule.interval == 3600
+    # not modified
+    fx_scheduler.crawled(schedule.feed_url, None, {}, now=0)
+    assert schedule.interval == 3600 * fx_scheduler.backoff
+    assert schedule.failures == 0
+    fx_scheduler.crawled(schedule.feed_url, make_feed('a', 2, hours=-1),
+                         {'ttl': '240'}, now=0)
+    assert schedule.interval == 4 * 3600
+    assert schedule.next_crawl_at == 4 * 3600
+    fx_scheduler.crawled(schedule.feed_url, None, None, now=0)
+    assert schedule.interval == 2 * fx_scheduler.min_interval
+    assert schedule.failures == 1
+
+
+@mark.parametrize(('hints', 'expected'), [
+    ({}, datetime.datetime(2014, 1, 4, 5, 30)),
+    ({'skipHours': '5 6'}, datetime.datetime(2014, 1, 4, 7)),
+    ({'skipDays': 'Saturday'}, datetime.datetime(2014, 1, 5)),
+])
+def test_scheduler_skip(fx_scheduler, hints, expected):
+    # 2014-01-04 is Saturday
+    epoch = datetime.datetime(1970, 1, 1)
+    timestamp = (datetime.datetime(2014, 1, 4, 5, 30) - epoch).days * 86400
+    timestamp += 5 * 3600 + 30 * 60
+    timestamp = fx_scheduler.skip(timestamp, parse_skip_hours(hints),
+                                  parse_skip_days(hints))
+    assert datetime.datetime.utcfromtimestamp(timestamp) == expected
@@ -0,0 +1,149 @@
+import os
+
+from pytest import fixture
+
+from earthreader.web.cache import FeedCache
+from earthreader.web.timeline import Timeline
+from earthreader.web.util import get_hash
+
+from .conftest import make_feed
+
+
+@fixture
+def fx_stage(fx_stage):
+    with fx_stage:
+        fx_stage.feeds['a'] = make_feed('a', 3, hours=2)
+        fx_stage.feeds['b'] = make_feed('b', 3, hours=2, offset=1)
+    return fx_stage
+
+
+def row_ids(rows):
+    return [(feed_id, entry_id) for _, entry_id, feed_id, _, _ in rows]
+
+
+def test_timeline_iter_rows(fx_stage):
+    timeline = Timeline(FeedCache())
+    with fx_stage:
+        assert timeline.update(fx_stage, ['a', 'b', 'c']) == 3
+        assert timeline.update(fx_stage, ['a', 'b', 'c']) == 0
+    rows = list(timeline.iter_rows(frozenset(['a', 'b'])))
+    assert row_ids(rows) == [
+        (feed_id, get_hash('{0}/{1}/'.format(feed_id, i)))
+        for i in (2, 1, 0) for feed_id in ('b', 'a')
+    ]
+    assert row_ids(timeline.iter_rows(frozenset(['a']))) == [
+        ('a', get_hash('a/{0}/'.format(i))) for i in (2, 1, 0)
+    ]
+    after = rows[2][:2]
+    assert list(timeline.iter_rows(frozenset(['a', 'b']), after)) == rows[3:]
+
+
+def test_timeline_mark(fx_stage):
+    timeline = Timeline(FeedCache())
+    with fx_stage:
+        timeline.update(fx_stage, ['a', 'b'])
+    timeline.mark('a', get_hash('a/1/'), read=True)
+    timeline.mark('b', get_hash('b/0/'), starred=True)
+    timeline.mark('b', get_hash('does-not-exist'), starred=True)
+    feed_ids = frozenset(['a', 'b'])
+    assert row_ids(timeline.iter_rows(feed_ids, read=True)) == [
+        ('a', get_hash('a/1/'))
+    ]
+    assert len(list(timeline.iter_rows(feed_ids, read=False))) == 5
+    assert row_ids(timeline.iter_rows(feed_ids, starred=True)) == [
+        ('b', get_hash('b/0/'))
+    ]
+
+
+def test_timeline_outdated(fx_stage):
+    timeline = Timeline(FeedCache())
+    with fx_stage:
+        timeline.update(fx_stage, ['a', 'b'])
+    with fx_stage:
+        fx_stage.feeds['a'] = make_feed('a', 5, hours=2)
+    with fx_stage:
+        assert timeline.update(fx_stage, ['a', 'b']) == 1
+    assert len(list(timeline.iter_rows(frozenset(['a'])))) == 5
+    assert len(list(timeline.iter_rows(frozenset(['a', 'b'])))) == 8
+
+
+def test_timeline_persist(fx_stage, tmpdir_factory):
+    persist = str(tmpdir_factory.mktemp('timelines'))
+    timeline = Timeline(FeedCache(), persist=persist)
+    with fx_stage:
+        assert timeline.rebuild(fx_stage, ['a', 'b']) == 2
+    timeline.mark('a', get_hash('a/1/'), read=True)
+    timeline.save(fx_stage)
+    assert not timeline.dirty
+    assert os.listdir(persist) == ['test.json']
+    assert '.earthreader-web' not in fx_stage.repository.list([])
+    loaded = Timeline(FeedCache(), persist=persist)
+    with fx_stage:
+        assert loaded.update(fx_stage, ['a', 'b']) == 0
+    assert loaded.rows == timeline.rows
+    assert row_ids(loaded.iter_rows(frozenset(['a', 'b']), read=True)) == [
+        ('a', get_hash('a/1/'))
+    ]
+
+
+def test_timeline_not_persisted(fx_stage):
+    timeline = Timeline(FeedCache())
+    with fx_stage:
+        assert timeline.rebuild(fx_stage, ['a', 'b']) == 2
+    assert timeline.dirty
+    timeline.save(fx_stage)
+    assert '.earthreader-web' not in fx_stage.repository.list([])
+    loaded = Timeline(FeedCache())
+    with fx_stage:
+        assert loaded.refresh(fx_stage, ['a', 'b']) == 2
+    assert loaded.rows == timeline.rows
+
+
+class CountingFeedCache(FeedCache):
+
+    def __init__(self):
+        super(CountingFeedCache, self).__init__()
+        self.revision_reads = 0
+
+    def get_revisions(self, stage, feed_id):
+        self.revision_reads += 1
+        return super(CountingFeedCache, self).get_revisions(stage, feed_id)
+
+
+def test_timeline_refresh(fx_stage):
+    cache = CountingFeedCache()
+    timeline = Timeline(cache)
+    with fx_stage:
+        assert timeline.refresh(fx_stage, ['a']) == 1
+        # Only the feed not indexed yet is indexed
+        assert timeline.refresh(fx_stage, ['a', 'b']) == 1
+        cache.revision_reads = 0
+        assert timeline.refresh(fx_stage, ['a', 'b']) == 0
+        assert cache.revision_reads == 0
+    with fx_stage:
+        fx_stage.feeds['a'] = make_feed('a', 5, hours=2)
+    timeline.check_interval = 0
+    with fx_stage:
+        assert timeline.refresh(fx_stage, ['a', 'b']) == 1
+    assert len(list(timeline.iter_rows(frozenset(['a'])))) == 5
+
+
+def test_timeline_stored(fx_stage):
+    cache = FeedCache()
+    timeline = Timeline(cache)
+    with fx_stage:
+        timeline.update(fx_stage, ['a', 'b'])
+    rows = timeline.rows
+    with fx_stage:
+        feed = cache.get(fx_stage, 'a')
+        feed.entries[1].read = True
+        cache.store(fx_stage, 'a', feed)
+    # Only flags are updated
+    assert timeline.rows is rows
+    assert row_ids(timeline.iter_rows(frozenset(['a']), read=True)) == [
+        ('a', get_hash('a/1/'))
+    ]
+    with fx_stage:
+        cache.store(fx_stage, 'b', make_feed('b', 4, hours=2, offset=1))
+        assert timeline.refresh(fx_stage, ['a', 'b']) == 0
+    assert len(list(timeline.iter_rows(frozenset(['a', 'b'])))) == 7
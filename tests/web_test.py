@@ -13,6 +13,7 @@ except ImportError:
     import urllib.request as urllib2
 
 from flask import json, url_for
+from libearth.codecs import Rfc3339
 from libearth.compat import binary
 from libearth.crawler import crawl
 from libearth.feed import Entry, Feed, Mark, Person, Text
@@ -25,7 +26,11 @@ from libearth.tz import utc
 from pytest import fixture, mark, raises
 from werkzeug.urls import url_encode
 
-from earthreader.web import app, get_hash, worker, entry_generators
+from earthreader.web import (app, build_url, content_cache, feed_cache,
+                             flush_marks, get_hash, subscription_cache,
+                             worker, entry_generators)
+from earthreader.web.connection import connection_pool
+from earthreader.web.crawler import fetch_feed, load_validators
 
 
 @app.errorhandler(400)
@@ -187,6 +192,7 @@ class HTTPHandler(urllib2.HTTPHandler):
 
 my_opener = urllib2.build_opener(HTTPHandler)
 urllib2.install_opener(my_opener)
+connection_pool.opener = my_opener
 
 
 @fixture
@@ -436,6 +442,46 @@ def test_all_feeds(xmls):
         assert result['updated'] == '2013-08-22 07:49:20+07:00'
 
 
+def test_feeds_entry_counts(xmls, fx_test_stage):
+    feed_one_id = get_hash('http://feedone.com/feed/atom/')
+    feed_three_id = get_hash('http://feedthree.com/feed/atom/')
+    with app.test_client() as client:
+        r = client.get('/feeds/')
+        assert r.status_code == 200
+        result = json.loads(r.data)
+        assert result['unread_count'] == 5
+        assert result['starred_count'] == 0
+        assert result['feeds'][0]['unread_count'] == 1
+        assert result['categories'][0]['unread_count'] == 3
+        assert result['categories'][1]['unread_count'] == 1
+        r = client.put(get_url(
+            'read_entry', feed_id=feed_three_id,
+            entry_id=get_hash('http://feedthree.com/feed/atom/1/')
+        ))
+        assert r.status_code == 200
+        r = client.put(get_url(
+            'star_entry', category_id='-categoryone', feed_id=feed_one_id,
+            entry_id=get_hash('http://feedone.com/feed/atom/1/')
+        ))
+        assert r.status_code == 200
+        result = json.loads(client.get('/feeds/').data)
+        assert result['unread_count'] == 4
+        assert result['starred_count'] == 1
+        assert result['feeds'][0]['unread_count'] == 0
+        assert result['categories'][0]['unread_count'] == 3
+        assert result['categories'][0]['starred_count'] == 1
+        r = client.put(get_url('read_all_entries',
+                               category_id='-categoryone'))
+        assert r.status_code == 200
+        result = json.loads(client.get('/feeds/').data)
+        assert result['unread_count'] == 1
+        assert result['categories'][0]['unread_count'] == 0
+        result = json.loads(client.get('/-categoryone/feeds/').data)
+        assert result['unread_count'] == 0
+        assert result['feeds'][0]['unread_count'] == 0
+        assert result['feeds'][0]['starred_count'] == 1
+
+
 def test_invalid_path(xmls):
     with app.test_client() as client:
         feed_id = hashlib.sha1(
@@ -458,6 +504,20 @@ def test_add_feed(xmls, fx_test_stage):
         assert opml.children[3]._title == 'Feed Five'
 
 
+def test_add_feed_validators(xmls, fx_test_stage, monkeypatch):
+    def fetch_feed_with_etag(feed_url):
+        result, _, size = fetch_feed(feed_url)
+        return result, {'etag': '"v1"'}, size
+    monkeypatch.setattr('earthreader.web.fetch_feed', fetch_feed_with_etag)
+    with app.test_client() as client:
+        r = client.post('/feeds/',
+                        data=dict(url='http://feedfive.com/feed/atom/'))
+        assert r.status_code == 200
+    feed_id = get_hash('http://feedfive.com/feed/atom/')
+    with fx_test_stage as stage:
+        assert load_validators(stage, feed_id) == {'etag': '"v1"'}
+
+
 def test_add_feed_in_category(xmls, fx_test_stage):
     with app.test_client() as client:
         r = client.get('/-categoryone/feeds/')
@@ -489,6 +549,19 @@ def test_add_category(xmls, fx_test_stage):
         assert subscriptions.categories['addedcategory'] is not None
 
 
+def test_add_category_cached_subscriptions(xmls, fx_test_stage):
+    with fx_test_stage as stage:
+        cached, _ = subscription_cache.load(stage)
+    labels = sorted(cached.categories)
+    with app.test_client() as client:
+        r = client.post('/', data=dict(title='addedcategory'))
+        assert r.status_code == 200
+    # The subscription list shared by readers isn't changed in place
+    assert sorted(cached.categories) == labels
+    with fx_test_stage as stage:
+        assert 'addedcategory' in subscription_cache.load(stage)[0].categories
+
+
 def test_add_category_in_category(xmls, fx_test_stage):
     with app.test_client() as client:
         r = client.get('/feeds/')
@@ -541,6 +614,21 @@ def test_delete_feed(xmls, fx_test_stage):
             assert child['title'] != 'Feed Three'
 
 
+def test_delete_feed_content_cache(xmls, fx_test_stage, tmpdir,
+                                   monkeypatch):
+    monkeypatch.setattr(content_cache, 'persist', str(tmpdir))
+    feed_id = get_hash('http://feedthree.com/feed/atom/')
+    entry_id = get_hash('http://feedthree.com/feed/atom/1/')
+    with app.test_client() as client:
+        r = client.get(get_url('feed_entry', feed_id=feed_id,
+                               entry_id=entry_id))
+        assert r.status_code == 200
+        assert tmpdir.join(feed_id, entry_id).check()
+        r = client.delete('/feeds/' + feed_id + '/')
+        assert r.status_code == 200
+    assert not tmpdir.join(feed_id).check()
+
+
 def test_delete_feed_in_category(xmls):
     with app.test_client() as client:
         r = client.get('/-categoryone/feeds/')
@@ -754,6 +842,35 @@ def test_update_category_entries(fx_xml_for_update, fx_test_stage,
         assert r.status_code == 404
 
 
+def test_crawl_job(fx_xml_for_update, fx_test_stage, fx_crawling_queue):
+    feed_two_id = get_hash('http://feedtwo.com/feed/atom/')
+    with app.test_client() as client:
+        worker.start_worker()
+        try:
+            r = client.put(get_url('update_entries',
+                                   category_id='-categoryone/-categorytwo',
+                                   feed_id=feed_two_id))
+            assert r.status_code == 202
+            job_url = r.headers['Location']
+            assert json.loads(r.data)['job_url'] == job_url
+            job_id = job_url.rstrip('/').rsplit('/', 1)[-1]
+            assert worker.get_job(job_id).wait(5)
+            r = client.get(job_url)
+            assert r.status_code == 200
+            result = json.loads(r.data)
+            assert result['id'] == job_id
+            assert result['status'] == 'done'
+            assert result['feeds'] == result['crawled'] == 1
+            assert result['failed'] == 0
+            assert result['bytes'] > 0
+            assert result['elapsed'] >= 0
+        finally:
+            worker.kill_worker()
+        r = client.get(get_url('crawl_job', job_id='does-not-exist'))
+        assert r.status_code == 404
+        assert json.loads(r.data)['error'] == 'job-not-found'
+
+
 def test_entry_read_unread(xmls, fx_test_stage):
     with app.test_client() as client:
         feed_three_id = get_hash('http://feedthree.com/feed/atom/')
@@ -820,6 +937,100 @@ def test_entry_star_unstar(xmls, fx_test_stage):
             assert not stage.feeds[feed_three_id].entries[0].starred
 
 
+def test_mark_entries(xmls, fx_test_stage):
+    feed_one_id = get_hash('http://feedone.com/feed/atom/')
+    feed_three_id = get_hash('http://feedthree.com/feed/atom/')
+    entry_ids = [get_hash('http://feedone.com/feed/atom/1/'),
+                 get_hash('http://feedone.com/feed/atom/2/'),
+                 get_hash('http://feedthree.com/feed/atom/1/')]
+    operations = [
+        {'feed_id': feed_one_id, 'entry_id': entry_ids[0], 'read': True},
+        [feed_one_id, entry_ids[1], True, True],
+        {'feed_id': feed_three_id, 'entry_id': entry_ids[2],
+         'starred': True},
+        {'feed_id': feed_three_id, 'entry_id': 'does-not-exist',
+         'read': True},
+        {'feed_id': 'does-not-exist', 'entry_id': entry_ids[0],
+         'read': True},
+        {'feed_id': feed_one_id, 'read': True},
+    ]
+    with app.test_client() as client:
+        r = client.put(get_url('mark_entries'), data=json.dumps(operations),
+                       content_type='application/json')
+        assert r.status_code == 200
+        results = json.loads(r.data)['results']
+    assert len(results) == len(operations)
+    assert results[0]['read'] and not results[0]['starred']
+    assert results[1]['read'] and results[1]['starred']
+    assert not results[2]['read'] and results[2]['starred']
+    assert results[3]['error'] == 'entry-not-found'
+    assert results[4]['error'] == 'feed-not-found'
+    assert results[5]['error'] == 'invalid-mark'
+    with fx_test_stage as stage:
+        entries = stage.feeds[feed_one_id].entries
+        assert all(entry.read for entry in entries)
+        assert [bool(entry.starred) for entry in entries] == [True, False]
+        entry = stage.feeds[feed_three_id].entries[0]
+        assert not entry.read and entry.starred
+
+
+def test_mark_entries_invalid(xmls):
+    with app.test_client() as client:
+        r = client.put(get_url('mark_entries'), data='{"read": true}',
+                       content_type='application/json')
+        assert r.status_code == 400
+        assert json.loads(r.data)['error'] == 'invalid-marks'
+
+
+@fixture
+def fx_mark_flusher(request):
+    feed_cache.start_flusher(3600, flush_marks)
+    request.addfinalizer(feed_cache.stop_flusher)
+
+
+def test_entry_read_write_behind(xmls, fx_test_stage, fx_mark_flusher):
+    feed_three_id = get_hash('http://feedthree.com/feed/atom/')
+    test_entry_id = get_hash('http://feedthree.com/feed/atom/1/')
+    url = get_url('feed_entries', feed_id=feed_three_id)
+    with app.test_client() as client:
+        response = client.get(url)
+        assert not json.loads(response.data)['entries'][0]['read']
+        time.sleep(1)
+        r = client.put(get_url('read_entry', feed_id=feed_three_id,
+                               entry_id=test_entry_id))
+        assert r.status_code == 200
+        with fx_test_stage as stage:
+            assert not stage.feeds[feed_three_id].entries[0].read
+        response2 = client.get(url, headers={
+            'If-Modified-Since': response.headers['Last-Modified']
+        })
+        assert response2.status_code == 200
+        assert json.loads(response2.data)['entries'][0]['read']
+        feed_cache.stop_flusher()
+        with fx_test_stage as stage:
+            assert stage.feeds[feed_three_id].entries[0].read
+
+
+def test_read_all_write_behind(xmls, fx_test_stage, fx_mark_flusher):
+    feed_three_id = get_hash('http://feedthree.com/feed/atom/')
+    test_entry_id = get_hash('http://feedthree.com/feed/atom/1/')
+    with fx_test_stage as stage:
+        feed = stage.feeds[feed_three_id]
+        feed.entries[0].read = True
+        stage.feeds[feed_three_id] = feed
+    with app.test_client() as client:
+        r = client.delete(get_url('unread_entry', feed_id=feed_three_id,
+                                  entry_id=test_entry_id))
+        assert r.status_code == 200
+        r = client.put(get_url('read_all_entries', feed_id=feed_three_id))
+        assert r.status_code == 200
+        response = client.get(get_url('feed_entries', feed_id=feed_three_id))
+        assert json.loads(response.data)['entries'][0]['read']
+        feed_cache.stop_flusher()
+        with fx_test_stage as stage:
+            assert stage.feeds[feed_three_id].entries[0].read
+
+
 opml_for_filtering = '''
 <opml version="1.0">
   <head>
@@ -1053,8 +1264,15 @@ def test_feed_with_20_entries(make_empty, xmls_for_next):
         assert not result['next_url']
 
 
+@fixture(params=[True, False], ids=['timeline', 'merge'])
+def fx_category_timeline(request):
+    app.config['CATEGORY_TIMELINE'] = request.param
+    request.addfinalizer(lambda: app.config.update(CATEGORY_TIMELINE=True))
+
+
 @mark.parametrize('make_empty', [True, False])
-def test_category_entries_next(make_empty, xmls_for_next):
+def test_category_entries_next(make_empty, xmls_for_next,
+                               fx_category_timeline):
     with app.test_client() as client:
         r = client.get('/-categoryone/entries/')
         assert r.status_code == 200
@@ -1075,6 +1293,26 @@ def test_category_entries_next(make_empty, xmls_for_next):
         assert result['entries'][-1]['title'] == 'Feed Two: Entry 0'
 
 
+@mark.parametrize('make_empty', [True, False])
+def test_category_entries_merge_order(make_empty, xmls_for_next,
+                                      fx_category_timeline):
+    codec = Rfc3339()
+    keys = []
+    with app.test_client() as client:
+        url = get_url('category_entries', category_id='')
+        while url:
+            r = client.get(url)
+            assert r.status_code == 200
+            result = json.loads(r.data)
+            keys.extend((codec.decode(e['updated']), e['entry_id'])
+                        for e in result['entries'])
+            url = result['next_url']
+            if make_empty:
+                entry_generators.clear()
+    assert len(keys) == 25 + 25 + 20
+    assert keys == sorted(keys, reverse=True)
+
+
 @mark.parametrize('make_empty', [True, False])
 def test_feed_entries_filtering(make_empty, xmls_for_next):
     with app.test_client() as client:
@@ -1093,7 +1331,8 @@ def test_feed_entries_filtering(make_empty, xmls_for_next):
 
 
 @mark.parametrize('make_empty', [True, False])
-def test_category_entries_filtering(make_empty, xmls_for_next):
+def test_category_entries_filtering(make_empty, xmls_for_next,
+                                    fx_category_timeline):
     with app.test_client() as client:
         r = client.get('/-categoryone/entries/?read=False')
         result = json.loads(r.data)
@@ -1107,6 +1346,44 @@ def test_category_entries_filtering(make_empty, xmls_for_next):
             assert entry['read'] is False
 
 
+def test_category_entries_timeline_marks(xmls_for_next):
+    with app.test_client() as client:
+        url = get_url('category_entries', category_id='-categoryone',
+                      read='False')
+        result = json.loads(client.get(url).data)
+        entry = result['entries'][0]
+        r = client.put(get_url('read_entry', category_id='-categoryone',
+                               feed_id=get_hash('http://feedone.com/'),
+                               entry_id=entry['entry_id']))
+        assert r.status_code == 200
+        result = json.loads(client.get(url).data)
+        assert entry['entry_id'] not in [e['entry_id']
+                                         for e in result['entries']]
+
+
+def test_entry_fragments(xmls_for_next):
+    feed_id = get_hash('http://feedone.com/')
+    url = get_url('feed_entries', feed_id=feed_id)
+    with app.test_client() as client:
+        result = json.loads(client.get(url).data)
+        entry = result['entries'][0]
+        assert not entry['read']
+        stage = app.config['STAGE']
+        with stage:
+            cached = feed_cache.load(stage, feed_id)
+        assert len(cached.fragments) == len(result['entries'])
+        fragments = dict(cached.fragments)
+        r = client.put(get_url('read_entry', feed_id=feed_id,
+                               entry_id=entry['entry_id']))
+        assert r.status_code == 200
+        result = json.loads(client.get(url).data)
+    assert result['entries'][0]['entry_id'] == entry['entry_id']
+    assert result['entries'][0]['read']
+    del result['entries'][0]['read'], entry['read']
+    assert result['entries'][0] == entry
+    assert cached.fragments == fragments
+
+
 @mark.parametrize('make_empty', [True, False])
 def test_request_same_feed(make_empty, xmls_for_next):
     with app.test_client() as client:
@@ -1127,6 +1404,49 @@ def test_request_same_feed(make_empty, xmls_for_next):
         assert r1_result['entries'] == r2_result['entries']
 
 
+def test_feed_entries_next_twice(xmls_for_next):
+    with app.test_client() as client:
+        r = client.get('/feeds/' + get_hash('http://feedfour.com/') +
+                       '/entries/')
+        next_url = json.loads(r.data)['next_url']
+        first = json.loads(client.get(next_url).data)
+        second = json.loads(client.get(next_url).data)
+        assert first['entries'] == second['entries']
+        assert first['entries'][0]['title'] == 'Feed Four: Entry 29'
+
+
+def test_feed_entries_stateless_cursor(xmls_for_next):
+    with app.test_client() as client:
+        feed_id = get_hash('http://feedone.com/')
+        r = client.get('/feeds/' + feed_id + '/entries/')
+        result = json.loads(r.data)
+        last = result['entries'][-1]
+        entry_after = last['entry_id'] + '@' + last['updated']
+        r = client.get(get_url('feed_entries', feed_id=feed_id,
+                               entry_after=entry_after))
+        assert r.status_code == 200
+        result = json.loads(r.data)
+        assert [e['title'] for e in result['entries']] == [
+            'Feed One: Entry ' + str(i) for i in range(4, -1, -1)
+        ]
+        r = client.get(get_url('feed_entries', feed_id=feed_id,
+                               entry_after=last['entry_id']))
+        assert json.loads(r.data)['entries'] == result['entries']
+
+
+@mark.parametrize('entry_after', ['abc@invalid', 'does-not-exist'])
+def test_feed_entries_invalid_cursor(entry_after, xmls_for_next):
+    with app.test_client() as client:
+        r = client.get(get_url('feed_entries',
+                               feed_id=get_hash('http://feedone.com/'),
+                               entry_after=entry_after))
+        assert r.status_code == 400
+        assert json.loads(r.data)['error'] == 'entry-after-invalid'
+        r = client.get(get_url('category_entries', category_id='',
+                               entry_after=entry_after))
+        assert r.status_code == 400
+
+
 def test_feed_entries_http_cache():
     """feed_entries() should be cached using Last-Modified header."""
     with app.test_client() as client:
@@ -1153,6 +1473,49 @@ def test_feed_entries_http_cache():
         assert len(entries) - 1 == len(entries3)
 
 
+@mark.parametrize('endpoint', [
+    'feeds', 'category_entries', 'feed_entries', 'feed_entry'
+])
+def test_etag(endpoint, xmls_for_next):
+    feed_id = get_hash('http://feedone.com/')
+    entry_id = get_hash('http://feedone.com/24')
+    with app.test_client() as client:
+        url = get_url(endpoint, category_id='-categoryone', feed_id=feed_id,
+                      entry_id=entry_id)
+        response = client.get(url)
+        assert response.status_code == 200
+        etag = response.headers['ETag']
+        response = client.get(url, headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.headers['ETag'] == etag
+        assert not response.data
+        response = client.get(url + '?read=False',
+                              headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        client.put(get_url('read_entry', category_id='-categoryone',
+                           feed_id=feed_id, entry_id=entry_id))
+        response = client.get(url, headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+
+
+@mark.parametrize('category_id', ['', '-categoryone', '-a/-b c'])
+def test_build_url(category_id):
+    feed_id = get_hash('feed')
+    entry_id = get_hash('entry')
+    with app.test_request_context():
+        for endpoint, values in [
+            ('category_entries', {}),
+            ('feed_entries', {'feed_id': feed_id}),
+            ('feed_entry', {'feed_id': feed_id, 'entry_id': entry_id}),
+            ('feed_entry', {'feed_id': feed_id, 'entry_id': get_hash('2')}),
+            ('unstar_entry', {'feed_id': feed_id, 'entry_id': entry_id}),
+        ]:
+            assert build_url(endpoint, category_id, **values) == url_for(
+                endpoint, category_id=category_id, _external=True, **values
+            )
+
+
 def test_move_feed(xmls, fx_test_stage):
     with app.test_client() as client:
         r = client.put('/-categoryone/feeds/?from=/feeds/' +
@@ -1195,3 +1558,25 @@ def test_move_category_circular(xmls):
         r = client.put('/-categoryone/-categorytwo/feeds/?from=-categoryone')
         assert r.status_code == 400
         assert json.loads(r.data)['error'] == 'circular-reference'
+
+
+def test_static_files(tmpdir, monkeypatch):
+    monkeypatch.setattr(app, 'static_folder', str(tmpdir))
+    tmpdir.join('master.js').write(b'var earth = "reader";\n' * 100, 'wb')
+    url = get_url('static', filename='master.js')
+    assert '?v=' in url
+    with app.test_client() as client:
+        response = client.get(url)
+        assert response.cache_control.max_age == app.config['STATIC_MAX_AGE']
+        assert response.cache_control.public
+        response = client.get(url.split('?')[0])
+        assert response.cache_control.max_age != \
+            app.config['STATIC_MAX_AGE']
+        tmpdir.join('master.js.gz').write(b'precompressed', 'wb')
+        response = client.get(url, headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert response.mimetype.endswith('javascript')
+        assert response.data == b'precompressed'
+        response = client.get(url)
+        assert 'Content-Encoding' not in response.headers
+        assert response.data.startswith(b'var earth')
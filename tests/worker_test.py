@@ -0,0 +1,306 @@
+import sys
+import threading
+import time
+
+from flask import Flask
+from libearth.crawler import CrawlError, CrawlResult
+from libearth.repository import RepositoryKeyError
+from pytest import fixture
+
+from earthreader.web.worker import (BACKGROUND_PRIORITY, CATEGORY_PRIORITY,
+                                    CONTROL_PRIORITY, FEED_PRIORITY,
+                                    JobQueue, Worker)
+
+from .conftest import Cursor, make_feed
+
+# earthreader.web.worker is shadowed by the worker instance of the app
+worker_module = sys.modules[Worker.__module__]
+
+
+@fixture
+def fx_worker(request, fx_stage, monkeypatch):
+    app = Flask(__name__)
+    app.config.update(
+        STAGE=fx_stage,
+        CRAWLER_THREAD=2,
+        WORKER_POOL_SIZE=2
+    )
+    worker = Worker(app)
+    worker.fetching = 0
+    worker.max_fetching = 0
+    worker.blocked = {}
+    worker.fetched = []
+    worker.failing = set()
+    lock = threading.Lock()
+
+    def fetch_feed(feed_url, validators):
+        with lock:
+            worker.fetching += 1
+            worker.fetched.append(feed_url)
+            worker.max_fetching = max(worker.max_fetching, worker.fetching)
+        event = worker.blocked.get(feed_url)
+        if event is None:
+            time.sleep(0.01)
+        else:
+            event.wait(5)
+        with lock:
+            worker.fetching -= 1
+        if feed_url in worker.failing:
+            raise CrawlError(feed_url, feed_url + ' failed')
+        return CrawlResult(feed_url, make_feed(feed_url), {}), {}, 100
+    monkeypatch.setattr(worker_module, 'fetch_feed', fetch_feed)
+    worker.start_worker()
+    request.addfinalizer(worker.kill_worker)
+    return worker
+
+
+def stored_feeds(worker):
+    stage = worker.app.config['STAGE']
+    with stage:
+        try:
+            return frozenset(stage.feeds)
+        except RepositoryKeyError:
+            return frozenset()
+
+
+def test_worker_pool(fx_worker):
+    assert len(fx_worker.workers) == 2
+    assert fx_worker.is_running()
+    crawled = []
+    fx_worker.add_listener(lambda url, feed, hints: crawled.append(url))
+    fx_worker.add_job(Cursor('a', 'b', 'c', 'd', 'e'), None)
+    fx_worker.add_job(Cursor('f', 'g', 'h'), None)
+    fx_worker.crawling_queue.join()
+    assert stored_feeds(fx_worker) == frozenset('abcdefgh')
+    assert sorted(crawled) == ['http://example.com/' + feed_id
+                               for feed_id in 'abcdefgh']
+    assert 1 <= fx_worker.max_fetching <= 2
+    fx_worker.kill_worker()
+    assert not fx_worker.is_running()
+    fx_worker.start_worker()
+    assert fx_worker.is_running()
+
+
+def test_worker_job_not_blocked(fx_worker):
+    event = threading.Event()
+    fx_worker.blocked['http://example.com/big'] = event
+    fx_worker.add_job(Cursor('big'), None)
+    fx_worker.add_job(Cursor('small'), 'small')
+    for _ in range(500):
+        if 'small' in stored_feeds(fx_worker):
+            break
+        time.sleep(0.01)
+    assert stored_feeds(fx_worker) == frozenset(['small'])
+    event.set()
+    fx_worker.crawling_queue.join()
+    assert stored_feeds(fx_worker) == frozenset(['big', 'small'])
+
+
+def test_worker_coalesce_pending(fx_worker):
+    fx_worker.kill_worker()
+    first = fx_worker.add_job(Cursor('a', 'b'), None)
+    second = fx_worker.add_job(Cursor('b', 'c'), None)
+    assert sorted(second.owned_urls) == ['http://example.com/c']
+    assert fx_worker.add_job(Cursor('a', 'b'), None) is first
+    assert fx_worker.add_job(Cursor('a', 'b', 'c'), 'b',
+                             priority=CATEGORY_PRIORITY).owned_urls == []
+    # A job of higher priority takes over the url
+    assert fx_worker.add_job(Cursor('a', 'b', 'c'), 'a').owned_urls == [
+        'http://example.com/a'
+    ]
+    assert fx_worker.qsize() == 3
+    assert not first.done and not second.done
+    assert first.status == 'queued'
+    fx_worker.start_worker()
+    assert first.wait(5) and second.wait(5)
+    assert first.status == second.status == 'done'
+    assert (first.crawled, first.failed, first.bytes) == (2, 0, 200)
+    assert fx_worker.get_job(first.id) is first
+    assert fx_worker.get_job('does-not-exist') is None
+    assert sorted(fx_worker.fetched) == [
+        'http://example.com/a', 'http://example.com/b', 'http://example.com/c'
+    ]
+    assert not fx_worker.jobs and not fx_worker.pending
+
+
+def test_worker_coalesce_crawling(fx_worker):
+    event = threading.Event()
+    fx_worker.blocked['http://example.com/big'] = event
+    job = fx_worker.add_job(Cursor('big', 'small'), None, caller='first')
+    for _ in range(500):
+        if 'http://example.com/big' in fx_worker.fetched:
+            break
+        time.sleep(0.01)
+    feed_job = fx_worker.add_job(Cursor('big', 'small'), 'big')
+    assert feed_job is not job
+    assert feed_job.owned_urls == []
+    assert fx_worker.add_job(Cursor('big', 'small'), None,
+                             caller='second') is job
+    assert job.callers == ['first', 'second']
+    assert not feed_job.done
+    assert job.status == feed_job.status == 'running'
+    event.set()
+    assert job.wait(5) and feed_job.wait(5)
+    fx_worker.crawling_queue.join()
+    assert sorted(fx_worker.fetched) == [
+        'http://example.com/big', 'http://example.com/small'
+    ]
+    assert stored_feeds(fx_worker) == frozenset(['big', 'small'])
+
+
+def test_worker_coalesce_finished(fx_worker):
+    event = threading.Event()
+    fx_worker.blocked['http://example.com/b'] = event
+    job = fx_worker.add_job(Cursor('a', 'b'), None)
+    for _ in range(500):
+        if job.crawled:
+            break
+        time.sleep(0.01)
+    assert job.crawled == 1
+    # The url crawled by the running job is queued again by another job
+    recrawl = threading.Event()
+    fx_worker.blocked['http://example.com/a'] = recrawl
+    feed_job = fx_worker.add_job(Cursor('a', 'b'), 'a')
+    assert feed_job.owned_urls == ['http://example.com/a']
+    event.set()
+    assert job.wait(5)
+    assert (job.crawled, job.failed) == (2, 0)
+    assert not feed_job.done
+    recrawl.set()
+    assert feed_job.wait(5)
+    assert (feed_job.crawled, feed_job.failed) == (1, 0)
+    assert fx_worker.fetched.count('http://example.com/a') == 2
+
+
+def test_worker_job_progress(fx_worker):
+    fx_worker.failing.add('http://example.com/b')
+    job = fx_worker.add_job(Cursor('a', 'b', 'c'), None)
+    assert job.wait(5)
+    assert (job.crawled, job.failed, job.bytes) == (2, 1, 200)
+
+
+def test_worker_job_progress_error(fx_worker, monkeypatch):
+    def merge_feed(stored, feed_data):
+        raise RuntimeError('merge failed')
+    monkeypatch.setattr(worker_module, 'merge_feed', merge_feed)
+    job = fx_worker.add_job(Cursor('a', 'b'), None)
+    assert job.wait(5)
+    assert (job.crawled, job.failed) == (0, 2)
+
+
+def test_worker_notify_failures(fx_worker):
+    notified = []
+    fx_worker.add_listener(
+        lambda url, feed, hints: notified.append((url, feed is None))
+    )
+    fx_worker.failing.update(['http://example.com/a', 'http://example.com/b'])
+    job = fx_worker.add_job(Cursor('a', 'b', 'c'), None)
+    assert job.wait(5)
+    assert (job.crawled, job.failed) == (1, 2)
+    assert sorted(notified) == [('http://example.com/a', True),
+                                ('http://example.com/b', True),
+                                ('http://example.com/c', False)]
+
+
+def test_job_queue_priority():
+    q = JobQueue(aging=None)
+    q.put('background', BACKGROUND_PRIORITY)
+    q.put('category', CATEGORY_PRIORITY)
+    q.put('feed', FEED_PRIORITY)
+    q.put('feed-2', FEED_PRIORITY)
+    assert q.qsize() == 4
+    assert q.get() == (FEED_PRIORITY, 'feed')
+    assert q.get() == (FEED_PRIORITY, 'feed-2')
+    assert q.promote('background', FEED_PRIORITY)
+    assert not q.promote('background', BACKGROUND_PRIORITY)
+    assert q.get() == (FEED_PRIORITY, 'background')
+    assert q.get() == (CATEGORY_PRIORITY, 'category')
+    assert q.get(timeout=0.01) is None
+
+
+def test_job_queue_aging():
+    q = JobQueue(aging=0.05)
+    q.put('background', BACKGROUND_PRIORITY)
+    time.sleep(0.15)
+    q.put('feed', FEED_PRIORITY)
+    assert q.get() == (BACKGROUND_PRIORITY, 'background')
+    assert q.get() == (FEED_PRIORITY, 'feed')
+
+
+def test_job_queue_aging_control():
+    q = JobQueue(aging=0.01)
+    q.put('background', BACKGROUND_PRIORITY)
+    time.sleep(0.1)
+    q.put('terminate', CONTROL_PRIORITY)
+    assert q.get() == (CONTROL_PRIORITY, 'terminate')
+    assert q.get() == (BACKGROUND_PRIORITY, 'background')
+
+
+def test_job_queue_limits():
+    q = JobQueue(aging=None, limits={BACKGROUND_PRIORITY: 1})
+    q.put('background-1', BACKGROUND_PRIORITY)
+    q.put('background-2', BACKGROUND_PRIORITY)
+    q.put('category', CATEGORY_PRIORITY)
+    assert q.get() == (CATEGORY_PRIORITY, 'category')
+    assert q.get() == (BACKGROUND_PRIORITY, 'background-1')
+    assert q.get(timeout=0.01) is None
+    q.task_done(BACKGROUND_PRIORITY)
+    assert q.get() == (BACKGROUND_PRIORITY, 'background-2')
+    q.task_done(BACKGROUND_PRIORITY)
+    q.task_done(CATEGORY_PRIORITY)
+    q.join()
+    q.put('feed', FEED_PRIORITY)
+    assert q.clear() == ['feed']
+    q.join()
+
+
+def test_worker_priority(fx_worker):
+    events = dict((feed_id, threading.Event()) for feed_id in ['a', 'b'])
+    for feed_id, event in events.items():
+        fx_worker.blocked['http://example.com/' + feed_id] = event
+    fx_worker.add_job(Cursor('a'), None)
+    fx_worker.add_job(Cursor('b'), None)
+    for _ in range(500):
+        if fx_worker.fetching == 2:
+            break
+        time.sleep(0.01)
+    background = fx_worker.add_feeds({'http://example.com/c': 'c'},
+                                     priority=BACKGROUND_PRIORITY)
+    job = fx_worker.add_job(Cursor('c', 'd'), 'd')
+    assert job.priority == FEED_PRIORITY
+    events['a'].set()
+    assert job.wait(5)
+    assert background.status == 'queued'
+    events['b'].set()
+    assert background.wait(5)
+    assert fx_worker.fetched[2:] == [
+        'http://example.com/d', 'http://example.com/c'
+    ]
+
+
+def test_worker_background_limit(fx_worker):
+    event = threading.Event()
+    fx_worker.blocked['http://example.com/a'] = event
+    fx_worker.add_feeds({'http://example.com/a': 'a'},
+                        priority=BACKGROUND_PRIORITY)
+    background = fx_worker.add_feeds({'http://example.com/b': 'b'},
+                                     priority=BACKGROUND_PRIORITY)
+    for _ in range(500):
+        if fx_worker.fetching:
+            break
+        time.sleep(0.01)
+    # The other thread is left for interactive jobs
+    assert fx_worker.add_job(Cursor('c'), 'c').wait(5)
+    assert background.status == 'queued'
+    event.set()
+    assert background.wait(5)
+
+
+def test_worker_queue_config(fx_worker):
+    fx_worker.kill_worker()
+    # Config applied after the worker is made takes effect
+    fx_worker.app.config.update(WORKER_AGING=None,
+                                WORKER_PRIORITY_LIMITS={CATEGORY_PRIORITY: 1})
+    fx_worker.start_worker()
+    assert fx_worker.crawling_queue.aging is None
+    assert fx_worker.crawling_queue.limits == {CATEGORY_PRIORITY: 1}
@@ -1,7 +1,10 @@
+import zlib
+
+from pytest import mark
 from werkzeug.test import Client
 from werkzeug.wrappers import Response
 
-from earthreader.web.wsgi import MethodRewriteMiddleware
+from earthreader.web.wsgi import GzipMiddleware, MethodRewriteMiddleware
 
 
 def test_method_rewrite_middleware():
@@ -19,3 +22,72 @@ def test_method_rewrite_middleware():
     assert response.data == b'PUT'
     response = client.post('/?_method=DELETE')
     assert response.data == b'DELETE'
+
+
+def make_gzip_test_app(body, mimetype='text/plain', chunks=1):
+    def test_app(environ, start_response):
+        start_response('200 OK', [('Content-Type', mimetype),
+                                  ('Content-Length', str(len(body)))])
+        size = len(body) // chunks
+        return [body[i:i + size] for i in range(0, len(body), size)]
+    return test_app
+
+
+@mark.parametrize('chunks', [1, 4])
+def test_gzip_middleware(chunks):
+    body = b'Earth Reader ' * 100
+    client = Client(GzipMiddleware(make_gzip_test_app(body, chunks=chunks)),
+                    Response)
+    response = client.get('/', headers={'Accept-Encoding': 'gzip, deflate'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    assert 'Content-Length' not in response.headers
+    assert zlib.decompress(response.data, 16 + zlib.MAX_WBITS) == body
+    response = client.get('/')
+    assert 'Content-Encoding' not in response.headers
+    assert response.data == body
+    response = client.get('/', headers={'Accept-Encoding': 'gzip;q=0'})
+    assert 'Content-Encoding' not in response.headers
+    assert response.data == body
+
+
+@mark.parametrize(('body', 'mimetype'), [
+    (b'tiny', 'text/plain'),
+    (b'\x89PNG' * 1000, 'image/png'),
+])
+def test_gzip_middleware_skip(body, mimetype):
+    client = Client(GzipMiddleware(make_gzip_test_app(body, mimetype)),
+                    Response)
+    response = client.get('/', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+    assert response.data == body
+
+
+def test_gzip_middleware_etag():
+    body = b'Earth Reader ' * 100
+
+    def test_app(environ, start_response):
+        headers = [('Content-Type', 'text/plain'), ('ETag', '"v1"')]
+        if environ.get('HTTP_IF_NONE_MATCH') == '"v1"':
+            start_response('304 Not Modified', headers)
+            return []
+        start_response('200 OK', headers)
+        return [body]
+    client = Client(GzipMiddleware(test_app), Response)
+    response = client.get('/', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['ETag'] == '"v1-gzip"'
+    response = client.get('/', headers={'Accept-Encoding': 'gzip',
+                                        'If-None-Match': '"v1-gzip"'})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == '"v1-gzip"'
+    response = client.get('/')
+    assert response.headers['ETag'] == '"v1"'
+    response = client.get('/', headers={'If-None-Match': '"v1"'})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == '"v1"'
+    # The identity representation validated by a client accepting gzip
+    response = client.get('/', headers={'Accept-Encoding': 'gzip',
+                                        'If-None-Match': '"v1"'})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == '"v1"'